@@ -0,0 +1,28 @@
+"""
+Builds the weekly worksheets from per-week frames in one step.
+
+Merging every new week into the growing DataFrame copies the whole frame
+each time, which is quadratic in the number of weeks. The loops collect the
+weekly frames instead and concatenate them once.
+"""
+
+
+#Import libraries
+import pandas as pd
+import schema
+
+def combine_frames(previous_data, weekly_frames):
+    """Concatenates the previous and the new typed weekly frames at once.
+
+    Args:
+        previous_data: A typed pandas DataFrame of schema, or None.
+        weekly_frames: A list of typed pandas DataFrames of one week each.
+    Returns:
+        The typed pandas DataFrame of all the weeks, with the dtypes of the
+        frames, or previous_data if there are no frames.
+    """
+    if isinstance(previous_data, pd.DataFrame):
+        weekly_frames = [previous_data] + list(weekly_frames)
+    if not weekly_frames:
+        return previous_data
+    return schema.concat_frames(weekly_frames)
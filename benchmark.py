@@ -0,0 +1,420 @@
+"""
+Offline benchmarks of the weekly transform and build steps, without API credentials.
+
+The pipeline suite feeds synthetic Analytics Reporting API V4 and Facebook
+insights payloads of N campaigns, W weeks and M metrics through the
+transform-and-merge path of both scripts. Every case runs in a fresh
+process and records the wall time, peak RSS, traced peak allocation,
+allocated blocks and the memory of the typed frames it built. The results
+can be stored as a baseline; with --check the suite fails when a case gets
+slower or bigger than the threshold allows.
+
+Usage:
+    python benchmark.py [--campaigns 200] [--metrics 3] [--weeks 13 26 52 104 208]
+        [--transform-campaigns 10000]
+    python benchmark.py --pipeline [--campaigns 200] [--metrics 3] [--weeks 13 52]
+        [--repeats 3] [--baseline benchmark_baseline.json] [--save-baseline | --check]
+        [--threshold 0.25]
+"""
+
+
+#Import libraries
+import argparse
+import datetime as dt
+import importlib
+import json
+import multiprocessing
+import resource
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import accumulation
+import schema
+import transform
+
+# Define variables
+SCRIPTS = {'google_analytics': 'ga_weekly_download', 'facebook': 'fb_weekly_download'}
+# The pipeline.SourceAdapter of every script
+SOURCES = {'google_analytics': 'GoogleAnalyticsSource', 'facebook': 'FacebookSource'}
+BASELINE_PATH = 'benchmark_baseline.json'
+FIRST_WEEK = dt.date(2016, 1, 4)
+# The measures a case may not regress on; peak RSS, blocks and frames are only reported.
+CHECKED_MEASURES = ['wall_s', 'peak_alloc_mb']
+
+def weekly_details_frames(campaigns, metrics, weeks):
+    """Generates per-week frames shaped like clean_extracted_data_details returns.
+
+    Args:
+        campaigns: The number of campaigns.
+        metrics: The number of metrics per campaign.
+        weeks: The number of weeks.
+    Returns:
+        A list of typed pandas DataFrames of one week each.
+    """
+    random = np.random.RandomState(0)
+    campaign_names = np.repeat(np.array(['campaign {}'.format(campaign) for campaign in range(campaigns)], dtype = object), metrics)
+    metric_names = np.tile(np.array(['metric{}'.format(metric) for metric in range(metrics)], dtype = object), campaigns)
+    return [
+        transform.details_frame(
+            campaign_names,
+            metric_names,
+            random.randint(0, 1000, campaigns * metrics).astype(float),
+            '{}-{}'.format(2016 + week // 52, week % 52 + 1)
+            )
+        for week in range(weeks)]
+
+def weekly_layout_frames(campaigns, metrics, weeks):
+    """Generates per-week frames in the former worksheet layout.
+
+    Args:
+        campaigns: The number of campaigns.
+        metrics: The number of metrics per campaign.
+        weeks: The number of weeks.
+    Returns:
+        A list of one-column pandas DataFrames with the row names as index.
+    """
+    random = np.random.RandomState(0)
+    index = ['metric{}_{}'.format(metric, campaign) for campaign in range(campaigns) for metric in range(metrics)]
+    return [
+        pd.DataFrame(
+            random.randint(0, 1000, len(index)),
+            index = index,
+            columns = ['{}-{}'.format(2016 + week // 52, week % 52 + 1)]
+            )
+        for week in range(weeks)]
+
+def merge_every_week(weekly_frames):
+    """The former build step: one outer pd.merge per week of the layout frames."""
+    previous_data = weekly_frames[0]
+    for transformed_data in weekly_frames[1:]:
+        previous_data = pd.merge(
+            previous_data,
+            transformed_data,
+            how = 'outer',
+            left_index = True,
+            right_index = True
+            )
+    return previous_data
+
+def concat_every_week(weekly_frames):
+    """The growing typed frame concatenated again every week."""
+    previous_data = weekly_frames[0]
+    for transformed_data in weekly_frames[1:]:
+        previous_data = schema.concat_frames([previous_data, transformed_data])
+    return previous_data
+
+def time_call(function, *args):
+    """Times one call.
+
+    Returns:
+        The wall time in seconds.
+    """
+    started = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - started
+
+def bench_accumulation(campaigns, metrics, week_counts):
+    """Compares the per-week merge and concatenation with the single concatenation.
+
+    Args:
+        campaigns: The number of campaigns.
+        metrics: The number of metrics per campaign.
+        week_counts: A list of numbers of weeks to build.
+    Returns:
+        A pandas DataFrame of wall times, total and per week, by number of weeks.
+    """
+    results = []
+    for weeks in week_counts:
+        merge_seconds = time_call(merge_every_week, weekly_layout_frames(campaigns, metrics, weeks))
+        weekly_frames = weekly_details_frames(campaigns, metrics, weeks)
+        reconcat_seconds = time_call(concat_every_week, weekly_frames)
+        concat_seconds = time_call(accumulation.combine_frames, None, weekly_frames)
+        results.append({
+            'weeks': weeks,
+            'merge_s': merge_seconds,
+            'reconcat_s': reconcat_seconds,
+            'concat_s': concat_seconds,
+            'merge_ms_per_week': 1000 * merge_seconds / weeks,
+            'reconcat_ms_per_week': 1000 * reconcat_seconds / weeks,
+            'concat_ms_per_week': 1000 * concat_seconds / weeks
+            })
+    return pd.DataFrame(results).set_index('weeks')
+
+def ga_details_response(campaigns, metrics):
+    """Generates an Analytics Reporting API V4 response with one row per campaign.
+
+    Args:
+        campaigns: The number of campaigns.
+        metrics: The number of metrics per campaign.
+    Returns:
+        The response dictionary, with metric values as strings like the API.
+    """
+    random = np.random.RandomState(0)
+    values = random.randint(0, 100000, (campaigns, metrics))
+    return {
+        'reports': [
+            {
+                'columnHeader': {
+                    'dimensions': ['ga:campaign'],
+                    'metricHeader': {
+                        'metricHeaderEntries': [{'name': 'ga:metric{}'.format(metric), 'type': 'INTEGER'} for metric in range(metrics)]
+                        }
+                    },
+                'data': {
+                    'rows': [
+                        {
+                            'dimensions': ['campaign {}'.format(campaign)],
+                            'metrics': [{'values': [str(value) for value in values[campaign]]}]
+                        } for campaign in range(campaigns)],
+                    'rowCount': campaigns
+                    }
+            }]
+        }
+
+def bench_details_transform(campaigns, metrics):
+    """Times the details transform of one week and checks it is exact.
+
+    Args:
+        campaigns: The number of campaigns.
+        metrics: The number of metrics per campaign.
+    Returns:
+        The wall time in seconds.
+    Raises:
+        RuntimeError: A campaign name or value differs from the response.
+    """
+    response = ga_details_response(campaigns, metrics)
+    started = time.perf_counter()
+    data = transform.details_frame(*transform.ga_details_arrays(response), week = '2017-1')
+    seconds = time.perf_counter() - started
+    for campaign, row in enumerate(response['reports'][0]['data']['rows']):
+        if data.loc[campaign, 'campaign'] != row['dimensions'][0]:
+            raise RuntimeError('campaign {} is named {!r}, not {!r}'.format(
+                campaign, data.loc[campaign, 'campaign'], row['dimensions'][0]))
+        for metric, value in enumerate(row['metrics'][0]['values']):
+            if data.loc[campaign, 'ga:metric{}'.format(metric)] != float(value):
+                raise RuntimeError('ga:metric{} of campaign {} is {!r}, not {}'.format(
+                    metric, campaign, data.loc[campaign, 'ga:metric{}'.format(metric)], value))
+    return seconds
+
+def ga_report(campaigns, metrics, prefix, segment = False, random = None):
+    """Generates one Analytics Reporting API V4 report of one week.
+
+    Args:
+        campaigns: The number of campaigns.
+        metrics: The number of metrics.
+        prefix: The prefix of the metric names.
+        segment: Whether to add the ga:segment dimension.
+        random: A np.random.RandomState.
+    Returns:
+        The report dictionary, with metric values as strings like the API.
+    """
+    values = random.randint(0, 100000, (campaigns, metrics))
+    entries = [
+        {'name': 'ga:{}{}'.format(prefix, metric), 'type': 'INTEGER' if metric % 3 else 'FLOAT'}
+        for metric in range(metrics)]
+    rows = []
+    for campaign in range(campaigns):
+        dimensions = ['campaign {}'.format(campaign)]
+        if segment:
+            dimensions.append('Paid Sessions')
+        rows.append({
+            'dimensions': dimensions,
+            'metrics': [{'values': [
+                str(value / 100) if entry['type'] == 'FLOAT' else str(value)
+                for entry, value in zip(entries, values[campaign])]}]
+            })
+    totals = [
+        str(values[:, metric].sum() / 100) if entry['type'] == 'FLOAT' else str(values[:, metric].sum())
+        for metric, entry in enumerate(entries)]
+    return {
+        'reports': [
+            {
+                'columnHeader': {
+                    'dimensions': ['ga:campaign'] + (['ga:segment'] if segment else []),
+                    'metricHeader': {'metricHeaderEntries': entries}
+                    },
+                'data': {
+                    'rows': rows,
+                    'rowCount': len(rows),
+                    'totals': [{'values': totals}]
+                    }
+            }]
+        }
+
+def ga_weekly_data(campaigns, weeks, metrics):
+    """Generates the weekly responses ga_weekly_download.extract_weeks hands over.
+
+    Args:
+        campaigns: The number of campaigns.
+        weeks: The number of weeks.
+        metrics: The number of metrics per report.
+    Returns:
+        A dictionary of week starting dates to dictionaries of the
+        non-segmented and segmented responses.
+    """
+    random = np.random.RandomState(0)
+    weekly_data = {}
+    for week in range(weeks):
+        start_date = FIRST_WEEK + dt.timedelta(days = 7 * week)
+        weekly_data[start_date] = {
+            'no_seg': ga_report(campaigns, metrics, 'metric', random = random),
+            'seg': ga_report(campaigns, metrics, 'segmentMetric', segment = True, random = random)
+            }
+    return weekly_data
+
+def fb_weekly_data(campaigns, weeks, metrics):
+    """Generates the weekly campaign stats fb_weekly_download.extract_weeks hands over.
+
+    Args:
+        campaigns: The number of campaigns.
+        weeks: The number of weeks.
+        metrics: The number of insights fields.
+    Returns:
+        A dictionary of week starting dates to dictionaries of campaign
+        IDs to insights, with values as strings like the API.
+    """
+    random = np.random.RandomState(0)
+    weekly_data = {}
+    for week in range(weeks):
+        start_date = FIRST_WEEK + dt.timedelta(days = 7 * week)
+        values = random.randint(0, 100000, (campaigns, metrics))
+        weekly_data[start_date] = {
+            str(campaign): dict(
+                {'field{}'.format(metric): str(values[campaign, metric]) for metric in range(metrics)},
+                campaign_id = str(campaign),
+                campaign_name = 'campaign {}'.format(campaign),
+                date_start = str(start_date),
+                date_stop = str(start_date + dt.timedelta(days = 6))
+                )
+            for campaign in range(campaigns)}
+    return weekly_data
+
+def run_case(case):
+    """Runs the transform-and-merge path of one script on synthetic weeks.
+
+    Meant to run in a fresh process, so the peak RSS is the case's own.
+
+    Args:
+        case: A (source, campaigns, weeks, metrics, repeats) tuple.
+    Returns:
+        A dictionary of the measures of the case.
+    """
+    source, campaigns, weeks, metrics, repeats = case
+    script = importlib.import_module(SCRIPTS[source])
+    # The transform never touches the API connection or the response cache
+    adapter = getattr(script, SOURCES[source])(None, None)
+    if source == 'google_analytics':
+        weekly_data = ga_weekly_data(campaigns, weeks, metrics)
+    else:
+        weekly_data = fb_weekly_data(campaigns, weeks, metrics)
+    starting_date = min(weekly_data)
+
+    def transform_and_merge():
+        return (
+            adapter.loop_adding_weeks_totals(weekly_data, None, starting_date),
+            adapter.loop_adding_weeks_details(weekly_data, None, starting_date)
+            )
+
+    transform_and_merge()
+    wall_s = min(time_call(transform_and_merge) for _ in range(repeats))
+    tracemalloc.start()
+    result = transform_and_merge()
+    peak = tracemalloc.get_traced_memory()[1]
+    blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    tracemalloc.stop()
+    frames_mb = sum(schema.memory_report(data)['bytes'] for data in result) / 1024 / 1024
+    del result
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss_unit = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return {
+        'wall_s': wall_s,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / rss_unit,
+        'peak_alloc_mb': peak / 1024 / 1024,
+        'allocated_blocks': blocks,
+        'frames_mb': frames_mb
+        }
+
+def case_name(source, campaigns, weeks, metrics):
+    """Names a case in the baseline file."""
+    return '{} {}x{}x{}'.format(source, campaigns, weeks, metrics)
+
+def bench_pipeline(campaigns, metrics, week_counts, repeats):
+    """Runs every case of the pipeline suite in its own fresh process.
+
+    Args:
+        campaigns: The number of campaigns.
+        metrics: The number of metrics per report.
+        week_counts: A list of numbers of weeks.
+        repeats: The timed runs per case; the fastest counts.
+    Returns:
+        A dictionary of case names to their measures.
+    """
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for source in SCRIPTS:
+        for weeks in week_counts:
+            with context.Pool(1) as pool:
+                results[case_name(source, campaigns, weeks, metrics)] = pool.apply(
+                    run_case, ((source, campaigns, weeks, metrics, repeats),))
+    return results
+
+def regressions(results, baseline, threshold):
+    """Compares the results with a baseline.
+
+    Args:
+        results: A dictionary of case names to their measures.
+        baseline: The same of an earlier run.
+        threshold: The allowed relative growth of a checked measure.
+    Returns:
+        A list of the measures that grew more than the threshold allows.
+    """
+    found = []
+    for name, measures in results.items():
+        for measure in CHECKED_MEASURES:
+            if name not in baseline or measure not in baseline[name]:
+                continue
+            if measures[measure] > baseline[name][measure] * (1 + threshold):
+                found.append('{}: {} {:.4f} > {:.4f} + {:.0%}'.format(
+                    name, measure, measures[measure], baseline[name][measure], threshold))
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the weekly build step.')
+    parser.add_argument('--campaigns', type = int, default = 200)
+    parser.add_argument('--metrics', type = int, default = 3)
+    parser.add_argument('--weeks', type = int, nargs = '+', default = [13, 26, 52, 104, 208])
+    parser.add_argument('--transform-campaigns', type = int, default = 10000)
+    parser.add_argument('--pipeline', action = 'store_true', help = 'run the transform-and-merge suite of both scripts')
+    parser.add_argument('--repeats', type = int, default = 3)
+    parser.add_argument('--baseline', default = BASELINE_PATH, help = 'the JSON file of the baseline')
+    parser.add_argument('--save-baseline', action = 'store_true', help = 'store the results as the new baseline')
+    parser.add_argument('--check', action = 'store_true', help = 'fail on regressions against the baseline')
+    parser.add_argument('--threshold', type = float, default = 0.25, help = 'the allowed relative regression')
+    args = parser.parse_args()
+
+    if args.pipeline:
+        results = bench_pipeline(args.campaigns, args.metrics, args.weeks, args.repeats)
+        print(pd.DataFrame(results).T.round(4).to_string())
+        if args.save_baseline:
+            with open(args.baseline, 'w') as baseline_file:
+                json.dump(results, baseline_file, indent = 2, sort_keys = True)
+        if args.check:
+            with open(args.baseline) as baseline_file:
+                found = regressions(results, json.load(baseline_file), args.threshold)
+            for regression in found:
+                print('regression: ' + regression)
+            if found:
+                raise SystemExit(1)
+        return
+
+    # A flat time per week means linear scaling in the number of weeks
+    print(bench_accumulation(args.campaigns, args.metrics, args.weeks).round(4).to_string())
+    print('details transform of {} campaigns: {:.4f} s, exact'.format(
+        args.transform_campaigns,
+        bench_details_transform(args.transform_campaigns, args.metrics)
+        ))
+
+if __name__ == "__main__":
+    main()
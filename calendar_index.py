@@ -0,0 +1,71 @@
+"""
+ISO-week calendar of the configured history.
+
+The complete weeks from the first configured week on are indexed once, with
+their ISO-year and ISO-week computed by pandas, so the weeks stored in the
+warehouse are diffed against the whole calendar in one go and years with 53
+ISO weeks need no arithmetic of their own. The weeks missing anywhere in the
+history, not only after the last one, are then fetched in contiguous ranges.
+"""
+
+
+#Import libraries
+import datetime as dt
+import numpy as np
+import pandas as pd
+
+def week_index(first_start_date, end_date):
+    """Builds the calendar of the complete weeks of the history.
+
+    Args:
+        first_start_date: A date of the first week.
+        end_date: The first date not to query; only the weeks that ended
+            before it are complete.
+    Returns:
+        A pandas DataFrame indexed by the week starting dates, Mondays in
+        dt.date(), with int iso_year and iso_week columns.
+    """
+    first_monday = first_start_date - dt.timedelta(days = first_start_date.weekday())
+    mondays = pd.date_range(first_monday, end_date - dt.timedelta(days = 7), freq = 'W-MON')
+    iso = mondays.isocalendar()
+    return pd.DataFrame(
+        {
+            'iso_year': iso['year'].to_numpy(dtype = np.int64),
+            'iso_week': iso['week'].to_numpy(dtype = np.int64)
+        },
+        index = pd.Index(mondays.date, name = 'start_date', dtype = object)
+        )
+
+def week_keys(iso_years, iso_weeks):
+    """Numbers weeks like 201727, so they compare and sort as ints."""
+    return np.asarray(iso_years, dtype = np.int64) * 100 + np.asarray(iso_weeks, dtype = np.int64)
+
+def missing_weeks(index, stored_weeks):
+    """Diffs the calendar against the weeks already stored.
+
+    Args:
+        index: A week_index.
+        stored_weeks: A list of (iso_year, iso_week) tuples.
+    Returns:
+        A list of the week starting dates not stored, in calendar order.
+    """
+    stored = np.array(stored_weeks, dtype = np.int64).reshape(-1, 2)
+    missing = ~np.isin(week_keys(index['iso_year'], index['iso_week']), week_keys(stored[:, 0], stored[:, 1]))
+    return index.index[missing].tolist()
+
+def coalesce(week_starts):
+    """Groups weeks into contiguous ranges.
+
+    Args:
+        week_starts: A sorted list of week starting dates.
+    Returns:
+        A list of (first Monday, last Monday) tuples, one per range of
+        consecutive weeks.
+    """
+    if not week_starts:
+        return []
+    ordinals = np.array([start_date.toordinal() for start_date in week_starts])
+    breaks = np.flatnonzero(np.diff(ordinals) != 7) + 1
+    firsts = np.concatenate([[0], breaks])
+    lasts = np.concatenate([breaks - 1, [len(week_starts) - 1]])
+    return [(week_starts[first], week_starts[last]) for first, last in zip(firsts, lasts)]
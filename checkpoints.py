@@ -0,0 +1,107 @@
+"""
+Per-week checkpoints of a backfill.
+
+Every extracted week is transformed and stored in the warehouse as soon as
+it and all the weeks before it are extracted, so a run that stops halfway,
+on a crash or an expired token, keeps the weeks done so far. The next run
+extracts only the weeks not checkpointed of each worksheet, and the upload
+reads the warehouse, so it can also run from the checkpoints alone.
+"""
+
+
+#Import libraries
+import sheets_loader
+import warehouse
+
+class OrderedWeeks(object):
+    """Hands over extracted weeks in calendar order, so the checkpoints never skip a week."""
+
+    def __init__(self, week_starts, on_week):
+        """Starts with no weeks.
+
+        Args:
+            week_starts: The week starting dates, Mondays, of the extraction.
+            on_week: A function of a week starting date and its extracted data,
+                or None to only keep the order.
+        """
+        self.week_starts = sorted(week_starts)
+        self.waiting = set(self.week_starts)
+        self.on_week = on_week
+        self.ready = {}
+        self.released = 0
+
+    def add(self, start_date, extracted_data):
+        """Takes a complete week and hands over all the weeks now in order.
+
+        Weeks handed over before, or not part of the extraction, are ignored.
+        """
+        if start_date not in self.waiting:
+            return
+        self.waiting.discard(start_date)
+        self.ready[start_date] = extracted_data
+        while self.released < len(self.week_starts) and self.week_starts[self.released] in self.ready:
+            start_date = self.week_starts[self.released]
+            extracted_data = self.ready.pop(start_date)
+            if self.on_week is not None:
+                self.on_week(start_date, extracted_data)
+            self.released += 1
+
+def first_missing_week(week_labels, header):
+    """Finds the first week of the warehouse missing on a worksheet.
+
+    Args:
+        week_labels: The week column names of the warehouse, in calendar order.
+        header: The header row of the worksheet.
+    Returns:
+        The (iso_year, iso_week) tuple of the first week not on the
+        worksheet, or None when it has them all.
+    """
+    uploaded = set(str(column) for column in header[1:])
+    for label in week_labels:
+        if label not in uploaded:
+            return warehouse.parse_week(label)
+    return None
+
+def load_worksheets(store, sheets, worksheets, sharding = None):
+    """Uploads the worksheets derived from the warehouse and checkpoints their weeks as loaded.
+
+    Only the weeks from the first one missing on a worksheet are pivoted,
+    the columns before it are on the worksheet already.
+
+    Args:
+        store: The warehouse.Warehouse of the account or view.
+        sheets: A sheets_loader.GspreadBackend of the spreadsheet.
+        worksheets: The names of the totals and the details worksheets.
+        sharding: A shards.Sharding to split the details worksheet with,
+            or None to upload it whole.
+    Returns:
+        A dictionary of the cells written per worksheet.
+    """
+    cells = {}
+    for worksheet_name, frame in zip(worksheets, [store.totals_frame, store.details_frame]):
+        # Only the weeks stored before the frame is read are uploaded with it;
+        # the ones stored while the upload runs are left for the next one
+        pending_weeks = store.pending_weeks(worksheet_name)
+        if sharding is not None and worksheet_name == worksheets[1]:
+            # Upload only the shards with new weeks
+            cells[worksheet_name] = sharding.load(store, sheets, worksheet_name, pending_weeks)
+        else:
+            layout = sheets.get_layout(worksheet_name)
+            first_week = first_missing_week(store.week_labels(worksheet_name), layout[0])
+            cells[worksheet_name] = 0
+            if first_week is not None:
+                # Upload only the new cells of the worksheet
+                cells[worksheet_name] = sheets_loader.upload_delta(
+                    sheets, worksheet_name, frame(worksheet_name, first_week), layout)
+        store.mark_loaded(worksheet_name, pending_weeks)
+    return cells
+
+def add_arguments(parser):
+    """Adds the --resume, --restart and --load-only options to an argparse parser."""
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--resume', dest = 'restart', action = 'store_false', default = False,
+        help = 'continue after the last checkpointed week, the default')
+    group.add_argument('--restart', dest = 'restart', action = 'store_true',
+        help = 'drop the weeks checkpointed since the last upload and extract them again')
+    parser.add_argument('--load-only', action = 'store_true',
+        help = 'upload the checkpointed weeks without extracting')
@@ -0,0 +1,741 @@
+"""
+Local stand-ins of the Analytics Reporting API V4, the Facebook Graph API and Google Sheets.
+
+The fakes answer through the same client interfaces the scripts use: the
+reports().batchGet() service of initialize_analyticsreporting, the ad
+account, campaign, report run and batch objects of the Facebook SDK, and
+the gspread client of initialize_drive. Every call waits a configurable latency, pages are capped at a
+configurable size, and a seeded share of the calls gets rate-limit or other
+errors. The data is generated per campaign and day, so any date range and
+granularity adds up consistently.
+
+Run the whole extract-to-load pipeline of both scripts offline:
+    python fakes.py [--campaigns 200] [--weeks 52] [--latency 0.05] [--page-size 1000]
+        [--rate-limit-rate 0.02] [--error-rate 0] [--seed 0] [--requests-per-second 50]
+        [--max-workers 4] [--sources google_analytics facebook] [--workdir fake_run]
+        [--resume | --restart] [--load-only]
+"""
+
+
+#Import libraries
+import argparse
+import collections
+import datetime as dt
+import importlib
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import zlib
+import numpy as np
+import gspread
+import checkpoints
+import instrumentation
+import rate_limiter
+import response_cache
+import sheets_loader
+import warehouse
+
+# Define variables
+SCRIPTS = {'google_analytics': 'ga_weekly_download', 'facebook': 'fb_weekly_download'}
+FIRST_DAY = dt.date(2015, 1, 5)
+SPREADSHEET = 'https://docs.google.com/spreadsheets/d/fake'
+REPORT_CACHE_SIZE = 16
+
+class FakeService(object):
+    """The latency, rate limits, errors and campaign data all fakes share."""
+
+    def __init__(self, campaigns = 100, latency = 0.0, page_size = 1000, rate_limit_rate = 0.0, error_rate = 0.0, seed = 0):
+        """Creates the service.
+
+        Args:
+            campaigns: The number of campaigns, starting one week after the other.
+            latency: The seconds every call takes.
+            page_size: The largest page the service returns.
+            rate_limit_rate: The share of calls answered with a rate-limit error.
+            error_rate: The share of calls answered with an error not worth retrying.
+            seed: The seed of the data and of the failing calls.
+        """
+        self.campaigns = campaigns
+        self.latency = latency
+        self.page_size = page_size
+        self.rate_limit_rate = rate_limit_rate
+        self.error_rate = error_rate
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.campaign_starts = np.array([FIRST_DAY + dt.timedelta(days = (7 * number) % 364) for number in range(campaigns)])
+        self.daily = {}
+        self.calls = 0
+        self.call_times = collections.deque()
+        self.lock = threading.Lock()
+
+    def answer(self):
+        """Waits the latency of a call and draws its outcome.
+
+        Returns:
+            None for a successful call, 'rate_limit' or 'error'.
+        """
+        with self.lock:
+            self.calls += 1
+            self.call_times.append(time.monotonic())
+            draw = self.random.random()
+        if self.latency:
+            time.sleep(self.latency)
+        if draw < self.rate_limit_rate:
+            return 'rate_limit'
+        if draw < self.rate_limit_rate + self.error_rate:
+            return 'error'
+        return None
+
+    def calls_per_minute(self):
+        """Counts the calls of the last minute."""
+        with self.lock:
+            while self.call_times and self.call_times[0] < time.monotonic() - 60:
+                self.call_times.popleft()
+            return len(self.call_times)
+
+    def campaign_name(self, number):
+        """Names a campaign."""
+        return 'Campaign {:05d}'.format(number)
+
+    def day_values(self, day, metric):
+        """Generates the values of a metric of all campaigns on a day.
+
+        Returns:
+            An int array, 0 for the campaigns that did not start yet.
+        """
+        key = (day, metric)
+        values = self.daily.get(key)
+        if values is None:
+            state = np.random.RandomState(zlib.crc32('{} {} {}'.format(self.seed, day, metric).encode('utf-8')))
+            values = state.randint(0, 1000, self.campaigns)
+            values[self.campaign_starts > day] = 0
+            self.daily[key] = values
+        return values
+
+    def range_values(self, starting_date, ending_date, metric):
+        """Sums the daily values of a metric of all campaigns over a date range."""
+        total = np.zeros(self.campaigns, dtype = np.int64)
+        day = starting_date
+        while day <= ending_date:
+            total += self.day_values(day, metric)
+            day += dt.timedelta(days = 1)
+        return total
+
+    def active(self, ending_date):
+        """Lists the numbers of the campaigns started by a date."""
+        return np.flatnonzero(self.campaign_starts <= ending_date)
+
+def iso_weeks(starting_date, ending_date):
+    """Splits a date range into its ISO weeks.
+
+    Returns:
+        A list of (ISO week like '201701', first date, last date) tuples.
+    """
+    weeks = []
+    day = starting_date
+    while day <= ending_date:
+        last_day = min(ending_date, day + dt.timedelta(days = 6 - day.weekday()))
+        weeks.append(('{}{:02d}'.format(*day.isocalendar()[:2]), day, last_day))
+        day = last_day + dt.timedelta(days = 1)
+    return weeks
+
+def metric_text(value, cents):
+    """Formats a metric value like the APIs, as a string."""
+    if cents:
+        return str(value / 100)
+    return str(int(value))
+
+class FakeHttpResponse(object):
+    """The response status of a FakeHttpError."""
+
+    def __init__(self, status):
+        self.status = status
+
+class FakeHttpError(Exception):
+    """An error shaped like googleapiclient.errors.HttpError."""
+
+    def __init__(self, status, reason):
+        super(FakeHttpError, self).__init__('{} {}'.format(status, reason))
+        self.resp = FakeHttpResponse(status)
+        self.content = json.dumps({'error': {'code': status, 'errors': [{'reason': reason}]}}).encode('utf-8')
+
+class FakeRequest(object):
+    """A request of the fake discovery client, sent by execute."""
+
+    def __init__(self, send):
+        self.send = send
+
+    def execute(self):
+        return self.send()
+
+class FakeAnalytics(FakeService):
+    """A stand-in of the Analytics Reporting API V4 service object."""
+
+    def __init__(self, sampling_limit = 0, **kwargs):
+        """Creates the service.
+
+        Args:
+            sampling_limit: The most sessions, the first metric, a segmented
+                report reads before it is sampled; 0 never samples.
+            kwargs: The arguments of FakeService.
+        """
+        super(FakeAnalytics, self).__init__(**kwargs)
+        self.sampling_limit = sampling_limit
+        self.reports_cache = collections.OrderedDict()
+
+    def reports(self):
+        return self
+
+    def batchGet(self, body):
+        return FakeRequest(lambda: self.batch_get(body))
+
+    def batch_get(self, body):
+        """Answers a batchGet call.
+
+        Args:
+            body: The request body with up to five reportRequests.
+        Returns:
+            The response dictionary.
+        """
+        outcome = self.answer()
+        if outcome == 'rate_limit':
+            raise FakeHttpError(429, 'rateLimitExceeded')
+        if outcome == 'error' or len(body['reportRequests']) > 5:
+            raise FakeHttpError(400, 'badRequest')
+        return {'reports': [self.report_page(report_request) for report_request in body['reportRequests']]}
+
+    def report_page(self, report_request):
+        """Answers one page of a reportRequest."""
+        key = json.dumps(dict(report_request, pageToken = None), sort_keys = True)
+        with self.lock:
+            report = self.reports_cache.pop(key, None)
+        if report is None:
+            report = self.report(report_request)
+        with self.lock:
+            self.reports_cache[key] = report
+            while len(self.reports_cache) > REPORT_CACHE_SIZE:
+                self.reports_cache.popitem(last = False)
+        page_size = min(report_request.get('pageSize', 1000), self.page_size)
+        first = int(report_request.get('pageToken') or 0)
+        page = {
+            'columnHeader': report['columnHeader'],
+            'data': dict(report['data'], rows = report['data']['rows'][first:first + page_size])
+            }
+        if first + page_size < len(report['data']['rows']):
+            page['nextPageToken'] = str(first + page_size)
+        return page
+
+    def report(self, report_request):
+        """Builds all rows of a reportRequest."""
+        dimensions = [dimension['name'] for dimension in report_request['dimensions']]
+        metrics = [metric['expression'] for metric in report_request['metrics']]
+        cents = [metric.get('formattingType') == 'FLOAT' for metric in report_request['metrics']]
+        date_range = report_request['dateRanges'][0]
+        starting_date = dt.datetime.strptime(date_range['startDate'], '%Y-%m-%d').date()
+        ending_date = dt.datetime.strptime(date_range['endDate'], '%Y-%m-%d').date()
+        if 'ga:isoYearIsoWeek' in dimensions:
+            periods = iso_weeks(starting_date, ending_date)
+        else:
+            periods = [(None, starting_date, ending_date)]
+        # Every segment has values of its own
+        segments = [
+            segment['dynamicSegment']['name'] if 'dynamicSegment' in segment else segment['segmentId']
+            for segment in report_request.get('segments', [])]
+        # Segments are computed on the fly, from a sample above the limit
+        space = int(self.range_values(starting_date, ending_date, metrics[0]).sum())
+        sampled = bool(self.sampling_limit and segments and space > self.sampling_limit)
+        rows = []
+        totals = np.zeros(len(metrics), dtype = np.int64)
+        for week, first_day, last_day in periods:
+            for segment in segments or [None]:
+                values = np.column_stack([
+                    self.range_values(first_day, last_day, metric if segment is None else '{} {}'.format(metric, segment))
+                    for metric in metrics])
+                if sampled:
+                    # The sample read, scaled back up to the whole
+                    rate = self.sampling_limit / space
+                    values = np.round(np.round(values * rate) / rate).astype(np.int64)
+                for number in self.active(last_day):
+                    row_dimensions = [self.campaign_name(number)]
+                    if week is not None:
+                        row_dimensions.insert(0, week)
+                    if segment is not None:
+                        row_dimensions.append(segment)
+                    rows.append({
+                        'dimensions': row_dimensions,
+                        'metrics': [{'values': [metric_text(value, cent) for value, cent in zip(values[number], cents)]}]
+                        })
+                totals += values.sum(axis = 0)
+        data = {
+            'rows': rows,
+            'rowCount': len(rows),
+            'totals': [{'values': [metric_text(value, cent) for value, cent in zip(totals, cents)]}]
+            }
+        if sampled:
+            data['samplesReadCounts'] = [str(self.sampling_limit)]
+            data['samplingSpaceSizes'] = [str(space)]
+        return {
+            'columnHeader': {
+                'dimensions': dimensions,
+                'metricHeader': {
+                    'metricHeaderEntries': [
+                        {'name': metric, 'type': 'FLOAT' if cent else 'INTEGER'}
+                        for metric, cent in zip(metrics, cents)]
+                    }
+                },
+            'data': data
+            }
+
+class FakeFacebookError(Exception):
+    """An error shaped like facebookads.exceptions.FacebookRequestError."""
+
+    def __init__(self, code, status, message):
+        super(FakeFacebookError, self).__init__(message)
+        self.code = code
+        self.status = status
+        self.message = message
+
+    def api_error_code(self):
+        return self.code
+
+    def http_status(self):
+        return self.status
+
+    def api_error_message(self):
+        return self.message
+
+def facebook_error(outcome):
+    """Builds the error of a failed Graph API call."""
+    if outcome == 'rate_limit':
+        return FakeFacebookError(17, 400, 'User request limit reached')
+    return FakeFacebookError(100, 400, 'Invalid parameter')
+
+class FakeCursor(object):
+    """A paged Graph API result, read page by page while iterated.
+
+    Like the facebookads Cursor, a page that fails to load leaves the cursor
+    where it was, so iterating on loads the same page again.
+    """
+
+    def __init__(self, service, rows, page_size):
+        self.service = service
+        self.rows = rows
+        self.page_size = min(page_size, service.page_size)
+        # The first page came with the call itself
+        self.queue = list(rows[:self.page_size])
+        self.position = self.page_size
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.queue and not self.load_next_page():
+            raise StopIteration()
+        return self.queue.pop(0)
+
+    def load_next_page(self):
+        """Loads the next page, False when there is none."""
+        if self.position >= len(self.rows):
+            return False
+        outcome = self.service.answer()
+        if outcome:
+            raise facebook_error(outcome)
+        self.queue = list(self.rows[self.position:self.position + self.page_size])
+        self.position += self.page_size
+        return True
+
+    def headers(self):
+        """The usage headers of the call."""
+        return self.service.usage_headers()
+
+class FakeCampaign(dict):
+    """A stand-in of a facebookads Campaign with its name."""
+
+    class Field(object):
+        name = 'name'
+
+    def __init__(self, account, number):
+        super(FakeCampaign, self).__init__(id = '{}{:05d}'.format(account.fbid.replace('act_', ''), number), name = account.service.campaign_name(number))
+        self.account = account
+        self.number = number
+
+    def get_id(self):
+        return self['id']
+
+    def get_insights(self, fields, params):
+        return self.account.campaign_insights(self.number, fields, params)
+
+class FakeReportRun(dict):
+    """A stand-in of a facebookads AdReportRun that completes after some polls."""
+
+    def __init__(self, account, fields, params):
+        super(FakeReportRun, self).__init__(id = 'report_run_{}'.format(id(self)), async_status = 'Job Not Started', async_percent_completion = 0)
+        self.account = account
+        self.fields = fields
+        self.params = params
+        self.polls = 0
+
+    def get_id(self):
+        return self['id']
+
+    def api_get(self, fields = None):
+        outcome = self.account.service.answer()
+        if outcome:
+            raise facebook_error(outcome)
+        self.polls += 1
+        if self.polls >= self.account.service.report_run_polls:
+            self.update(async_status = 'Job Completed', async_percent_completion = 100)
+        else:
+            self.update(async_status = 'Job Running', async_percent_completion = 100 * self.polls // self.account.service.report_run_polls)
+        return self
+
+    def get_insights(self, params = None):
+        return self.account.get_insights(self.fields, dict(self.params, limit = (params or {}).get('limit', 500)))
+
+class FakeAdAccount(object):
+    """A stand-in of a facebookads AdAccount."""
+
+    def __init__(self, service, fbid):
+        self.service = service
+        self.fbid = fbid
+
+    def get_id(self):
+        return self.fbid
+
+    def get_campaigns(self, fields = None):
+        outcome = self.service.answer()
+        if outcome:
+            raise facebook_error(outcome)
+        return FakeCursor(self.service, [FakeCampaign(self, number) for number in range(self.service.campaigns)], 1000)
+
+    def insights_rows(self, numbers, fields, starting_date, ending_date):
+        """Builds the insights rows of some campaigns over one date range."""
+        values = {field: self.service.range_values(starting_date, ending_date, field) for field in fields if field not in ('campaign_name', 'campaign_id')}
+        rows = []
+        for number in numbers:
+            if self.service.campaign_starts[number] > ending_date:
+                continue
+            row = {field: metric_text(values[field][number], field == 'spend') for field in values}
+            if 'campaign_name' in fields:
+                row['campaign_name'] = self.service.campaign_name(number)
+            if 'campaign_id' in fields:
+                row['campaign_id'] = FakeCampaign(self, number).get_id()
+            row.update(date_start = str(starting_date), date_stop = str(ending_date))
+            rows.append(row)
+        return rows
+
+    def campaign_insights(self, number, fields, params):
+        """Answers the insights call of one campaign and date range."""
+        outcome = self.service.answer()
+        if outcome:
+            raise facebook_error(outcome)
+        starting_date, ending_date = time_range(params)
+        return FakeCursor(self.service, self.insights_rows([number], fields, starting_date, ending_date), 1000)
+
+    def get_insights(self, fields, params):
+        """Answers account insights at campaign level, in weekly time increments."""
+        outcome = self.service.answer()
+        if outcome:
+            raise facebook_error(outcome)
+        starting_date, ending_date = time_range(params)
+        increment = params.get('time_increment', 'all_days')
+        rows = []
+        day = starting_date
+        while day <= ending_date:
+            if increment == 'all_days':
+                last_day = ending_date
+            else:
+                last_day = min(ending_date, day + dt.timedelta(days = int(increment) - 1))
+            rows.extend(self.insights_rows(range(self.service.campaigns), fields, day, last_day))
+            day = last_day + dt.timedelta(days = 1)
+        return FakeCursor(self.service, rows, params.get('limit', 25))
+
+    def get_insights_async(self, fields, params):
+        outcome = self.service.answer()
+        if outcome:
+            raise facebook_error(outcome)
+        return FakeReportRun(self, fields, params)
+
+def time_range(params):
+    """Reads the dates of a time_range parameter, a dictionary or its JSON."""
+    value = params['time_range']
+    if isinstance(value, str):
+        value = json.loads(value)
+    return (
+        dt.datetime.strptime(value['since'], '%Y-%m-%d').date(),
+        dt.datetime.strptime(value['until'], '%Y-%m-%d').date()
+        )
+
+class FakeResponse(object):
+    """A sub-response of a fake batch request."""
+
+    def __init__(self, body = None, error = None, headers = None):
+        self.body = body
+        self.failure = error
+        self.header_list = headers or []
+
+    def json(self):
+        return self.body
+
+    def headers(self):
+        return self.header_list
+
+    def error(self):
+        return self.failure
+
+class FakeBatch(object):
+    """A stand-in of a facebookads FacebookAdsApiBatch of campaign insights calls."""
+
+    def __init__(self, service):
+        self.service = service
+        self.calls = []
+
+    def add(self, method, relative_path, params = None, headers = None, files = None, success = None, failure = None, request = None):
+        self.calls.append((relative_path, params or {}, success, failure))
+
+    def execute(self):
+        outcome = self.service.answer()
+        if outcome:
+            raise facebook_error(outcome)
+        if len(self.calls) > 50:
+            raise FakeFacebookError(1, 400, 'Too many requests in batch')
+        header_list = [{'name': name, 'value': value} for name, value in self.service.usage_headers().items()]
+        for relative_path, params, success, failure in self.calls:
+            with self.service.lock:
+                draw = self.service.random.random()
+            if draw < self.service.rate_limit_rate + self.service.error_rate:
+                failure(FakeResponse(error = facebook_error('rate_limit' if draw < self.service.rate_limit_rate else 'error')))
+                continue
+            campaign_id = relative_path.split('/')[0]
+            account, number = self.service.campaigns_by_id[campaign_id]
+            fields = params['fields'].split(',') if isinstance(params['fields'], str) else params['fields']
+            starting_date, ending_date = time_range(params)
+            success(FakeResponse(body = {'data': account.insights_rows([number], fields, starting_date, ending_date)}, headers = header_list))
+
+class FakeFacebook(FakeService):
+    """A stand-in of the FacebookAdsApi with its ad accounts."""
+
+    def __init__(self, *args, **kwargs):
+        self.calls_per_minute_quota = kwargs.pop('calls_per_minute_quota', 6000)
+        self.report_run_polls = kwargs.pop('report_run_polls', 3)
+        super(FakeFacebook, self).__init__(*args, **kwargs)
+        self.campaigns_by_id = {}
+
+    def account(self, fbid):
+        """Opens an ad account, like facebookads AdAccount(fbid)."""
+        account = FakeAdAccount(self, fbid)
+        for number in range(self.campaigns):
+            self.campaigns_by_id[FakeCampaign(account, number).get_id()] = (account, number)
+        return account
+
+    def new_batch(self):
+        return FakeBatch(self)
+
+    def usage_headers(self):
+        """The X-App-Usage header of the calls of the last minute."""
+        percent = min(100, 100 * self.calls_per_minute() // max(1, self.calls_per_minute_quota))
+        return {'x-app-usage': json.dumps({'call_count': percent, 'total_cputime': percent, 'total_time': percent})}
+
+class FakeWorksheet(object):
+    """A stand-in of a gspread Worksheet, with its cells by (row, column)."""
+
+    def __init__(self, client, title, rows, cols):
+        self.client = client
+        self.title = title
+        self.row_count = rows
+        self.col_count = cols
+        self.cells = {}
+
+    def row_values(self, row):
+        self.client.answer()
+        cols = max([col for cell_row, col in self.cells if cell_row == row] or [0])
+        return [self.cells.get((row, col), '') for col in range(1, cols + 1)]
+
+    def col_values(self, col):
+        self.client.answer()
+        rows = max([row for row, cell_col in self.cells if cell_col == col] or [0])
+        return [self.cells.get((row, col), '') for row in range(1, rows + 1)]
+
+    def resize(self, rows = None, cols = None):
+        self.client.answer()
+        self.row_count = rows or self.row_count
+        self.col_count = cols or self.col_count
+
+class FakeSpreadsheet(object):
+    """A stand-in of a gspread Spreadsheet."""
+
+    def __init__(self, client):
+        self.client = client
+        self.worksheets = {}
+
+    def worksheet(self, title):
+        self.client.answer()
+        if title not in self.worksheets:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self.worksheets[title]
+
+    def add_worksheet(self, title, rows, cols):
+        self.client.answer()
+        self.worksheets[title] = FakeWorksheet(self.client, title, rows, cols)
+        return self.worksheets[title]
+
+    def values_batch_get(self, ranges, params = None):
+        """Reads ranges column by column, like a values batchGet with majorDimension COLUMNS."""
+        self.client.answer()
+        value_ranges = []
+        for full_range in ranges:
+            title, a1_range = re.match(r"^'(.*)'!(.*)$", full_range).groups()
+            value_ranges.append({'range': full_range, 'values': sheets_loader.range_columns(self.worksheets[title].cells, a1_range)})
+        return {'valueRanges': value_ranges}
+
+    def values_batch_update(self, body):
+        """Writes the ranges of a values update, within the worksheet grids."""
+        self.client.answer()
+        for update in body['data']:
+            title, a1_range = re.match(r"^'(.*)'!(.*)$", update['range']).groups()
+            worksheet = self.worksheets[title]
+            first_row, first_col = sheets_loader.parse_cell(a1_range.split(':')[0])
+            for row_number, row in enumerate(update['values']):
+                for col_number, value in enumerate(row):
+                    if first_row + row_number > worksheet.row_count or first_col + col_number > worksheet.col_count:
+                        raise ValueError('Range {} exceeds the grid of {}'.format(update['range'], title))
+                    worksheet.cells[(first_row + row_number, first_col + col_number)] = value
+                    self.client.cells_written += 1
+
+class FakeSheetsClient(FakeService):
+    """A stand-in of the gspread client, with latency only."""
+
+    def __init__(self, latency = 0.0, path = None):
+        """Opens the fake spreadsheets.
+
+        Args:
+            latency: The seconds every call takes.
+            path: A JSON file to keep the spreadsheets in between runs, or None.
+        """
+        super(FakeSheetsClient, self).__init__(campaigns = 0, latency = latency)
+        self.spreadsheets = {}
+        self.cells_written = 0
+        self.path = path
+        if path and os.path.exists(path):
+            with open(path) as sheets_file:
+                for url, worksheets in json.load(sheets_file).items():
+                    spreadsheet = self.spreadsheets[url] = FakeSpreadsheet(self)
+                    for title, saved in worksheets.items():
+                        worksheet = spreadsheet.worksheets[title] = FakeWorksheet(self, title, saved['rows'], saved['cols'])
+                        worksheet.cells = {(row, col): value for row, col, value in saved['cells']}
+
+    def save(self):
+        """Writes the spreadsheets to the JSON file."""
+        saved = {
+            url: {
+                title: {
+                    'rows': worksheet.row_count,
+                    'cols': worksheet.col_count,
+                    'cells': [[row, col, value] for (row, col), value in worksheet.cells.items()]
+                    } for title, worksheet in spreadsheet.worksheets.items()}
+            for url, spreadsheet in self.spreadsheets.items()}
+        with open(self.path, 'w') as sheets_file:
+            json.dump(saved, sheets_file)
+
+    def open_by_url(self, url):
+        self.answer()
+        return self.spreadsheets.setdefault(url, FakeSpreadsheet(self))
+
+def run_offline(source, analytics = None, facebook = None, sheets = None, weeks = 52, workdir = None, restart = False, load_only = False):
+    """Runs the extract-to-load pipeline of a script against the fakes.
+
+    Args:
+        source: 'google_analytics' or 'facebook'.
+        analytics: The FakeAnalytics of a Google Analytics run.
+        facebook: The FakeFacebook of a Facebook run.
+        sheets: The FakeSheetsClient.
+        weeks: The number of complete weeks to backfill on the first run.
+        workdir: The directory of the cache and warehouse files.
+        restart: Whether to drop the weeks checkpointed since the last upload.
+        load_only: Whether to upload the checkpointed weeks without extracting.
+    Returns:
+        A dictionary of the run's result and report.
+    """
+    script = importlib.import_module(SCRIPTS[source])
+    workdir = workdir or tempfile.mkdtemp()
+    os.makedirs(workdir, exist_ok = True)
+    this_monday = dt.date.today() - dt.timedelta(days = dt.date.today().weekday())
+    # Wire the script to the fakes
+    cache = response_cache.ResponseCache(path = os.path.join(workdir, 'api_cache_{}.sqlite'.format(source)))
+    script.FIRST_START_DATE = this_monday - dt.timedelta(days = 7 * weeks)
+    store = warehouse.Warehouse(path = os.path.join(workdir, 'warehouse_{}.sqlite'.format(source)))
+    report = instrumentation.start(script.__name__, 'fake', [script.LIMITER])
+    if source == 'google_analytics':
+        script.initialize_analyticsreporting = lambda: analytics
+        result = script.run(analytics, sheets, 'fake', SPREADSHEET, script.WORKSHEETS, store, restart = restart, load_only = load_only, cache = cache)
+    else:
+        script.END_DATE = dt.date.today()
+        script.FacebookAdsApi.set_default_api(facebook)
+        result = script.run(facebook.account('act_fake'), sheets, SPREADSHEET, script.WORKSHEETS, store, restart = restart, load_only = load_only, cache = cache)
+    return {'result': result, 'report': report.to_dict()}
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Run the weekly downloads against local fakes of the APIs.')
+    parser.add_argument('--campaigns', type = int, default = 200)
+    parser.add_argument('--weeks', type = int, default = 52)
+    parser.add_argument('--latency', type = float, default = 0.05, help = 'the seconds every API call takes')
+    parser.add_argument('--sheets-latency', type = float, default = 0.0)
+    parser.add_argument('--page-size', type = int, default = 1000, help = 'the largest page the fakes return')
+    parser.add_argument('--rate-limit-rate', type = float, default = 0.02, help = 'the share of calls answered with a rate-limit error')
+    parser.add_argument('--error-rate', type = float, default = 0.0, help = 'the share of calls answered with an error not worth retrying')
+    parser.add_argument('--sampling-limit', type = int, default = 0,
+        help = 'the most sessions a segmented Analytics report reads before it is sampled, 0 for never')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--requests-per-second', type = float, default = 50.0, help = 'the rate limit of the scripts')
+    parser.add_argument('--max-workers', type = int, default = 4, help = 'the threads of the scripts')
+    parser.add_argument('--ga-mode', choices = ['range', 'week'])
+    parser.add_argument('--fb-mode', choices = ['account', 'campaign', 'batch', 'async'])
+    parser.add_argument('--sources', nargs = '+', choices = sorted(SCRIPTS), default = sorted(SCRIPTS))
+    parser.add_argument('--workdir', help = 'the directory of the cache and warehouse files, kept between runs')
+    checkpoints.add_arguments(parser)
+    args = parser.parse_args()
+
+    options = {
+        'campaigns': args.campaigns,
+        'latency': args.latency,
+        'page_size': args.page_size,
+        'rate_limit_rate': args.rate_limit_rate,
+        'error_rate': args.error_rate,
+        'seed': args.seed
+        }
+    sheets = FakeSheetsClient(
+        latency = args.sheets_latency,
+        path = os.path.join(args.workdir, 'sheets.json') if args.workdir else None
+        )
+    results = {}
+    for source in args.sources:
+        script = importlib.import_module(SCRIPTS[source])
+        script.MAX_WORKERS = args.max_workers
+        script.LIMITER = rate_limiter.RateLimiter(
+            script.LIMITER.name, rate = args.requests_per_second, burst = max(1, int(args.requests_per_second)), base_delay = 0.1)
+        mode = args.ga_mode if source == 'google_analytics' else args.fb_mode
+        if mode:
+            script.EXTRACTION_MODE = mode
+        if source == 'facebook':
+            # The report runs are polled quickly against the fake
+            script.ASYNC_FIRST_POLL = 0.05
+        results[source] = run_offline(
+            source,
+            analytics = FakeAnalytics(sampling_limit = args.sampling_limit, **options) if source == 'google_analytics' else None,
+            facebook = FakeFacebook(**options) if source == 'facebook' else None,
+            sheets = sheets,
+            weeks = args.weeks,
+            workdir = args.workdir,
+            restart = args.restart,
+            load_only = args.load_only
+            )
+    if sheets.path:
+        sheets.save()
+    print(json.dumps(results, indent = 2))
+
+if __name__ == "__main__":
+    main()
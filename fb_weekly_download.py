@@ -26,15 +26,28 @@ Extracts campaign statistics.
 #Import libraries
 from facebookads import FacebookSession
 from facebookads import FacebookAdsApi
+from facebookads.adobjects.adaccount import AdAccount
 from facebookads.adobjects.adaccountuser import AdAccountUser
+from facebookads.adobjects.adreportrun import AdReportRun
 from facebookads.adobjects.campaign import Campaign
+import numpy as np
 import pandas as pd
+import argparse
 import datetime as dt
+import time
 from oauth2client.service_account import ServiceAccountCredentials
 import gspread
-from df2gspread import df2gspread as d2g
-from df2gspread import gspread2df as g2d
-from time import sleep
+import response_cache
+import warehouse
+import transform
+import schema
+import checkpoints
+import calendar_index
+import pipeline
+import sheets_loader
+import shards
+import rate_limiter
+import instrumentation
 
 # no need to do this.
 import json
@@ -53,6 +66,31 @@ KEY_FILE_LOCATION = '/your/path/to/file/client_secrets_key.json'
 INSIGHT_FIELDS = ['impressions', 'clicks', 'spend']
 SPREADSHEET = '<your_spreadsheet_url>'
 WORKSHEETS = ['facebook_totals', 'facebook_details']
+# 'account' asks one paged insights query per run, 'campaign' one query per campaign and week,
+# 'batch' packs the queries per campaign and week into Graph API batch requests,
+# 'async' runs the account query as asynchronous report runs, one per quarter.
+EXTRACTION_MODE = CONFIG.get('fb_extraction_mode', 'account')
+MAX_BATCH_REQUESTS = 50
+ASYNC_FIRST_POLL = 2
+ASYNC_MAX_POLL = 60
+ASYNC_TIMEOUT = CONFIG.get('fb_async_timeout', 3600)
+ASYNC_PAGE_SIZE = 500
+# The insights calls sent in batches, and the batch requests that carried them
+ROUND_TRIPS = {'calls': 0, 'requests': 0}
+END_DATE = dt.date(2016, 9, 5) #dt.date.today()
+# The first week to query when there is no data yet
+FIRST_START_DATE = dt.date(2016, 8, 29)
+MAX_WORKERS = CONFIG.get('fb_max_workers', 4)
+LIMITER = rate_limiter.RateLimiter(
+    'facebook',
+    rate = CONFIG.get('fb_requests_per_second', 2.0),
+    burst = CONFIG.get('fb_request_burst', 5)
+    )
+QUEUE_WEEKS = CONFIG.get('pipeline_queue_weeks', pipeline.QUEUE_WEEKS)
+LOAD_BATCH_WEEKS = CONFIG.get('load_batch_weeks', pipeline.LOAD_BATCH_WEEKS)
+READ_CHUNK_WEEKS = CONFIG.get('sheets_read_chunk_weeks', sheets_loader.READ_CHUNK_WEEKS)
+READ_WORKERS = CONFIG.get('sheets_read_workers', sheets_loader.READ_WORKERS)
+SHARDING = shards.from_config(CONFIG)
 
 def initialize_facebook():
     """Initializes a Facebook API session object.
@@ -75,53 +113,87 @@ def initialize_drive():
     )
     return gspread.authorize(credentials_drive)
 
-def get_week_days(year, week):
-    """Calculates dates from iso-years and iso-weeks.
+def limited_list(get_cursor):
+    """Reads a whole Graph API cursor through the rate limiter, page by page.
 
     Args:
-        year: An ISO-year.
-        week: An ISO-week number.
+        get_cursor: A function without arguments that sends the request.
     Returns:
-        The first date of that week, Monday, in dt.datetime.date().
+        A list of all the objects of all the pages.
     """
-    d = dt.date(year, 1, 1)
-    if(d.weekday() > 3):
-        d = d + dt.timedelta(7 - d.weekday())
-    else:
-        d = d - dt.timedelta(d.weekday())
-    dlt = dt.timedelta(days = (week - 1) * 7)
-    return d + dlt #,  d + dlt + dt.timedelta(days = 6)
+    return list(limited_pages(get_cursor))
+
+def limited_pages(get_cursor):
+    """Reads a Graph API cursor with each of its pages loaded through the rate limiter.
+
+    The request loads the first page and the cursor the next one when
+    iterated past the last; a page that fails leaves the cursor where it
+    was, so a rate-limited page is loaded again on its own.
 
-def download_df(worksheet_name):
-    """Downloading an existing worksheet from Google Drive.
+    Args:
+        get_cursor: A function without arguments that sends the request.
+    Yields:
+        The objects of all the pages.
+    """
+    def observe_usage(result):
+        if hasattr(cursor, 'headers'):
+            LIMITER.observe_usage(*rate_limiter.facebook_usage(cursor.headers()))
+        return result
+
+    cursor = LIMITER.call(get_cursor, rate_limiter.fb_rate_limited)
+    observe_usage(cursor)
+    load_next_page = cursor.load_next_page
+    cursor.load_next_page = lambda: observe_usage(LIMITER.call(load_next_page, rate_limiter.fb_rate_limited))
+    for item in cursor:
+        instrumentation.add_bytes(LIMITER.name, instrumentation.response_size(dict(item)))
+        yield item
+
+def cache_request(ad_account, starting_date, ad_fields):
+    """Describes a week of campaign stats for the response cache.
 
     Args:
-        worksheet_name: The correct worksheet name on the spreadsheet.
+        ad_account: the ad account to take data.
+        starting_date: the starting date of the week.
+        ad_fields: the metrics of the campaign to take data.
     Returns:
-        The existing worksheet data, or None;
-        and the first date of the next week's query.
+        A dictionary identifying the week's campaign stats.
     """
-    try:
-        existing = g2d.download(gfile = SPREADSHEET, wks_name = worksheet_name, col_names = True, row_names = True)
-        start_date = get_week_days(
-            int(existing.columns[-1].split('-')[0]), 
-            int(existing.columns[-1].split('-')[1])
-            ) + dt.timedelta(days = 7)
-        return existing, start_date
-    except RuntimeError:
-        existing = None
-        start_date = dt.date(2016, 8, 29)
-        return existing, start_date
-
-def campaign_stats(ad_account, starting_date, ad_fields):
+    return {
+        'account': ad_account.get_id(),
+        'fields': ad_fields,
+        'level': 'campaign',
+        'time_range': {
+            'since': str(starting_date),
+            'until': str(starting_date + dt.timedelta(days = 6))
+            }
+        }
+
+def campaign_stats(ad_account, starting_date, ad_fields, cache):
     """Extracting Facebook data.
 
+    Args:
+        ad_account: the ad account to take data.
+        starting_date: the starting date of the campaign to take data.
+        ad_fields: the metrics of the campaign to take data.
+        cache: The response_cache.ResponseCache of the responses.
+    Returns:
+        A dictionary of Facebook campaign stats by campaign ID.
+    """
+    return cache.read_through(
+        cache_request(ad_account, starting_date, ad_fields),
+        starting_date + dt.timedelta(days = 6),
+        lambda: fetch_campaign_stats(ad_account, starting_date, ad_fields)
+        )
+
+def fetch_campaign_stats(ad_account, starting_date, ad_fields):
+    """Extracting Facebook data one campaign at a time, bypassing the cache.
+
     Args:
         ad_account: the ad account to take data.
         starting_date: the starting date of the campaign to take data.
         ad_fields: the metrics of the campaign to take data.
     Returns:
-        A dictionary of Facebook campaign stats.
+        A dictionary of Facebook campaign stats by campaign ID.
     """
     insight_params = {
         'time_range': {
@@ -129,18 +201,383 @@ def campaign_stats(ad_account, starting_date, ad_fields):
             'until': str(starting_date + dt.timedelta(days = 6))
             }
         }
+    campaigns = limited_list(lambda: ad_account.get_campaigns(fields = [Campaign.Field.name]))
+    # Ask for the campaigns in parallel, as fast as the rate limiter allows.
+    campaign_insights = rate_limiter.fetch_concurrently(
+        lambda campaign: limited_list(lambda: campaign.get_insights(fields = ad_fields, params = insight_params)),
+        campaigns,
+        MAX_WORKERS
+        )
     stats_data_dict = {}
-    for campaign in ad_account.get_campaigns(fields = [Campaign.Field.name]):
-        # Slow down your requests, if you have many ad campaigns.
-        sleep(5)
-        for stat in campaign.get_insights(fields = ad_fields, params = insight_params):
+    for campaign, insights in zip(campaigns, campaign_insights):
+        for stat in insights:
             for statfield in stat:
-                if campaign[campaign.Field.name] not in stats_data_dict.keys():
-                    stats_data_dict[campaign[campaign.Field.name]] = {statfield: stat[statfield]}
+                if campaign.get_id() not in stats_data_dict.keys():
+                    stats_data_dict[campaign.get_id()] = {statfield: stat[statfield]}
                 else:
-                    stats_data_dict[campaign[campaign.Field.name]][statfield] = stat[statfield]
+                    stats_data_dict[campaign.get_id()][statfield] = stat[statfield]
+            stats_data_dict[campaign.get_id()]['campaign_id'] = campaign.get_id()
+            stats_data_dict[campaign.get_id()]['campaign_name'] = campaign[campaign.Field.name]
     return stats_data_dict
 
+def account_stats(ad_account, starting_date, ending_date, ad_fields):
+    """Extracting Facebook data of a whole ad account and date range at once.
+
+    Asks for campaign-level insights in weekly time increments, so the number
+    of API calls grows with the result pages, not with campaigns times weeks.
+
+    Args:
+        ad_account: the ad account to take data.
+        starting_date: the first Monday of the date range.
+        ending_date: the last Sunday of the date range.
+        ad_fields: the metrics of the campaign to take data.
+    Returns:
+        A dictionary of week starting dates to dictionaries of Facebook
+        campaign stats, the same as campaign_stats returns for one week.
+    """
+    insight_params = {
+        'level': 'campaign',
+        'time_increment': 7,
+        'time_range': {
+            'since': str(starting_date),
+            'until': str(ending_date)
+            }
+        }
+    # The cursor follows the paging of the result by itself.
+    return weekly_account_stats(
+        limited_list(lambda: ad_account.get_insights(fields = ad_fields + ['campaign_name', 'campaign_id'], params = insight_params)),
+        starting_date,
+        ending_date
+        )
+
+def weekly_account_stats(stats, starting_date, ending_date):
+    """Sorts campaign-level insights rows in weekly increments by week.
+
+    Args:
+        stats: A list of insights rows with 'campaign_name', 'campaign_id'
+            and 'date_start'.
+        starting_date: the first Monday of the date range.
+        ending_date: the last Sunday of the date range.
+    Returns:
+        A dictionary of week starting dates to dictionaries of Facebook
+        campaign stats by campaign ID.
+    """
+    return dict(iter_weekly_stats(sorted(stats, key = lambda stat: stat['date_start']), starting_date, ending_date))
+
+def iter_weekly_stats(stats, starting_date, ending_date):
+    """Groups campaign-level insights rows sorted by week into weeks, one week at a time.
+
+    A week is handed out as soon as the rows of the next week start, so only
+    one week of rows is held at a time.
+
+    Args:
+        stats: An iterable of insights rows with 'campaign_name',
+            'campaign_id' and 'date_start', sorted by 'date_start' and
+            consumed one row at a time.
+        starting_date: the first Monday of the date range.
+        ending_date: the last Sunday of the date range.
+    Yields:
+        (week starting date, dictionary of Facebook campaign stats by
+        campaign ID) tuples for every week of the range, in calendar order.
+    """
+    start_date = starting_date
+    stats_data_dict = {}
+    for stat in stats:
+        week_start = dt.datetime.strptime(stat['date_start'], '%Y-%m-%d').date()
+        if week_start < start_date:
+            raise RuntimeError('Insights rows of the week of {} came after the week of {}'.format(week_start, start_date))
+        while start_date < week_start:
+            yield start_date, stats_data_dict
+            stats_data_dict = {}
+            start_date += dt.timedelta(days = 7)
+        for statfield in stat:
+            if stat['campaign_id'] not in stats_data_dict.keys():
+                stats_data_dict[stat['campaign_id']] = {statfield: stat[statfield]}
+            else:
+                stats_data_dict[stat['campaign_id']][statfield] = stat[statfield]
+    while start_date <= ending_date:
+        yield start_date, stats_data_dict
+        stats_data_dict = {}
+        start_date += dt.timedelta(days = 7)
+
+def quarter_ranges(week_starts):
+    """Groups weeks by the calendar quarter of their Monday.
+
+    A gap in the weeks starts a new range too, so no week is queried twice.
+
+    Args:
+        week_starts: A sorted list of week starting dates.
+    Returns:
+        A list of (first Monday, last Sunday) tuples, one per quarter and
+        contiguous range.
+    """
+    ranges = []
+    quarter = None
+    for start_date in week_starts:
+        if (start_date.year, (start_date.month - 1) // 3) != quarter or start_date - ranges[-1][1] != dt.timedelta(days = 7):
+            quarter = (start_date.year, (start_date.month - 1) // 3)
+            ranges.append([start_date, start_date])
+        ranges[-1][1] = start_date
+    return [(first, last + dt.timedelta(days = 6)) for first, last in ranges]
+
+def wait_for_report(report_run):
+    """Polls an insights report run with backoff until it completes.
+
+    Args:
+        report_run: The AdReportRun of an asynchronous insights query.
+    Returns:
+        The completed AdReportRun.
+    """
+    started = time.time()
+    attempt = 0
+    while True:
+        LIMITER.call(
+            lambda: report_run.api_get(fields = [AdReportRun.Field.async_status, AdReportRun.Field.async_percent_completion]),
+            rate_limiter.fb_rate_limited
+            )
+        status = report_run[AdReportRun.Field.async_status]
+        if status == 'Job Completed':
+            return report_run
+        if status in ['Job Failed', 'Job Skipped']:
+            raise RuntimeError('Insights report run {} ended with {}'.format(report_run.get_id(), status))
+        if time.time() - started > ASYNC_TIMEOUT:
+            raise RuntimeError('Insights report run {} still {} after {} s'.format(report_run.get_id(), status, ASYNC_TIMEOUT))
+        time.sleep(min(ASYNC_MAX_POLL, ASYNC_FIRST_POLL * 2 ** attempt))
+        attempt += 1
+
+def submit_report_run(ad_account, starting_date, ending_date, ad_fields):
+    """Runs the query of account_stats as an asynchronous insights report run.
+
+    The rows are asked for sorted by week, so async_stats can hand out the
+    weeks one by one.
+
+    Args:
+        ad_account: the ad account to take data.
+        starting_date: the first Monday of the date range.
+        ending_date: the last Sunday of the date range.
+        ad_fields: the metrics of the campaign to take data.
+    Returns:
+        The completed AdReportRun.
+    """
+    insight_params = {
+        'level': 'campaign',
+        'time_increment': 7,
+        'time_range': {
+            'since': str(starting_date),
+            'until': str(ending_date)
+            },
+        'sort': ['date_start_ascending']
+        }
+    report_run = LIMITER.call(
+        lambda: ad_account.get_insights_async(fields = ad_fields + ['campaign_name', 'campaign_id'], params = insight_params),
+        rate_limiter.fb_rate_limited
+        )
+    return wait_for_report(report_run)
+
+def async_stats(report_run, starting_date, ending_date):
+    """Extracting Facebook data of a whole ad account and date range from a report run.
+
+    Reads the result pages of the report run as they arrive and hands out
+    every week as soon as its rows are read, instead of holding the whole
+    result.
+
+    Args:
+        report_run: The completed AdReportRun of submit_report_run.
+        starting_date: the first Monday of the date range.
+        ending_date: the last Sunday of the date range.
+    Yields:
+        (week starting date, dictionary of Facebook campaign stats) tuples,
+        the same as campaign_stats returns for one week, in calendar order.
+    """
+    return iter_weekly_stats(
+        limited_pages(lambda: report_run.get_insights(params = {'limit': ASYNC_PAGE_SIZE})),
+        starting_date,
+        ending_date
+        )
+
+def batch_insights(api, calls, ad_fields):
+    """Sends campaign insights calls in one Graph API batch request.
+
+    Args:
+        api: The FacebookAdsApi to send the batch with.
+        calls: A list of up to MAX_BATCH_REQUESTS (campaign id, week
+            starting date) tuples.
+        ad_fields: the metrics of the campaign to take data.
+    Returns:
+        A dictionary of the answered calls to their lists of insights, and
+        a dictionary of the failed calls to their FacebookRequestError.
+    """
+    insights = {}
+    errors = {}
+
+    def on_success(call):
+        def success(response):
+            body = response.json()
+            instrumentation.add_bytes(LIMITER.name, instrumentation.response_size(body))
+            insights[call] = body.get('data', [])
+            headers = response.headers()
+            if isinstance(headers, list):
+                headers = {header['name']: header['value'] for header in headers}
+            LIMITER.observe_usage(*rate_limiter.facebook_usage(headers))
+        return success
+
+    def on_failure(call):
+        def failure(response):
+            errors[call] = response.error()
+        return failure
+
+    def execute():
+        batch = api.new_batch()
+        for call in calls:
+            campaign_id, starting_date = call
+            batch.add(
+                'GET',
+                '{}/insights'.format(campaign_id),
+                params = {
+                    'fields': ','.join(ad_fields),
+                    'time_range': {
+                        'since': str(starting_date),
+                        'until': str(starting_date + dt.timedelta(days = 6))
+                        }
+                    },
+                success = on_success(call),
+                failure = on_failure(call)
+                )
+        # Calls the batch could not run at all are retried with the failed ones.
+        batch.execute()
+
+    LIMITER.call(execute, rate_limiter.fb_rate_limited)
+    return insights, errors
+
+def batch_stats(ad_account, week_starts, ad_fields):
+    """Extracting Facebook data per campaign and week in batch requests.
+
+    Every batch request carries up to MAX_BATCH_REQUESTS insights calls, of
+    one or several weeks. Only the failed calls are sent again.
+
+    Args:
+        ad_account: the ad account to take data.
+        week_starts: The Mondays of the weeks to take data.
+        ad_fields: the metrics of the campaign to take data.
+    Returns:
+        A dictionary of week starting dates to dictionaries of Facebook
+        campaign stats, the same as campaign_stats returns for one week.
+    """
+    api = FacebookAdsApi.get_default_api()
+    campaigns = limited_list(lambda: ad_account.get_campaigns(fields = [Campaign.Field.name]))
+    names = {campaign.get_id(): campaign[Campaign.Field.name] for campaign in campaigns}
+    pending = [(campaign_id, start_date) for start_date in week_starts for campaign_id in names]
+    insights = {}
+    attempt = 0
+    while pending:
+        chunks = [pending[i:i + MAX_BATCH_REQUESTS] for i in range(0, len(pending), MAX_BATCH_REQUESTS)]
+        results = rate_limiter.fetch_concurrently(
+            lambda chunk: batch_insights(api, chunk, ad_fields),
+            chunks,
+            MAX_WORKERS
+            )
+        ROUND_TRIPS['calls'] += len(pending)
+        ROUND_TRIPS['requests'] += len(chunks)
+        errors = {}
+        for chunk_insights, chunk_errors in results:
+            insights.update(chunk_insights)
+            errors.update(chunk_errors)
+        for error in errors.values():
+            if not rate_limiter.fb_rate_limited(error) or attempt >= LIMITER.max_retries:
+                raise error
+        pending = [call for call in pending if call not in insights]
+        if pending:
+            if attempt >= LIMITER.max_retries:
+                raise RuntimeError('{} insights calls got no answer'.format(len(pending)))
+            with LIMITER.lock:
+                LIMITER.retries += len(pending)
+            LIMITER.slow_down()
+            time.sleep(LIMITER.backoff_delay(attempt))
+            attempt += 1
+    # Put the answers back in campaign order, whatever batch they came in
+    weekly_stats = {}
+    for start_date in week_starts:
+        stats_data_dict = weekly_stats[start_date] = {}
+        for campaign_id, name in names.items():
+            for stat in insights[(campaign_id, start_date)]:
+                for statfield in stat:
+                    if campaign_id not in stats_data_dict.keys():
+                        stats_data_dict[campaign_id] = {statfield: stat[statfield]}
+                    else:
+                        stats_data_dict[campaign_id][statfield] = stat[statfield]
+                stats_data_dict[campaign_id]['campaign_id'] = campaign_id
+                stats_data_dict[campaign_id]['campaign_name'] = name
+    return weekly_stats
+
+def extract_weeks(ad_account, week_starts, ad_fields, on_week, cache):
+    """Extracting Facebook data of all the weeks still to query.
+
+    Args:
+        ad_account: the ad account to take data.
+        week_starts: The week starting dates still to query, in calendar order.
+        ad_fields: the metrics of the campaign to take data.
+        on_week: A function of a week starting date and a dictionary of its
+            Facebook campaign stats, called for every week in calendar order
+            as soon as it is extracted.
+        cache: The response_cache.ResponseCache of the responses.
+    Returns:
+        The number of weeks extracted.
+    """
+    ordered_weeks = checkpoints.OrderedWeeks(week_starts, on_week)
+    if EXTRACTION_MODE == 'campaign':
+        for start_date, stats_data_dict in zip(week_starts, rate_limiter.iter_concurrently(
+            lambda start_date: campaign_stats(ad_account, start_date, ad_fields, cache),
+            week_starts,
+            MAX_WORKERS,
+            QUEUE_WEEKS
+            )):
+            ordered_weeks.add(start_date, stats_data_dict)
+        return len(week_starts)
+
+    def keep_week(start_date, stats_data_dict):
+        cache.put(cache_request(ad_account, start_date, ad_fields), start_date + dt.timedelta(days = 6), stats_data_dict)
+        ordered_weeks.add(start_date, stats_data_dict)
+
+    def keep_weeks(extracted_data):
+        for start_date, stats_data_dict in sorted(extracted_data.items()):
+            keep_week(start_date, stats_data_dict)
+
+    # Take the weeks already in the cache
+    missing = []
+    for start_date in week_starts:
+        stats_data_dict = cache.get(cache_request(ad_account, start_date, ad_fields))
+        if stats_data_dict is None:
+            missing.append(start_date)
+        else:
+            ordered_weeks.add(start_date, stats_data_dict)
+    if missing and EXTRACTION_MODE == 'batch':
+        # Extract the other weeks in batches of campaign insights calls
+        keep_weeks(batch_stats(ad_account, missing, ad_fields))
+    elif missing and EXTRACTION_MODE == 'async':
+        # Extract the other weeks in one report run per quarter, run side by
+        # side, and keep the weeks of every quarter as its result pages are
+        # read, once it and the ones before it are done
+        date_ranges = quarter_ranges(missing)
+        for date_range, report_run in zip(date_ranges, rate_limiter.iter_concurrently(
+            lambda date_range: submit_report_run(ad_account, date_range[0], date_range[1], ad_fields),
+            date_ranges,
+            MAX_WORKERS,
+            QUEUE_WEEKS
+            )):
+            for start_date, stats_data_dict in async_stats(report_run, date_range[0], date_range[1]):
+                keep_week(start_date, stats_data_dict)
+    elif missing:
+        # Extract every contiguous range of the other weeks from Facebook at
+        # once, side by side
+        for range_data in rate_limiter.iter_concurrently(
+            lambda date_range: account_stats(ad_account, date_range[0], date_range[1] + dt.timedelta(days = 6), ad_fields),
+            calendar_index.coalesce(missing),
+            MAX_WORKERS,
+            QUEUE_WEEKS
+            ):
+            keep_weeks(range_data)
+    return len(week_starts)
+
 def clean_extracted_data_totals(dict_data, starting_date):
     """Cleans extracted Facebook campaign stats.
 
@@ -148,15 +585,16 @@ def clean_extracted_data_totals(dict_data, starting_date):
         dict_data: the ad account data in dictionary format.
         starting_date: the starting date of the campaign to take data.
     Returns:
-        A totaled pandas DataFrame of the extracted Facebook campaign stats.
+        A one-row typed pandas DataFrame of the totaled Facebook campaign stats.
     """
-    stats_dataframe = pd.DataFrame.from_dict(dict_data)
     iso_year, iso_week = starting_date.isocalendar()[:2]
-    stats_dataframe.drop(stats_dataframe.index[stats_dataframe.index == 'date_start'], inplace = True)
-    stats_dataframe.drop(stats_dataframe.index[stats_dataframe.index == 'date_stop'], inplace = True)
-    stats_dataframe = stats_dataframe.astype(float)
-    stats_dataframe = stats_dataframe.sum(axis = 1)
-    return stats_dataframe.to_frame('{}-{}'.format(iso_year, iso_week))
+    _, metrics, values = transform.fb_details_arrays(dict_data)
+    metric_numbers, metric_names = pd.factorize(metrics)
+    totals = np.bincount(metric_numbers, weights = values, minlength = len(metric_names))
+    # Sums of cents in binary floats are off in the last digits
+    money = np.isin(np.asarray(metric_names, dtype = object), schema.MONEY_METRICS)
+    totals[money] = np.round(totals[money], 2)
+    return transform.totals_frame(list(metric_names), totals, '{}-{}'.format(iso_year, iso_week))
 
 def clean_extracted_data_details(dict_data, starting_date):
     """Cleans extracted Facebook campaign stats.
@@ -165,182 +603,109 @@ def clean_extracted_data_details(dict_data, starting_date):
         dict_data: the ad account data in dictionary format.
         starting_date: the starting date of the campaign to take data. 
     Returns:
-        A detailed pandas DataFrame of the extracted Facebook campaign stats.
+        A typed pandas DataFrame of the extracted Facebook campaign stats.
     """
-    stats_dataframe = pd.DataFrame.from_dict(dict_data)
     iso_year, iso_week = starting_date.isocalendar()[:2]
-    stats_dataframe.drop(stats_dataframe.index[stats_dataframe.index == 'date_start'], inplace = True)
-    stats_dataframe.drop(stats_dataframe.index[stats_dataframe.index == 'date_stop'], inplace = True)
-    titles = pd.DataFrame(stats_dataframe.columns).T.rename(columns = pd.DataFrame(stats_dataframe.columns).T.loc[0])
-    titles.index = ['campaign']
-    stats_dataframe = titles.append(stats_dataframe)
-    one_column = stats_dataframe.iloc[:, 0]
-    for number in range(1, len(stats_dataframe.columns)):
-        one_column = one_column.append(stats_dataframe.iloc[:, number])
-    new_index = []
-    for i, _ in enumerate(titles):
-        for _, j in enumerate(stats_dataframe.index):
-            new_index.append('{}_{}'.format(j, i))
-    one_column.index = new_index
-    return one_column.to_frame('{}-{}'.format(iso_year, iso_week)), stats_dataframe.index
-
-def sort_data(data, metrics):
-    """Sort data similar to the totals.
+    campaigns, metrics, values = transform.fb_details_arrays(dict_data)
+    # Keyed by campaign ID, a renamed campaign keeps its rows and campaigns
+    # of the same name stay apart
+    return transform.details_frame(
+        campaigns, metrics, values, '{}-{}'.format(iso_year, iso_week),
+        campaign_names = transform.fb_campaign_names(dict_data)
+        )
 
-    Args:
-        data: A pandas DataFrame.
-        metrics: The metrics of a campaign.
-    Returns:
-        A sorted pandas DataFrame with an index list similar to totals.
-    """
-    number_of_campaigns = int(len(data.index)/len(metrics))
-    index = []
-    for add_number, _ in enumerate(metrics):
-        index += [int(data.index[row].split('_')[1] + str(add_number)) for row in range(number_of_campaigns)]
-    data.index = index
-    data.sort_index(inplace = True)
-    new_index = []
-    for i in range(number_of_campaigns):
-        for _, j in enumerate(sorted(metrics)):
-            new_index.append('{}_{}'.format(j, i))
-    data.index = new_index
-    return data
-
-def loop_adding_weeks_totals(ad_account, previous_data, starting_date, ad_fields):
-    """Merges all the previous and newly extracted data.
+class FacebookSource(pipeline.SourceAdapter):
+    """The Facebook steps of the weekly download."""
 
-    Args:
-        ad_account: the ad account to take data.
-        previous_data: A dataframe from Google Drive, or None.
-        starting_date: The date with which the data queries start.
-        ad_fields: the metrics of the campaign to take data. 
-    Returns:
-        A cleanded and merged pandas DataFrame of campaign totals.
-    """
-    start_date = starting_date
-    if isinstance(previous_data, pd.DataFrame):
-        while start_date + dt.timedelta(days = 6) < dt.date(2016, 9, 5): #dt.date.today()
-            # Extract data from Facebook
-            extracted_data = campaign_stats(ad_account, start_date, ad_fields)
-            # Transform the extracted data
-            transformed_data = clean_extracted_data_totals(extracted_data, start_date)
-            # Add another week
-            start_date += dt.timedelta(days = 7)
-            # Merge existing datat with new column
-            previous_data = pd.merge(
-                previous_data, 
-                transformed_data,
-                left_index = True,
-                right_index = True
-                )
-        return previous_data
-    else:
-        # Extract data from Facebook
-        extracted_data = campaign_stats(ad_account, start_date, ad_fields)
-        # Transform the extracted data
-        previous_data = clean_extracted_data_totals(extracted_data, start_date)
-        # Add another week
-        start_date += dt.timedelta(days = 7)
-        while start_date + dt.timedelta(days = 6) < dt.date(2016, 9, 5): #dt.date.today()
-            # Extract data from Facebook
-            extracted_data = campaign_stats(ad_account, start_date, ad_fields)
-            # Transform the extracted data
-            transformed_data = clean_extracted_data_totals(extracted_data, start_date)
-            # Add another week
-            start_date += dt.timedelta(days = 7)
-            # Merge existing datat with new column
-            previous_data = pd.merge(
-                previous_data, 
-                transformed_data,
-                left_index = True,
-                right_index = True
-                )
-        return previous_data 
+    def __init__(self, ad_account, cache, ad_fields = INSIGHT_FIELDS):
+        """Sets up the source.
+
+        Args:
+            ad_account: the ad account to take data.
+            cache: The response_cache.ResponseCache of the responses.
+            ad_fields: the metrics of the campaign to take data.
+        """
+        pipeline.SourceAdapter.__init__(self, FIRST_START_DATE, END_DATE)
+        self.ad_account = ad_account
+        self.cache = cache
+        self.ad_fields = ad_fields
+        self.round_trips = dict(ROUND_TRIPS)
+
+    def extract_weeks(self, totals_weeks, details_weeks, on_week):
+        return extract_weeks(self.ad_account, sorted(set(totals_weeks) | set(details_weeks)), self.ad_fields, on_week, self.cache)
+
+    def clean_weekly_totals(self, extracted_data, starting_date):
+        return clean_extracted_data_totals(extracted_data, starting_date)
 
-def loop_adding_weeks_details(ad_account, previous_data, starting_date, ad_fields):
-    """Merges all the previous and newly extracted data.
+    def clean_weekly_details(self, extracted_data, starting_date):
+        return clean_extracted_data_details(extracted_data, starting_date)
+
+    def summary(self):
+        """Returns the round trips saved by batch requests since the source was set up."""
+        calls = ROUND_TRIPS['calls'] - self.round_trips['calls']
+        requests = ROUND_TRIPS['requests'] - self.round_trips['requests']
+        return {'round_trips_saved': calls - requests}
+
+def run(ad_account, gc, spreadsheet, worksheets, store, restart = False, load_only = False, cache = None):
+    """Brings the worksheets of one ad account up to date.
+
+    Every week is checkpointed in the warehouse as soon as it is extracted,
+    so a run that stops halfway resumes after the last week it stored.
 
     Args:
         ad_account: the ad account to take data.
-        previous_data: A dataframe from Google Drive, or None.
-        starting_date: The date with which the data queries start.
-        ad_fields: the metrics of the campaign to take data. 
+        gc: An authorized gspread client.
+        spreadsheet: The spreadsheet URL.
+        worksheets: The names of the totals and the details worksheets.
+        store: The warehouse.Warehouse of the ad account.
+        restart: Whether to drop the weeks stored since the last upload and
+            extract them again.
+        load_only: Whether to upload the stored weeks without extracting.
+        cache: The response_cache.ResponseCache of the responses, or None
+            to open the one of config.json.
     Returns:
-        A cleanded and merged pandas DataFrame of campaign details.
+        A dictionary of the number of new weeks, of the weeks resumed from
+        an earlier run, the round trips saved by batch requests and the
+        cells written per worksheet.
     """
-    start_date = starting_date
-    if isinstance(previous_data, pd.DataFrame):
-        while start_date + dt.timedelta(days = 6) < dt.date(2016, 9, 5): #dt.date.today()
-            # Extract data from Facebook
-            extracted_data = campaign_stats(ad_account, start_date, ad_fields)
-            # Transform the extracted data
-            transformed_data, index = clean_extracted_data_details(extracted_data, start_date)
-            # Add another week
-            start_date += dt.timedelta(days = 7)
-            # Merge existing datat with new column
-            previous_data = pd.merge(
-                previous_data, 
-                transformed_data,
-                how = 'outer',
-                left_index = True,
-                right_index = True
-                )
-        return sort_data(previous_data, index)
-    else:
-        # Extract data from Facebook
-        extracted_data = campaign_stats(ad_account, start_date, ad_fields)
-        # Transform the extracted data
-        previous_data, index = clean_extracted_data_details(extracted_data, start_date)
-        # Add another week
-        start_date += dt.timedelta(days = 7)
-        while start_date + dt.timedelta(days = 6) < dt.date(2016, 9, 5): #dt.date.today()
-            # Extract data from Facebook
-            extracted_data = campaign_stats(ad_account, start_date, ad_fields)
-            # Transform the extracted data
-            transformed_data, index = clean_extracted_data_details(extracted_data, start_date)
-            # Add another week
-            start_date += dt.timedelta(days = 7)
-            # Merge existing datat with new column
-            previous_data = pd.merge(
-                previous_data, 
-                transformed_data,
-                how = 'outer',
-                left_index = True,
-                right_index = True
-                )
-        return sort_data(previous_data, index) 
-
+    if cache is None:
+        cache = response_cache.from_config(CONFIG)
+    return pipeline.run(
+        FacebookSource(ad_account, cache),
+        gc,
+        spreadsheet,
+        worksheets,
+        store,
+        restart = restart,
+        load_only = load_only,
+        queue_weeks = QUEUE_WEEKS,
+        load_batch_weeks = LOAD_BATCH_WEEKS,
+        read_chunk_weeks = READ_CHUNK_WEEKS,
+        read_workers = READ_WORKERS,
+        sharding = SHARDING
+        )
 
 def main():
-    # Initialize API access
-    FacebookAdsApi.set_default_api(initialize_facebook())
+    parser = argparse.ArgumentParser(description = 'Download the weekly Facebook campaign stats to Google Sheets.')
+    checkpoints.add_arguments(parser)
+    args = parser.parse_args()
+    report = instrumentation.start('fb_weekly_download', '', [LIMITER])
+
+    with instrumentation.stage('auth'):
+        # Initialize API access
+        FacebookAdsApi.set_default_api(initialize_facebook())
 
-    # Authorize credentials with Google Drive
-    gc = initialize_drive()
+        # Authorize credentials with Google Drive
+        gc = initialize_drive()
 
     # Get account connected to the user
     # [3] may not be your account, find the right account, try [0] first
     my_account = AdAccountUser(fbid = 'me').get_ad_accounts()[3]
+    report.account = my_account.get_id()
 
-    # Download existing or make dataframe and the last week
-    existing_totals, start_date_totals = download_df(WORKSHEETS[0])
-    existing_details, start_date_details = download_df(WORKSHEETS[1])
-
-    # Getting the sweet data
-    all_data_totals = loop_adding_weeks_totals(my_account, existing_totals, start_date_totals, INSIGHT_FIELDS)
-    all_data_details = loop_adding_weeks_details(my_account, existing_details, start_date_details, INSIGHT_FIELDS)
-
-    # Upload the transformed data to Google Sheets
-    d2g.upload(
-        df = all_data_totals, 
-        gfile = SPREADSHEET, 
-        wks_name = WORKSHEETS[0]
-        )
-    d2g.upload(
-        df = all_data_details, 
-        gfile = SPREADSHEET, 
-        wks_name = WORKSHEETS[1]
-        )
+    store = warehouse.from_config(CONFIG)
+    run(my_account, gc, SPREADSHEET, WORKSHEETS, store, restart = args.restart, load_only = args.load_only)
+    instrumentation.write_reports([report.to_dict()], CONFIG)
 
 if __name__ == "__main__":
     main()
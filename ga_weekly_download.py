@@ -1,11 +1,25 @@
 #Import libraries
 from apiclient.discovery import build
 from oauth2client.service_account import ServiceAccountCredentials
+import argparse
+import contextlib
 import datetime as dt
-import pandas as pd
+import decimal
+import functools
+import itertools
+import queue
+import threading
 import gspread
-from df2gspread import df2gspread as d2g
-from df2gspread import gspread2df as g2d
+import response_cache
+import warehouse
+import transform
+import checkpoints
+import calendar_index
+import pipeline
+import sheets_loader
+import shards
+import rate_limiter
+import instrumentation
 
 # no need to do this.
 import json
@@ -22,6 +36,106 @@ KEY_FILE_LOCATION = '/your/path/to/file/service_key.json'
 VIEW_ID = CONFIG['view_id']
 SPREADSHEET = '<your_spreadsheet_url'
 WORKSHEETS = ['ga_totals', 'ga_details']
+# 'range' asks one paged report of all missing weeks, 'week' one report per week.
+EXTRACTION_MODE = CONFIG.get('ga_extraction_mode', 'range')
+# The first week to query when there is no data yet
+FIRST_START_DATE = dt.date(2017, 7, 3)
+MAX_BATCH_REQUESTS = 5
+MAX_SEGMENTS = 4
+MAX_METRICS = 10
+# The totals of a range split into weeks or days, and of every segment, are
+# summed up from the rows, so only metrics that add up over campaigns, days
+# and weeks can be configured; ratios, averages and users do not.
+NON_ADDITIVE_METRICS = ['ga:users', 'ga:1dayUsers', 'ga:7dayUsers', 'ga:30dayUsers', 'ga:bounceRate', 'ga:CTR', 'ga:CPC', 'ga:CPM', 'ga:RPC', 'ga:ROAS']
+PAGE_SIZE = 10000
+# LARGE reads the most sessions before the API samples a report
+SAMPLING_LEVEL = CONFIG.get('ga_sampling_level', 'LARGE')
+# The reports of the totals; the one marked 'details' also feeds the details.
+# The totals rows of a segment with a 'label' are named like 'ga:sessions (organic)'.
+REPORTS = CONFIG.get('ga_reports', [
+    {
+        'name': 'no_seg',
+        'details': True,
+        'metrics': [
+            {
+                'expression': 'ga:impressions'
+            },
+            {
+                'expression': 'ga:adClicks'
+            },
+            {
+                'expression': 'ga:adCost',
+                'formattingType': 'FLOAT'
+            }],
+        'dimensions': [
+            {
+                'name': 'ga:campaign'
+            }]
+    },
+    {
+        'name': 'seg',
+        'metrics': [
+            {
+                'expression': 'ga:sessions'
+            },
+            {
+                'expression': 'ga:goal6Completions'
+            },
+            {
+                'expression': 'ga:transactions'
+            },
+            {
+                'expression': 'ga:transactionRevenue',
+                'formattingType': 'FLOAT'
+            }],
+        'dimensions': [
+            {
+                'name': 'ga:campaign'
+            }],
+        'segments': [
+            {
+                'dynamicSegment': {
+                    'name': 'Paid Sessions',
+                    'sessionSegment': {
+                        'segmentFilters': [
+                            {
+                                'not': 'False',
+                                'simpleSegment': {
+                                    'orFiltersForSegment': [
+                                        {
+                                            'segmentFilterClauses': [
+                                                {
+                                                    'dimensionFilter': {
+                                                        'dimensionName': 'ga:medium',
+                                                        'operator': 'REGEXP',
+                                                        'expressions': ['^(cpc|ppc|cpa|cpm|cpv|cpp)$']
+                                                        }
+                                                }]
+                                        }]
+                                    }
+                            }]
+                        }
+                    }
+            }]
+    }])
+# The reports split into shorter date ranges because they were sampled,
+# and the reports still sampled at one day
+SAMPLING = {'split': 0, 'sampled': 0}
+SAMPLING_LOCK = threading.Lock()
+MAX_WORKERS = CONFIG.get('ga_max_workers', 4)
+LIMITER = rate_limiter.RateLimiter(
+    'google_analytics',
+    rate = CONFIG.get('ga_requests_per_second', 1.0),
+    burst = CONFIG.get('ga_request_burst', 10)
+    )
+# The idle API connections built for the worker threads, per connection of the run
+CONNECTION_POOLS = {}
+CONNECTION_POOLS_LOCK = threading.Lock()
+QUEUE_WEEKS = CONFIG.get('pipeline_queue_weeks', pipeline.QUEUE_WEEKS)
+LOAD_BATCH_WEEKS = CONFIG.get('load_batch_weeks', pipeline.LOAD_BATCH_WEEKS)
+READ_CHUNK_WEEKS = CONFIG.get('sheets_read_chunk_weeks', sheets_loader.READ_CHUNK_WEEKS)
+READ_WORKERS = CONFIG.get('sheets_read_workers', sheets_loader.READ_WORKERS)
+SHARDING = shards.from_config(CONFIG)
 
 def initialize_drive():
     """Initializes a Drive API service object.
@@ -52,170 +166,525 @@ def initialize_analyticsreporting():
         cache_discovery = False)
     return analytics
 
-def get_week_days(year, week):
-    """Calculates dates from iso-years and iso-weeks.
+@contextlib.contextmanager
+def pooled_connection(analytics):
+    """Lends an API connection to the current thread.
+
+    The discovery client is not thread-safe, so a connection serves one
+    thread at a time and the main thread keeps the given one. The worker
+    threads of every round of requests are new, so their connections are
+    returned to a pool when done and lent again, and only as many are built
+    as requests ever run side by side.
+
+    Args:
+        analytics: The API connection of the main thread.
+    Yields:
+        An authorized Analytics Reporting API V4 service object.
+    """
+    if threading.current_thread() is threading.main_thread():
+        yield analytics
+        return
+    with CONNECTION_POOLS_LOCK:
+        # The connection of the run is kept with its pool, so its id is not reused
+        pool = CONNECTION_POOLS.setdefault(id(analytics), (analytics, queue.LifoQueue()))[1]
+    try:
+        connection = pool.get_nowait()
+    except queue.Empty:
+        with instrumentation.stage('auth'):
+            connection = initialize_analyticsreporting()
+    try:
+        yield connection
+    finally:
+        pool.put(connection)
+
+def execute(request):
+    """Sends an Analytics Reporting API V4 request through the rate limiter.
 
     Args:
-        year: An ISO-year.
-        week: An ISO-week number.
+        request: A request object, like reports().batchGet().
     Returns:
-        The first date of that week, Monday, in dt.date().
+        The Analytics Reporting API V4 response.
+    """
+    response = LIMITER.call(request.execute, rate_limiter.ga_rate_limited)
+    instrumentation.add_bytes(LIMITER.name, instrumentation.response_size(response))
+    return response
+
+def segment_name(segment):
+    """Names a segment like the ga:segment dimension of its rows.
+
+    Dynamic segments carry their name, saved segments, given by segmentId,
+    need a 'name' next to it.
     """
-    d = dt.date(year, 1, 1)
-    if (d.weekday() > 3):
-        d = d + dt.timedelta(7 - d.weekday())
-    else:
-        d = d - dt.timedelta(d.weekday())
-    dlt = dt.timedelta(days = (week - 1) * 7)
-    return d + dlt #,  d + dlt + dt.timedelta(days = 6)
+    if 'dynamicSegment' in segment:
+        return segment['dynamicSegment']['name']
+    return segment['name']
 
-def download_df(worksheet_name):
-    """Downloading an existing worksheet from Google Drive.
+def is_additive(expression):
+    """Tells whether a metric adds up over campaigns, days and weeks.
+
+    Listed metrics, rates, averages, per-something ratios and calculated
+    expressions do not.
+    """
+    name = expression[len('ga:'):] if expression.startswith('ga:') else expression
+    return not (
+        expression in NON_ADDITIVE_METRICS
+        or name.startswith('avg')
+        or name.endswith('Rate')
+        or 'Per' in name
+        or any(operator in expression for operator in '+-*/()'))
+
+def totals_name(metric_name, segment):
+    """Names the totals row of a metric of a segment, or of no segment."""
+    if segment is not None and segment.get('label'):
+        return '{} ({})'.format(metric_name, segment['label'])
+    return metric_name
+
+def pack_reports(reports):
+    """Packs the report definitions into as few reportRequests as the API allows.
+
+    The reports with the same dimensions and metrics become one query with
+    all their segments, up to MAX_SEGMENTS per reportRequest, and more than
+    MAX_METRICS metrics take one query per MAX_METRICS. The queries with the
+    same segments then share batchGet calls, see iter_batch_get. Metrics
+    that do not add up, see is_additive, and a segment configured twice
+    under another label are rejected with a ValueError.
 
     Args:
-        worksheet_name: The correct worksheet name on the spreadsheet.
+        reports: A list of report definitions, dictionaries with a 'name',
+            the 'metrics' and 'dimensions' of a reportRequest, optional
+            'segments' and whether the report also feeds the details
+            worksheet under 'details', for exactly one report.
     Returns:
-        The existing worksheet data, or None;
-        and the first date of the next week's query.
+        A list of queries, dictionaries with the 'name', 'metrics',
+        'dimensions', 'segments' and 'details' of one reportRequest.
     """
-    try:
-        existing = g2d.download(gfile = SPREADSHEET, wks_name = worksheet_name, col_names = True, row_names = True)
-        start_date = get_week_days(
-            int(existing.columns[-1].split('-')[0]), 
-            int(existing.columns[-1].split('-')[1])
-            ) + dt.timedelta(days = 7)
-        return existing, start_date
-    except RuntimeError:
-        existing = None
-        start_date = dt.date(2017, 7, 2)
-        return existing, start_date
-
-def get_no_seg_report(analytics, starting_date):
-    """Queries the Analytics Reporting API V4 for non-segmented metrics.
+    if sum(1 for report in reports if report.get('details')) != 1:
+        raise ValueError('Exactly one GA report feeds the details')
+    for report in reports:
+        for metric in report['metrics']:
+            if not is_additive(metric['expression']):
+                raise ValueError(
+                    'GA report {!r}: {} does not add up over weeks, days or segments; '
+                    'query the metrics it is computed from instead'.format(report['name'], metric['expression']))
+    groups = {}
+    for report in reports:
+        group_key = json.dumps([report['dimensions'], report['metrics'], bool(report.get('segments'))], sort_keys = True)
+        group = groups.setdefault(group_key, dict(report, segments = [], details = False))
+        group['details'] = group['details'] or bool(report.get('details'))
+        segments = {segment_name(segment): segment for segment in group['segments']}
+        for segment in report.get('segments', []):
+            if segment_name(segment) not in segments:
+                segments[segment_name(segment)] = segment
+                group['segments'].append(segment)
+            elif segment != segments[segment_name(segment)]:
+                raise ValueError(
+                    'GA segment {!r} is configured twice with the same metrics but another label or '
+                    'definition; give them the same one or another name'.format(segment_name(segment)))
+    queries = []
+    for group in groups.values():
+        if group['details'] and (group['segments'] or len(group['metrics']) > MAX_METRICS):
+            raise ValueError('The details GA report takes no segments and at most {} metrics'.format(MAX_METRICS))
+        segment_chunks = [group['segments'][first:first + MAX_SEGMENTS] for first in range(0, len(group['segments']), MAX_SEGMENTS)]
+        metric_chunks = [group['metrics'][first:first + MAX_METRICS] for first in range(0, len(group['metrics']), MAX_METRICS)]
+        for number, (metrics, segments) in enumerate(itertools.product(metric_chunks, segment_chunks or [[]])):
+            queries.append({
+                'name': group['name'] if number == 0 else '{}_{}'.format(group['name'], number + 1),
+                'metrics': metrics,
+                'dimensions': group['dimensions'],
+                'segments': segments,
+                'details': group['details']
+                })
+    if len(set(query['name'] for query in queries)) < len(queries):
+        raise ValueError('The GA reports repeat names')
+    names = [
+        totals_name(metric['expression'], segment)
+        for query in queries
+        for segment in query['segments'] or [None]
+        for metric in query['metrics']]
+    if len(set(names)) < len(names):
+        raise ValueError('The GA reports repeat totals rows, label their segments')
+    return queries
+
+def get_request(query, starting_date, ending_date, by_week = False, view_id = VIEW_ID):
+    """Builds the Analytics Reporting API V4 request of a query.
+
+    Args:
+        query: A query of pack_reports.
+        starting_date: The date with which the data queries start.
+        ending_date: The date with which the data queries end.
+        by_week: Whether to add the ISO-year and ISO-week as first dimension.
+        view_id: The Google Analytics view to query.
+    Returns:
+        A reportRequest dictionary.
+    """
+    report_request = {
+        'viewId': view_id,
+        'dateRanges': [
+            {
+                'startDate': str(starting_date), 
+                'endDate': str(ending_date)
+            }],
+        'samplingLevel': SAMPLING_LEVEL,
+        'metrics': list(query['metrics']),
+        'dimensions': list(query['dimensions'])
+        }
+    if query['segments']:
+        # The rows of every segment come with its name as last dimension
+        report_request['dimensions'].append({'name': 'ga:segment'})
+        report_request['segments'] = [
+            {key: value for key, value in segment.items() if key in ['dynamicSegment', 'segmentId']}
+            for segment in query['segments']]
+    if by_week:
+        report_request['dimensions'].insert(0, {'name': 'ga:isoYearIsoWeek'})
+        report_request['orderBys'] = [{'fieldName': 'ga:isoYearIsoWeek'}]
+        report_request['pageSize'] = PAGE_SIZE
+    return report_request
+
+def get_reports(analytics, queries, starting_date, cache, view_id = VIEW_ID):
+    """Queries the Analytics Reporting API V4 for the reports of one week.
+
+    The reports not cached are queried together, in as few batchGet calls
+    as the API allows.
 
     Args:
         analytics: An authorized Analytics Reporting API V4 service object.
+        queries: The queries of pack_reports.
         starting_date: The date with which the data queries start.
+        cache: The response_cache.ResponseCache of the responses.
+        view_id: The Google Analytics view to query.
     Returns:
-        The Analytics Reporting API V4 response.
+        A dictionary of the Analytics Reporting API V4 responses per query name.
     """
-    return analytics.reports().batchGet(
-        body = {
-            'reportRequests': [
-                {
-                    'viewId': VIEW_ID,
-                    'dateRanges': [
-                        {
-                            'startDate': str(starting_date), 
-                            'endDate': str(starting_date + dt.timedelta(days = 6))
-                        }],
-                    'metrics': [
-                        {
-                            'expression': 'ga:impressions'
-                        },
-                        {
-                            'expression': 'ga:adClicks'
-                        },
-                        {
-                            'expression': 'ga:adCost',
-                            'formattingType': 'FLOAT'
-                        }],
-                    'dimensions': [
-                        {
-                            'name': 'ga:campaign'
-                        }]
-                }]
+    ending_date = starting_date + dt.timedelta(days = 6)
+    responses = {}
+    missing = []
+    for query in queries:
+        query_request = functools.partial(get_request, query, view_id = view_id)
+        response = cache.get(query_request(starting_date, ending_date))
+        if response is None:
+            missing.append((query, query_request))
+        else:
+            responses[query['name']] = response
+    fetched = get_unsampled_reports(analytics, [query_request for _, query_request in missing], starting_date, ending_date)
+    for (query, query_request), response in zip(missing, fetched):
+        cache.put(query_request(starting_date, ending_date), ending_date, response)
+        responses[query['name']] = response
+    return responses
+
+def iter_batch_get(analytics, report_requests, follow = None):
+    """Queries several reports in as few batchGet calls as the API allows, page by page.
+
+    Report requests can only share a batchGet when they have the same view,
+    date ranges, segments and sampling level, and at most five fit in one.
+    Every report is followed through its nextPageToken until the last page.
+
+    Args:
+        analytics: An authorized Analytics Reporting API V4 service object.
+        report_requests: A list of reportRequest dictionaries.
+        follow: A function of a report page telling whether to query the
+            next page, or None to query all of them.
+    Yields:
+        A (request number, report page) tuple per page, the pages of every
+        report in order.
+    """
+    def send_batch(chunk):
+        with pooled_connection(analytics) as connection:
+            return execute(connection.reports().batchGet(
+                body = {
+                    'reportRequests': [report_request for _, report_request in chunk]
+                    }
+                ))
+
+    pending = list(enumerate(report_requests))
+    while pending:
+        batches = {}
+        for number, report_request in pending:
+            batch_key = json.dumps(
+                [report_request.get(key) for key in ['viewId', 'dateRanges', 'segments', 'samplingLevel']],
+                sort_keys = True
+                )
+            batches.setdefault(batch_key, []).append((number, report_request))
+        chunks = []
+        for batch in batches.values():
+            for first in range(0, len(batch), MAX_BATCH_REQUESTS):
+                chunks.append(batch[first:first + MAX_BATCH_REQUESTS])
+        # Send the batches of this round in parallel
+        responses = rate_limiter.fetch_concurrently(send_batch, chunks, MAX_WORKERS)
+        pending = []
+        for chunk, response in zip(chunks, responses):
+            for (number, report_request), report in zip(chunk, response['reports']):
+                if 'nextPageToken' in report:
+                    page_token = report.pop('nextPageToken')
+                    if follow is None or follow(report):
+                        pending.append((number, dict(report_request, pageToken = page_token)))
+                yield number, report
+        # Only this round's pages are referenced from here on
+        del responses
+
+def batch_get(analytics, report_requests, follow = None):
+    """Queries several whole reports in as few batchGet calls as the API allows.
+
+    Args:
+        analytics: An authorized Analytics Reporting API V4 service object.
+        report_requests: A list of reportRequest dictionaries.
+        follow: A function of a report page telling whether to query the
+            next page, or None to query all of them.
+    Returns:
+        A list of reports with the rows of all their pages, in the order of the requests.
+    """
+    reports = [None] * len(report_requests)
+    for number, report in iter_batch_get(analytics, report_requests, follow):
+        if reports[number] is None:
+            reports[number] = report
+        else:
+            reports[number]['data'].setdefault('rows', []).extend(report['data'].get('rows', []))
+    return reports
+
+def is_sampled(report):
+    """Tells whether a report, or one page of it, is sampled.
+
+    Sampled reports carry the sessions read and the sessions there were,
+    per date range, in samplesReadCounts and samplingSpaceSizes.
+    """
+    return bool(report['data'].get('samplesReadCounts') or report['data'].get('samplingSpaceSizes'))
+
+def count_sampling(name):
+    """Adds one report to the SAMPLING counter name."""
+    with SAMPLING_LOCK:
+        SAMPLING[name] += 1
+
+def metric_total(convert, values):
+    """Adds up the values of one metric, strings like the API sends them, into one.
+
+    Decimal sums the fractions exactly, so the days of a week add up to the
+    value the API sends for the whole week.
+    """
+    if convert is int:
+        return str(sum(int(value) for value in values))
+    return '{:f}'.format(sum(decimal.Decimal(value) for value in values))
+
+def merge_reports(reports):
+    """Adds up the reports of consecutive date ranges into the report of the whole range.
+
+    The rows with the same dimensions are summed, which is right for the
+    additive metrics pack_reports allows.
+
+    Args:
+        reports: A list of reports of the same request but the date range.
+    Returns:
+        The report of the whole range, with the sampling of the parts still sampled.
+    """
+    types = transform.ga_metric_types(reports[0])
+    rows = {}
+    totals = [[] for _ in types]
+    for report in reports:
+        for row in report['data'].get('rows', []):
+            row_values = rows.setdefault(tuple(row['dimensions']), [[] for _ in types])
+            for number, value in enumerate(row['metrics'][0]['values']):
+                row_values[number].append(value)
+        for number, value in enumerate(report['data']['totals'][0]['values']):
+            totals[number].append(value)
+    data = {
+        'rows': [
+            {
+                'dimensions': list(dimensions),
+                'metrics': [{'values': [metric_total(convert, values) for convert, values in zip(types, row_values)]}]
             }
-    ).execute()
+            for dimensions, row_values in rows.items()],
+        'rowCount': len(rows),
+        'totals': [{'values': [metric_total(convert, values) for convert, values in zip(types, totals)]}]
+        }
+    for key in ['samplesReadCounts', 'samplingSpaceSizes']:
+        if any(key in report['data'] for report in reports):
+            data[key] = [count for report in reports for count in report['data'].get(key, [])]
+    return {'columnHeader': reports[0]['columnHeader'], 'data': data}
 
-def get_seg_report(analytics, starting_date):
-    """Queries the Analytics Reporting API V4 for segmented metrics.
+def get_daily_report(analytics, get_request, starting_date, ending_date):
+    """Queries a date range day by day, side by side, and adds the days up.
 
     Args:
         analytics: An authorized Analytics Reporting API V4 service object.
+        get_request: A function of the starting and ending date that builds
+            the reportRequest.
+        starting_date: The first day of the range.
+        ending_date: The last day of the range.
+    Returns:
+        The report of the whole range.
+    """
+    count_sampling('split')
+    days = [starting_date + dt.timedelta(days = day) for day in range((ending_date - starting_date).days + 1)]
+    report = merge_reports(batch_get(analytics, [get_request(day, day) for day in days]))
+    if is_sampled(report):
+        # A day is as short as a date range gets
+        count_sampling('sampled')
+    return report
+
+def get_unsampled_reports(analytics, get_requests, starting_date, ending_date):
+    """Queries the reports of a date range together, day by day the ones that come back sampled.
+
+    Args:
+        analytics: An authorized Analytics Reporting API V4 service object.
+        get_requests: A list of functions of the starting and ending date
+            that build the reportRequests.
         starting_date: The date with which the data queries start.
+        ending_date: The date with which the data queries end.
     Returns:
-        The Analytics Reporting API V4 response.
+        A list of the Analytics Reporting API V4 responses, in the order of get_requests.
+    """
+    # The pages of a sampled report are of no use
+    reports = batch_get(
+        analytics,
+        [get_request(starting_date, ending_date) for get_request in get_requests],
+        follow = lambda page: not is_sampled(page)
+        )
+    responses = []
+    for get_request, report in zip(get_requests, reports):
+        if is_sampled(report):
+            if starting_date < ending_date:
+                report = get_daily_report(analytics, get_request, starting_date, ending_date)
+            else:
+                count_sampling('sampled')
+        responses.append({'reports': [report]})
+    return responses
+
+class WeekSplitter(object):
+    """Splits the pages of a report with the ISO-week as first dimension into weekly responses.
+
+    The report must be ordered by week, so every week is complete, and
+    released, as soon as the rows of the next week start. The weekly totals
+    are summed up from the rows, which is right for the additive metrics
+    pack_reports allows.
     """
-    return analytics.reports().batchGet(
-        body = {
-            'reportRequests': [
+
+    def __init__(self, week_starts):
+        """Starts with no rows.
+
+        Args:
+            week_starts: The week starting dates, Mondays, covered by the report.
+        """
+        self.week_starts = sorted(week_starts)
+        self.positions = {
+            '{}{:02d}'.format(*start_date.isocalendar()[:2]): position
+            for position, start_date in enumerate(self.week_starts)}
+        self.column_header = None
+        self.types = None
+        self.released = 0
+        self.rows = []
+        self.values = None
+
+    def add_page(self, report):
+        """Reads the rows of one page.
+
+        Args:
+            report: The next page of the report, queried with by_week.
+        Returns:
+            A list of (week starting date, weekly response) tuples of the weeks
+            this page completed.
+        """
+        if self.column_header is None:
+            self.column_header = dict(report['columnHeader'])
+            self.column_header['dimensions'] = report['columnHeader'].get('dimensions', [])[1:]
+            self.types = transform.ga_metric_types(report)
+            self.values = [[] for _ in self.types]
+        completed = []
+        for row in report['data'].get('rows', []):
+            dimensions = row['dimensions']
+            position = self.positions.get(dimensions[0])
+            if position is None:
+                continue
+            if position < self.released:
+                raise ValueError('The report rows are not ordered by week')
+            while self.released < position:
+                completed.append(self.release())
+            self.rows.append({'dimensions': dimensions[1:], 'metrics': row['metrics']})
+            for number, value in enumerate(row['metrics'][0]['values']):
+                self.values[number].append(value)
+        return completed
+
+    def finish(self):
+        """Releases the remaining weeks after the last page.
+
+        Returns:
+            A list of (week starting date, weekly response) tuples.
+        """
+        return [self.release() for _ in range(self.released, len(self.week_starts))]
+
+    def release(self):
+        """Builds the weekly response of the oldest week not released yet."""
+        start_date = self.week_starts[self.released]
+        totals = [metric_total(convert, values) for convert, values in zip(self.types, self.values)]
+        weekly_report = {
+            'reports': [
                 {
-                    'viewId': VIEW_ID,
-                    'dateRanges': [
-                        {
-                            'startDate': str(starting_date), 
-                            'endDate': str(starting_date + dt.timedelta(days = 6))
-                        }],
-                    'metrics': [
-                        {
-                            'expression': 'ga:sessions'
-                        },
-                        {
-                            'expression': 'ga:goal6Completions'
-                        },
-                        {
-                            'expression': 'ga:transactions'
-                        },
-                        {
-                            'expression': 'ga:transactionRevenue',
-                            'formattingType': 'FLOAT'
-                        }],
-                    'dimensions': [
-                        {
-                            'name': 'ga:campaign'
-                        },
-                        {
-                            'name': 'ga:segment'
+                    'columnHeader': self.column_header,
+                    'data': {
+                        'rows': self.rows,
+                        'rowCount': len(self.rows),
+                        'totals': [{'values': totals}]
                         }
-                        ],
-                    'segments':[
-                        {
-                            'dynamicSegment': {
-                                'name': 'Paid Sessions',
-                                'sessionSegment': {
-                                    'segmentFilters': [
-                                        {
-                                            'not': 'False',
-                                            'simpleSegment': {
-                                                'orFiltersForSegment': [
-                                                    {
-                                                        'segmentFilterClauses': [
-                                                            {
-                                                                'dimensionFilter': {
-                                                                    'dimensionName': 'ga:medium',
-                                                                    'operator': 'REGEXP',
-                                                                    'expressions': ['^(cpc|ppc|cpa|cpm|cpv|cpp)$']
-                                                                    }
-                                                            }]
-                                                    }]
-                                                }
-                                        }]
-                                    }
-                                }
-                        }]
                 }]
             }
-        ).execute()
+        self.released += 1
+        self.rows = []
+        self.values = [[] for _ in self.types]
+        return start_date, weekly_report
+
+def segment_totals(report, segments):
+    """Demultiplexes the totals of a report per segment.
 
-def clean_extracted_data_totals(dict_data, starting_date):
+    The totals of a report with segments add up all of them, so the totals
+    of each segment are summed up from its rows instead, which is right for
+    the additive metrics pack_reports allows. Rows of a segment that is not
+    configured, a saved segment whose 'name' is not its name in Google
+    Analytics, raise a ValueError.
+
+    Args:
+        report: A report with the segment name as last dimension.
+        segments: The segments of the reportRequest.
+    Returns:
+        The names and the values of the totals, segment after segment.
+    """
+    metric_names = [entry['name'] for entry in report['columnHeader']['metricHeader']['metricHeaderEntries']]
+    types = transform.ga_metric_types(report)
+    values = {segment_name(segment): [[] for _ in types] for segment in segments}
+    for row in report['data'].get('rows', []):
+        if row['dimensions'][-1] not in values:
+            raise ValueError(
+                'The report has rows of the segment {!r}, not of the configured {}; the name of a saved '
+                'segment must be its name in Google Analytics'.format(row['dimensions'][-1], sorted(values)))
+        for number, value in enumerate(row['metrics'][0]['values']):
+            values[row['dimensions'][-1]][number].append(value)
+    index, totals = [], []
+    for segment in segments:
+        index += [totals_name(metric_name, segment) for metric_name in metric_names]
+        totals += [metric_total(convert, metric_values) for convert, metric_values in zip(types, values[segment_name(segment)])]
+    return index, totals
+
+def clean_extracted_data_totals(dict_data, starting_date, queries = None):
     """Cleans the totals data.
 
     Args:
-        dict_data: A dictionary of extracted data.
+        dict_data: A list of dictionaries of extracted data; the metrics of
+            all their reports become the columns of one row.
         starting_date: The date with which the data queries start.
+        queries: The queries of pack_reports of the reports, whose segments
+            are split into totals of their own, or None for reports without
+            segments.
     Returns:
-        A cleanded pandas DataFrame of totals.
+        A one-row typed pandas DataFrame of totals.
     """
-    index = []
-    for number, _ in enumerate(dict_data['reports'][0]['columnHeader']['metricHeader']['metricHeaderEntries']):
-        index.extend([dict_data['reports'][0]['columnHeader']['metricHeader']['metricHeaderEntries'][number]['name']])
+    index, values = [], []
+    for number, response in enumerate(dict_data):
+        report = response['reports'][0]
+        if queries is not None and queries[number]['segments']:
+            segment_index, segment_values = segment_totals(report, queries[number]['segments'])
+            index += segment_index
+            values += segment_values
+        else:
+            index += [entry['name'] for entry in report['columnHeader']['metricHeader']['metricHeaderEntries']]
+            values += report['data']['totals'][0]['values']
     iso_year, iso_week = starting_date.isocalendar()[:2]
-    return pd.DataFrame(
-        dict_data['reports'][0]['data']['totals'][0]['values'], 
-        index = index, 
-        columns = ['{}-{}'.format(iso_year, iso_week)]
-        )
+    return transform.totals_frame(index, values, '{}-{}'.format(iso_year, iso_week))
 
 def clean_extracted_data_details(dict_data, starting_date):
     """Cleans the details data.
@@ -224,201 +693,207 @@ def clean_extracted_data_details(dict_data, starting_date):
         dict_data: A dictionary of extracted data.
         starting_date: The date with which the data queries start.
     Returns:
-        A cleanded pandas DataFrame of campaign details.
+        A typed pandas DataFrame of campaign details.
     """
-    index = ['campaign']
-    for number, _ in enumerate(dict_data['reports'][0]['columnHeader']['metricHeader']['metricHeaderEntries']):
-        index.extend([dict_data['reports'][0]['columnHeader']['metricHeader']['metricHeaderEntries'][number]['name']])
-    campaigns_details = []
-    for number, _ in enumerate(dict_data['reports'][0]['data']['rows']):
-        campaigns_details.extend([
-                dict_data['reports'][0]['data']['rows'][number]['dimensions'],
-                dict_data['reports'][0]['data']['rows'][number]['metrics'][0]['values']
-            ])
     iso_year, iso_week = starting_date.isocalendar()[:2]
-    new_index = []
-    for i in range(dict_data['reports'][0]['data']['rowCount']):
-        for _, j in enumerate(index):
-            new_index.append('{}_{}'.format(j, i))
-    return pd.DataFrame(
-        sum(campaigns_details, []), 
-        index = new_index, 
-        columns = ['{}-{}'.format(iso_year, iso_week)]
-        ), index
-
-def sort_data(data, metrics):
-    """Sort data similar to the totals.
+    campaigns, metrics, values = transform.ga_details_arrays(dict_data)
+    return transform.details_frame(campaigns, metrics, values, '{}-{}'.format(iso_year, iso_week))
 
-    Args:
-        data: A pandas DataFrame.
-        metrics: The metrics of a campaign.
-    Returns:
-        A sorted pandas DataFrame with an index list similar to totals.
-    """
-    number_of_campaigns = int(len(data.index)/len(metrics))
-    index = []
-    for add_number, _ in enumerate(metrics):
-        index += [int(data.index[row].split('_')[1] + str(add_number)) for row in range(number_of_campaigns)]
-    data.index = index
-    data.sort_index(inplace = True)
-    new_index = []
-    for i in range(number_of_campaigns):
-        for _, j in enumerate(sorted(metrics)):
-            new_index.append('{}_{}'.format(j, i))
-    data.index = new_index
-    return data
-
-def loop_adding_weeks_totals(connection, previous_data, starting_date):
-    """Merges all the previous and newly extracted data.
+def extract_weeks(connection, totals_weeks, details_weeks, on_week, cache, view_id = VIEW_ID, queries = None):
+    """Queries every report of the missing weeks once for both worksheets.
+
+    The details report feeds both the totals and the details, the other
+    reports only the totals.
 
     Args:
         connection: The API connection with Google Analytics.
-        previous_data: A dataframe from Google Drive, or None.
-        starting_date: The date with which the data queries start.
+        totals_weeks: The week starting dates missing from the totals.
+        details_weeks: The week starting dates missing from the details.
+        on_week: A function of a week starting date and a dictionary of its
+            Analytics Reporting API V4 responses per query name, called for
+            every week in calendar order as soon as it is extracted.
+        cache: The response_cache.ResponseCache of the responses.
+        view_id: The Google Analytics view to query.
+        queries: The queries of pack_reports, by default of REPORTS.
     Returns:
-        A cleanded and merged pandas DataFrame of campaign totals.
+        The number of weeks extracted.
     """
-    start_date = starting_date
-    if isinstance(previous_data, pd.DataFrame):
-        while start_date + dt.timedelta(days = 6) < dt.date.today(): 
-            # Extract data from Google Analytics
-            extracted_data_no_seg = get_no_seg_report(connection, start_date)
-            extracted_data_seg = get_seg_report(connection, start_date)
-            # Transform the extracted data
-            transformed_data = clean_extracted_data_totals(
-                extracted_data_no_seg,
-                start_date
-                ).append(
-                    clean_extracted_data_totals(
-                        extracted_data_seg,
-                        start_date
-                        ))
-            # Add another week
-            start_date += dt.timedelta(days = 7)
-            # Merge existing datat with new column
-            previous_data = pd.merge(
-                previous_data, 
-                transformed_data,
-                left_index = True,
-                right_index = True
-                )
-        return previous_data
-    else:
-        # Extract data from Google Analytics
-        extracted_data_no_seg = get_no_seg_report(connection, start_date)
-        extracted_data_seg = get_seg_report(connection, start_date))
-        # Transform the extracted data
-        previous_data = clean_extracted_data_totals(
-            extracted_data_no_seg,
-            start_date
-            ).append(
-                clean_extracted_data_totals(
-                    extracted_data_seg,
-                    start_date
-                    ))
-        # Add another week
-        start_date += dt.timedelta(days = 7)
-        while start_date + dt.timedelta(days = 6) < dt.date.today(): 
+    if queries is None:
+        queries = pack_reports(REPORTS)
+    week_starts = sorted(set(totals_weeks) | set(details_weeks))
+    totals_week_starts = set(totals_weeks)
+    weekly_data = {}
+    ordered_weeks = checkpoints.OrderedWeeks(week_starts, on_week)
+
+    def week_queries(start_date):
+        return [query for query in queries if query['details'] or start_date in totals_week_starts]
+
+    def keep_report(start_date, query, weekly_report):
+        extracted_data = weekly_data.setdefault(start_date, {})
+        extracted_data[query] = weekly_report
+        # A week is complete with the reports of all its worksheets,
+        # and only kept here until then
+        if all(week_query['name'] in extracted_data for week_query in week_queries(start_date)):
+            ordered_weeks.add(start_date, weekly_data.pop(start_date))
+
+    if EXTRACTION_MODE != 'range':
+        def extract_week(start_date):
             # Extract data from Google Analytics
-            extracted_data_no_seg = get_no_seg_report(connection, start_date)
-            extracted_data_seg = get_seg_report(connection, start_date)
-            # Transform the extracted data
-            transformed_data = clean_extracted_data_totals(
-                extracted_data_no_seg,
-                start_date
-                ).append(
-                    clean_extracted_data_totals(
-                        extracted_data_seg,
-                        start_date
-                        ))
-            # Add another week
-            start_date += dt.timedelta(days = 7)
-            # Merge existing datat with new column
-            previous_data = pd.merge(
-                previous_data, 
-                transformed_data,
-                left_index = True,
-                right_index = True
-                )
-        return previous_data
+            return get_reports(connection, week_queries(start_date), start_date, cache, view_id)
+        # Extract the weeks in parallel, as fast as the rate limiter allows.
+        for start_date, extracted_data in zip(week_starts, rate_limiter.iter_concurrently(extract_week, week_starts, MAX_WORKERS, QUEUE_WEEKS)):
+            ordered_weeks.add(start_date, extracted_data)
+        return len(week_starts)
+    # Take the weeks already in the cache
+    range_queries = [
+        (
+            query['name'],
+            functools.partial(get_request, query, view_id = view_id),
+            [start_date for start_date in week_starts if query['details'] or start_date in totals_week_starts]
+        ) for query in queries]
+    missing = {}
+    for query, query_request, query_week_starts in range_queries:
+        for start_date in query_week_starts:
+            weekly_report = cache.get(query_request(start_date, start_date + dt.timedelta(days = 6)))
+            if weekly_report is None:
+                missing.setdefault(query, []).append(start_date)
+            else:
+                keep_report(start_date, query, weekly_report)
+    range_queries = [(query, query_request, query_week_starts) for query, query_request, query_week_starts in range_queries if query in missing]
+
+    def keep_weeks(number, weeks):
+        query, query_request, _ = range_queries[number]
+        for start_date, weekly_report in weeks:
+            cache.put(query_request(start_date, start_date + dt.timedelta(days = 6)), start_date + dt.timedelta(days = 6), weekly_report)
+            keep_report(start_date, query, weekly_report)
+
+    # Extract every contiguous range of the other weeks from Google Analytics
+    # at once, in shorter spans, side by side, while the reports come back sampled
+    plans = [
+        (number, [start_date for start_date in missing[query] if first_date <= start_date <= last_date])
+        for number, (query, _, _) in enumerate(range_queries)
+        for first_date, last_date in calendar_index.coalesce(missing[query])]
+    while plans:
+        report_requests = [
+            range_queries[number][1](plan_weeks[0], plan_weeks[-1] + dt.timedelta(days = 6), by_week = True)
+            for number, plan_weeks in plans]
+        splitters = [WeekSplitter(plan_weeks) for _, plan_weeks in plans]
+        sampled = set()
+        # Only the weeks are kept, every page is dropped once read
+        for position, report in iter_batch_get(connection, report_requests, follow = lambda page: not is_sampled(page)):
+            if is_sampled(report):
+                sampled.add(position)
+            else:
+                keep_weeks(plans[position][0], splitters[position].add_page(report))
+        split_plans = []
+        for position, (number, plan_weeks) in enumerate(plans):
+            if position not in sampled:
+                keep_weeks(number, splitters[position].finish())
+            elif len(plan_weeks) > 1:
+                # Query the two halves of the span, in whole weeks
+                count_sampling('split')
+                middle = len(plan_weeks) // 2
+                split_plans += [(number, plan_weeks[:middle]), (number, plan_weeks[middle:])]
+            else:
+                start_date = plan_weeks[0]
+                weekly_report = get_daily_report(connection, range_queries[number][1], start_date, start_date + dt.timedelta(days = 6))
+                keep_weeks(number, [(start_date, {'reports': [weekly_report]})])
+        plans = split_plans
+    return len(week_starts)
+
+class GoogleAnalyticsSource(pipeline.SourceAdapter):
+    """The Google Analytics steps of the weekly download."""
+
+    def __init__(self, analytics, cache, view_id = VIEW_ID, reports = None):
+        """Sets up the source.
+
+        Args:
+            analytics: An authorized Analytics Reporting API V4 service object.
+            cache: The response_cache.ResponseCache of the responses.
+            view_id: The Google Analytics view to query.
+            reports: The report definitions of pack_reports, by default REPORTS.
+        """
+        pipeline.SourceAdapter.__init__(self, FIRST_START_DATE, dt.date.today())
+        self.analytics = analytics
+        self.cache = cache
+        self.view_id = view_id
+        self.queries = pack_reports(REPORTS if reports is None else reports)
+        self.details_query = next(query for query in self.queries if query['details'])
+        with SAMPLING_LOCK:
+            self.sampling = dict(SAMPLING)
+
+    def extract_weeks(self, totals_weeks, details_weeks, on_week):
+        return extract_weeks(self.analytics, totals_weeks, details_weeks, on_week, self.cache, self.view_id, self.queries)
+
+    def clean_weekly_totals(self, extracted_data, starting_date):
+        return clean_extracted_data_totals([extracted_data[query['name']] for query in self.queries], starting_date, self.queries)
+
+    def clean_weekly_details(self, extracted_data, starting_date):
+        return clean_extracted_data_details(extracted_data[self.details_query['name']], starting_date)
 
-def loop_adding_weeks_details(connection, previous_data, starting_date):
-    """Merges all the previous and newly extracted data.
+    def summary(self):
+        """Returns the reports split, and still sampled, since the source was set up."""
+        with SAMPLING_LOCK:
+            return {
+                'sampled_splits': SAMPLING['split'] - self.sampling['split'],
+                'sampled_reports': SAMPLING['sampled'] - self.sampling['sampled']
+                }
+
+def run(analytics, gc, view_id, spreadsheet, worksheets, store, restart = False, load_only = False, cache = None):
+    """Brings the worksheets of one view up to date.
+
+    Every week is checkpointed in the warehouse as soon as it is extracted,
+    so a run that stops halfway resumes after the last week it stored.
 
     Args:
-        connection: The API connection with Google Analytics.
-        previous_data: A dataframe from Google Drive, or None.
-        starting_date: The date with which the data queries start.
+        analytics: An authorized Analytics Reporting API V4 service object.
+        gc: An authorized gspread client.
+        view_id: The Google Analytics view to query.
+        spreadsheet: The spreadsheet URL.
+        worksheets: The names of the totals and the details worksheets.
+        store: The warehouse.Warehouse of the view.
+        restart: Whether to drop the weeks stored since the last upload and
+            extract them again.
+        load_only: Whether to upload the stored weeks without extracting.
+        cache: The response_cache.ResponseCache of the responses, or None
+            to open the one of config.json.
     Returns:
-        A cleanded and merged pandas DataFrame of campaign details.
+        A dictionary of the number of new weeks, of the weeks resumed from
+        an earlier run, the reports split and still sampled and the cells
+        written per worksheet.
     """
-    start_date = starting_date
-    if isinstance(previous_data, pd.DataFrame):
-        while start_date + dt.timedelta(days = 6) < dt.date.today(): 
-            # Extract data from Google Analytics
-            extracted_data_no_seg = get_no_seg_report(connection, start_date)
-            # Transform the extracted data
-            transformed_data, index = clean_extracted_data_details(extracted_data_no_seg, start_date)
-            # Add another week
-            start_date += dt.timedelta(days = 7)
-            # Merge existing datat with new column
-            previous_data = pd.merge(
-                previous_data, 
-                transformed_data,
-                how = 'outer',
-                left_index = True,
-                right_index = True
-                )
-        return sort_data(previous_data, index)
-    else:
-        # Extract data from Google Analytics
-        extracted_data_no_seg = get_no_seg_report(connection, start_date)
-        # Transform the extracted data
-        previous_data, index = clean_extracted_data_details(extracted_data_no_seg, start_date)
-        # Add another week
-        start_date += dt.timedelta(days = 7)
-        while start_date + dt.timedelta(days = 6) < dt.date.today(): 
-            # Extract data from Google Analytics
-            extracted_data_no_seg = get_no_seg_report(connection, start_date)
-            # Transform the extracted data
-            transformed_data, index = clean_extracted_data_details(extracted_data_no_seg, start_date)
-            # Add another week
-            start_date += dt.timedelta(days = 7)
-            # Merge existing datat with new column
-            previous_data = pd.merge(
-                previous_data, 
-                transformed_data,
-                how = 'outer',
-                left_index = True,
-                right_index = True
-                )
-        return sort_data(previous_data, index) 
+    if cache is None:
+        cache = response_cache.from_config(CONFIG)
+    return pipeline.run(
+        GoogleAnalyticsSource(analytics, cache, view_id),
+        gc,
+        spreadsheet,
+        worksheets,
+        store,
+        restart = restart,
+        load_only = load_only,
+        queue_weeks = QUEUE_WEEKS,
+        load_batch_weeks = LOAD_BATCH_WEEKS,
+        read_chunk_weeks = READ_CHUNK_WEEKS,
+        read_workers = READ_WORKERS,
+        sharding = SHARDING
+        )
 
 def main():
+    parser = argparse.ArgumentParser(description = 'Download the weekly Google Analytics reports to Google Sheets.')
+    checkpoints.add_arguments(parser)
+    args = parser.parse_args()
+    report = instrumentation.start('ga_weekly_download', VIEW_ID, [LIMITER])
+
     # Authorize credentials with Google Drive and Google Analytics
-    gc = initialize_drive()
-    analytics = initialize_analyticsreporting()
-
-    # Download existing or make dataframe and the last week
-    existing_totals, start_date_totals = download_df(WORKSHEETS[0])
-    existing_details, start_date_details = download_df(WORKSHEETS[1])
-
-    # Getting the sweet data
-    all_data_totals = loop_adding_weeks_totals(analytics, existing_totals, start_date_totals)
-    all_data_details = loop_adding_weeks_details(analytics, existing_details, start_date_details)
-    
-    # Upload the transformed data to Google Sheets
-    d2g.upload(
-        df = all_data_totals, 
-        gfile = SPREADSHEET, 
-        wks_name = WORKSHEETS[0]
-        )
-    d2g.upload(
-        df = all_data_details, 
-        gfile = SPREADSHEET, 
-        wks_name = WORKSHEETS[1]
-        )
-    
+    with instrumentation.stage('auth'):
+        gc = initialize_drive()
+        analytics = initialize_analyticsreporting()
+
+    store = warehouse.from_config(CONFIG)
+    run(analytics, gc, VIEW_ID, SPREADSHEET, WORKSHEETS, store, restart = args.restart, load_only = args.load_only)
+    instrumentation.write_reports([report.to_dict()], CONFIG)
+
 if __name__ == "__main__":
     main()
     
\ No newline at end of file
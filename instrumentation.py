@@ -0,0 +1,224 @@
+"""
+Per-stage timing, API counters and quota headroom of a weekly run.
+
+A run report collects the durations of the auth, extract, transform, merge
+and load stages, and the requests, bytes, retries and quota headroom of
+every API, and the memory of the typed frames the run built. It is written
+as JSON, and as a Prometheus textfile for the node exporter textfile
+collector.
+"""
+
+
+#Import libraries
+import contextlib
+import json
+import os
+import threading
+import time
+
+# Define variables
+METRIC_PREFIX = 'weekly_download'
+
+class RunReport(object):
+    """The measures of one run of a script for one account or view."""
+
+    def __init__(self, script, account, limiters = ()):
+        """Starts the run.
+
+        Args:
+            script: The script name, like 'ga_weekly_download'.
+            account: The ad account or view of the run.
+            limiters: The rate_limiter.RateLimiter of every API the run uses.
+        """
+        self.script = script
+        self.account = account
+        self.started = time.time()
+        self.stages = {}
+        self.bytes = {}
+        self.frames = {}
+        self.limiters = list(limiters)
+        # The limiters live longer than a run, so only the growth counts.
+        self.limiter_counts = {limiter.name: (limiter.requests, limiter.retries) for limiter in self.limiters}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Adds the duration of a block to a stage; blocks may repeat and overlap."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            with self.lock:
+                stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+                stage['seconds'] += seconds
+                stage['calls'] += 1
+
+    def add_bytes(self, api, count):
+        """Adds the size of a response to an API's bytes transferred."""
+        with self.lock:
+            self.bytes[api] = self.bytes.get(api, 0) + count
+
+    def add_memory(self, name, measures):
+        """Adds the memory measures of a frame, like schema.memory_report returns.
+
+        The frames of a worksheet built week by week add up.
+        """
+        with self.lock:
+            frame = self.frames.setdefault(name, {'rows': 0, 'bytes': 0, 'untyped_bytes': 0})
+            for measure in ['rows', 'bytes', 'untyped_bytes']:
+                frame[measure] += measures[measure]
+            frame['saved_percent'] = round(100 * (1 - frame['bytes'] / frame['untyped_bytes']), 1) if frame['untyped_bytes'] else 0.0
+
+    def to_dict(self):
+        """Summarizes the run so far.
+
+        Returns:
+            A JSON serializable dictionary of the run, its stages and APIs.
+        """
+        apis = {}
+        for limiter in self.limiters:
+            requests, retries = self.limiter_counts[limiter.name]
+            apis[limiter.name] = {
+                'requests': limiter.requests - requests,
+                'retries': limiter.retries - retries,
+                'bytes': self.bytes.get(limiter.name, 0),
+                # The request rate the limiter slowed down to, of the configured one
+                'rate_percent': round(100 * limiter.rate / limiter.max_rate, 1),
+                # The quota left by the API's own usage report, if it sends one
+                'quota_headroom_percent': None if limiter.usage_percent is None else round(100 - limiter.usage_percent, 1)
+                }
+        with self.lock:
+            stages = {name: dict(stage, seconds = round(stage['seconds'], 3)) for name, stage in self.stages.items()}
+            frames = {name: dict(measures) for name, measures in self.frames.items()}
+        return {
+            'script': self.script,
+            'account': self.account,
+            'started': self.started,
+            'seconds': round(time.time() - self.started, 3),
+            'stages': stages,
+            'apis': apis,
+            'frames': frames
+            }
+
+CURRENT = RunReport('', '')
+
+def start(script, account, limiters = ()):
+    """Starts the report of a run, used by stage and add_bytes from then on.
+
+    Returns:
+        The new RunReport.
+    """
+    global CURRENT
+    CURRENT = RunReport(script, account, limiters)
+    return CURRENT
+
+def stage(name):
+    """Times a block as part of a stage of the current run."""
+    return CURRENT.stage(name)
+
+def add_bytes(api, count):
+    """Adds the size of a response to the current run."""
+    CURRENT.add_bytes(api, count)
+
+def add_memory(name, measures):
+    """Adds the memory measures of a frame to the current run."""
+    CURRENT.add_memory(name, measures)
+
+def response_size(response):
+    """Measures a decoded API response as its size in compact JSON.
+
+    Args:
+        response: A JSON serializable response.
+    Returns:
+        The number of bytes.
+    """
+    return len(json.dumps(response, separators = (',', ':'), default = str))
+
+def write_atomically(path, text):
+    """Writes a file so readers never see it half written."""
+    temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary_path, 'w') as output_file:
+        output_file.write(text)
+    os.replace(temporary_path, path)
+
+def write_json(reports, path):
+    """Writes run reports as JSON.
+
+    Args:
+        reports: A list of RunReport.to_dict dictionaries.
+        path: The JSON file.
+    """
+    write_atomically(path, json.dumps(reports, indent = 2))
+
+def label_text(labels):
+    """Formats Prometheus labels."""
+    return ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels.items())
+
+def prometheus_text(reports):
+    """Formats run reports in the Prometheus text exposition format.
+
+    Args:
+        reports: A list of RunReport.to_dict dictionaries.
+    Returns:
+        The text of the metrics.
+    """
+    metrics = [
+        ('run_timestamp_seconds', 'The start of the last run.'),
+        ('run_seconds', 'The duration of the last run.'),
+        ('stage_seconds', 'The time spent in a stage of the last run.'),
+        ('api_requests', 'The API requests of the last run.'),
+        ('api_retries', 'The retried API requests of the last run.'),
+        ('api_bytes', 'The bytes of the API responses of the last run.'),
+        ('api_rate_percent', 'The request rate at the end of the last run, in percent of the configured rate.'),
+        ('api_quota_headroom_percent', 'The quota left by the usage the API reported in the last run.'),
+        ('frame_bytes', 'The memory of a typed frame of the last run.'),
+        ('frame_untyped_bytes', 'The memory the frame would take as object strings.')
+        ]
+    samples = {name: [] for name, _ in metrics}
+    for report in reports:
+        run_labels = {'script': report['script'], 'account': report['account']}
+        samples['run_timestamp_seconds'].append((run_labels, report['started']))
+        samples['run_seconds'].append((run_labels, report['seconds']))
+        for name, stage in sorted(report['stages'].items()):
+            samples['stage_seconds'].append((dict(run_labels, stage = name), stage['seconds']))
+        for api, measures in sorted(report['apis'].items()):
+            api_labels = dict(run_labels, api = api)
+            for measure in ['requests', 'retries', 'bytes', 'rate_percent', 'quota_headroom_percent']:
+                if measures[measure] is not None:
+                    samples['api_' + measure].append((api_labels, measures[measure]))
+        for name, measures in sorted(report.get('frames', {}).items()):
+            frame_labels = dict(run_labels, frame = name)
+            samples['frame_bytes'].append((frame_labels, measures['bytes']))
+            samples['frame_untyped_bytes'].append((frame_labels, measures['untyped_bytes']))
+    lines = []
+    for name, help_text in metrics:
+        lines.append('# HELP {}_{} {}'.format(METRIC_PREFIX, name, help_text))
+        lines.append('# TYPE {}_{} gauge'.format(METRIC_PREFIX, name))
+        for labels, value in samples[name]:
+            lines.append('{}_{}{{{}}} {}'.format(METRIC_PREFIX, name, label_text(labels), value))
+    return '\n'.join(lines) + '\n'
+
+def write_prometheus(reports, path):
+    """Writes run reports as a Prometheus textfile.
+
+    Args:
+        reports: A list of RunReport.to_dict dictionaries.
+        path: The .prom file, in the textfile collector directory.
+    """
+    write_atomically(path, prometheus_text(reports))
+
+def write_reports(reports, config):
+    """Writes run reports to the files of a config.json.
+
+    Args:
+        reports: A list of RunReport.to_dict dictionaries.
+        config: The loaded config.json dictionary, with 'run_report_path'
+            and 'prometheus_textfile'; a missing or empty path skips that file.
+    """
+    if config.get('run_report_path'):
+        write_json(reports, config['run_report_path'])
+    if config.get('prometheus_textfile'):
+        write_prometheus(reports, config['prometheus_textfile'])
@@ -0,0 +1,351 @@
+"""
+Staged extract, transform and load of the weekly downloads.
+
+The scripts only differ in how they extract a week and clean it into the
+typed frames; they plug that in as a SourceAdapter. The engine runs the
+stages side by side: the extraction hands every week, in calendar order, to
+the transform thread, which hands the frames to the load thread, which
+checkpoints them in the warehouse and uploads every finished batch of
+weeks. The queues between the stages are bounded, and the extraction only
+fetches a window of weeks ahead, see rate_limiter.iter_concurrently, so a
+fast extraction waits for the transform instead of piling up weeks in
+memory.
+"""
+
+
+#Import libraries
+import queue
+import threading
+import accumulation
+import calendar_index
+import checkpoints
+import instrumentation
+import schema
+import sheets_loader
+import warehouse
+
+# Define variables
+# The weeks waiting between two stages
+QUEUE_WEEKS = 4
+# The weeks stored between two uploads, 0 to upload once at the end
+LOAD_BATCH_WEEKS = 13
+DONE = None
+
+class SourceAdapter(object):
+    """The steps of a weekly download that depend on the API.
+
+    Subclasses extract the weeks and clean one week of extracted data into
+    the typed totals and details frames; reading the existing worksheets
+    and merging the weekly frames are the same for every API.
+    """
+
+    def __init__(self, first_start_date, end_date):
+        """Sets up the source.
+
+        Args:
+            first_start_date: The first week of the history.
+            end_date: The first date not to query; the weeks that ended
+                before it are complete.
+        """
+        self.first_start_date = first_start_date
+        self.calendar = calendar_index.week_index(first_start_date, end_date)
+
+    def extract_weeks(self, totals_weeks, details_weeks, on_week):
+        """Extracts the missing weeks of both worksheets only once.
+
+        Args:
+            totals_weeks: The week starting dates missing from the totals.
+            details_weeks: The week starting dates missing from the details.
+            on_week: A function of a week starting date and its extracted
+                data, called for every week in calendar order.
+        Returns:
+            The number of weeks extracted.
+        """
+        raise NotImplementedError
+
+    def clean_weekly_totals(self, extracted_data, starting_date):
+        """Cleans one week of extracted data into a one-row typed frame of totals."""
+        raise NotImplementedError
+
+    def clean_weekly_details(self, extracted_data, starting_date):
+        """Cleans one week of extracted data into a typed frame of campaign details."""
+        raise NotImplementedError
+
+    def summary(self):
+        """Returns the measures of the source to add to the result of a run."""
+        return {}
+
+    def get_missing_weeks(self, store, sheets, worksheet_name, details = False, read_chunk_weeks = sheets_loader.READ_CHUNK_WEEKS, read_workers = sheets_loader.READ_WORKERS):
+        """Finds every week of the history the warehouse does not have.
+
+        The existing worksheet is read and stored in the warehouse only
+        when the warehouse has no weeks of it yet.
+
+        Args:
+            store: The warehouse.Warehouse of the account or view.
+            sheets: A sheets_loader.GspreadBackend of the spreadsheet.
+            worksheet_name: The correct worksheet name on the spreadsheet.
+            details: Whether the worksheet has the details layout.
+            read_chunk_weeks: The week columns read per request.
+            read_workers: The number of chunks read side by side.
+        Returns:
+            A list of the missing week starting dates, in calendar order.
+        """
+        if store.last_week(worksheet_name) is None:
+            existing = sheets_loader.read_worksheet(
+                sheets, worksheet_name, details, chunk_weeks = read_chunk_weeks, max_workers = read_workers)
+            if existing is not None:
+                store.store_frame(worksheet_name, existing)
+        return calendar_index.missing_weeks(self.calendar, store.stored_weeks(worksheet_name))
+
+    def loop_adding_weeks_totals(self, weekly_data, previous_data, starting_date):
+        """Merges all the previous and newly extracted data.
+
+        Args:
+            weekly_data: A dictionary of week starting dates to extracted data.
+            previous_data: A typed DataFrame of the earlier weeks, or None.
+            starting_date: The date with which the data queries start.
+        Returns:
+            A typed pandas DataFrame of schema with the totals of every week.
+        """
+        return self.loop_adding_weeks(weekly_data, previous_data, starting_date, self.clean_weekly_totals)
+
+    def loop_adding_weeks_details(self, weekly_data, previous_data, starting_date):
+        """Merges all the previous and newly extracted data.
+
+        Args:
+            weekly_data: A dictionary of week starting dates to extracted data.
+            previous_data: A typed DataFrame of the earlier weeks, or None.
+            starting_date: The date with which the data queries start.
+        Returns:
+            A typed pandas DataFrame of schema with the campaigns of every week.
+        """
+        return self.loop_adding_weeks(weekly_data, previous_data, starting_date, self.clean_weekly_details)
+
+    def loop_adding_weeks(self, weekly_data, previous_data, starting_date, clean):
+        """Cleans the weeks of one worksheet with clean and merges them."""
+        weekly_frames = []
+        for start_date, extracted_data in weekly_data.items():
+            # Skip the weeks that only the other worksheet is missing
+            if start_date < starting_date:
+                continue
+            # Transform the extracted data
+            with instrumentation.stage('transform'):
+                weekly_frames.append(clean(extracted_data, start_date))
+        if not weekly_frames:
+            return previous_data
+        # Merge existing data with all new columns at once
+        with instrumentation.stage('merge'):
+            return accumulation.combine_frames(previous_data, weekly_frames)
+
+class Pipeline(object):
+    """The transform, load and upload stages of a run, each in its own thread.
+
+    The upload stage works on its own warehouse connection, so the weeks
+    keep being stored while a batch is uploaded; a batch that finishes while
+    another upload is still waiting joins it. The first error of a stage
+    stops the pipeline: the stages drop the items still queued and the next
+    hand-over raises the error.
+    """
+
+    def __init__(self, source, store, sheets, worksheets, missing_weeks, queue_weeks = QUEUE_WEEKS, load_batch_weeks = LOAD_BATCH_WEEKS, sharding = None):
+        """Starts the stages, waiting for weeks.
+
+        Args:
+            source: The SourceAdapter of the run.
+            store: The warehouse.Warehouse of the account or view.
+            sheets: A sheets_loader.GspreadBackend of the spreadsheet.
+            worksheets: The names of the totals and the details worksheets.
+            missing_weeks: The week starting dates missing from each worksheet.
+            queue_weeks: The weeks waiting between two stages.
+            load_batch_weeks: The weeks stored between two uploads, 0 to
+                only upload when finished.
+            sharding: A shards.Sharding of the details worksheet, or None.
+        """
+        self.source = source
+        self.store = store
+        # The upload reads while the load stage writes
+        self.upload_store = warehouse.Warehouse(store.path)
+        self.sheets = sheets
+        self.worksheets = worksheets
+        self.missing_weeks = [set(week_starts) for week_starts in missing_weeks]
+        self.load_batch_weeks = load_batch_weeks
+        self.sharding = sharding
+        self.transform_queue = queue.Queue(maxsize = queue_weeks)
+        self.load_queue = queue.Queue(maxsize = queue_weeks)
+        self.upload_queue = queue.Queue(maxsize = 1)
+        self.error = None
+        self.finishing = False
+        self.weeks = 0
+        self.unloaded_weeks = 0
+        self.cells = {worksheet_name: 0 for worksheet_name in worksheets}
+        self.threads = [
+            threading.Thread(target = self.work, args = (self.transform_queue, self.transform_week, self.load_queue)),
+            threading.Thread(target = self.work, args = (self.load_queue, self.load_week, self.upload_queue)),
+            threading.Thread(target = self.work, args = (self.upload_queue, self.upload, None))
+            ]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def put(self, stage_queue, item):
+        """Queues an item for a stage, waiting while the queue is full."""
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                stage_queue.put(item, timeout = 0.1)
+                return
+            except queue.Full:
+                continue
+
+    def add_week(self, start_date, extracted_data):
+        """Hands an extracted week to the transform stage; the on_week of extract_weeks."""
+        self.put(self.transform_queue, (start_date, extracted_data))
+
+    def work(self, inbox, handle, outbox):
+        """Runs one stage on the items of its queue until DONE.
+
+        The items are the arguments of handle; its results, unless None, are
+        the items of the next stage.
+        """
+        while True:
+            item = inbox.get()
+            if item is DONE:
+                break
+            if self.error is not None:
+                # Drain the queue so the stage before never blocks
+                continue
+            try:
+                result = handle(*item)
+                if outbox is not None and result is not None:
+                    self.put(outbox, result)
+            except BaseException as error:
+                if self.error is None:
+                    self.error = error
+        if outbox is not None:
+            outbox.put(DONE)
+
+    def transform_week(self, start_date, extracted_data):
+        """Cleans one week into the typed frame of every worksheet missing it."""
+        frames = []
+        for worksheet_name, loop_adding_weeks, missing_weeks in zip(
+            self.worksheets,
+            [self.source.loop_adding_weeks_totals, self.source.loop_adding_weeks_details],
+            self.missing_weeks
+            ):
+            # Skip the weeks that only the other worksheet is missing
+            if start_date not in missing_weeks:
+                continue
+            data = loop_adding_weeks({start_date: extracted_data}, None, start_date)
+            instrumentation.add_memory(worksheet_name, schema.memory_report(data))
+            frames.append((worksheet_name, data))
+        return (frames,)
+
+    def load_week(self, frames):
+        """Checkpoints one week in the warehouse.
+
+        Returns:
+            An upload for the upload stage when a batch of weeks is finished
+            and no upload is waiting yet, or None.
+        """
+        with instrumentation.stage('load'):
+            for worksheet_name, data in frames:
+                self.store.store_frame(worksheet_name, data, checkpoint = True)
+        self.weeks += 1
+        self.unloaded_weeks += 1
+        if self.load_batch_weeks and self.unloaded_weeks >= self.load_batch_weeks and self.upload_queue.empty():
+            self.unloaded_weeks = 0
+            return ()
+        return None
+
+    def upload(self):
+        """Uploads the worksheets of all the weeks stored so far."""
+        if self.finishing:
+            # The upload after the run covers these weeks
+            return None
+        with instrumentation.stage('load'):
+            cells = checkpoints.load_worksheets(self.upload_store, self.sheets, self.worksheets, self.sharding)
+        for worksheet_name, count in cells.items():
+            self.cells[worksheet_name] += count
+
+    def finish(self):
+        """Waits for the stages to store the weeks handed over so far.
+
+        Raises:
+            The first error of a stage.
+        """
+        self.finishing = True
+        self.transform_queue.put(DONE)
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+def run(source, gc, spreadsheet, worksheets, store, restart = False, load_only = False, queue_weeks = QUEUE_WEEKS, load_batch_weeks = LOAD_BATCH_WEEKS,
+        read_chunk_weeks = sheets_loader.READ_CHUNK_WEEKS, read_workers = sheets_loader.READ_WORKERS, sharding = None):
+    """Brings the worksheets of one account or view up to date.
+
+    Every week is checkpointed in the warehouse as soon as it is extracted,
+    so a run that stops halfway resumes after the last week it stored.
+
+    Args:
+        source: The SourceAdapter of the account or view.
+        gc: An authorized gspread client.
+        spreadsheet: The spreadsheet URL.
+        worksheets: The names of the totals and the details worksheets.
+        store: The warehouse.Warehouse of the account or view.
+        restart: Whether to drop the weeks stored since the last upload and
+            extract them again.
+        load_only: Whether to upload the stored weeks without extracting.
+        queue_weeks: The weeks waiting between two stages.
+        load_batch_weeks: The weeks stored between two uploads during the
+            extraction, 0 to upload once at the end.
+        read_chunk_weeks: The week columns read per request from an existing
+            worksheet.
+        read_workers: The number of chunks of a worksheet read side by side.
+        sharding: A shards.Sharding to split the details worksheet with, or
+            None to upload it whole.
+    Returns:
+        A dictionary of the number of new weeks, of the weeks resumed from
+        an earlier run, of the cells written per worksheet and the summary
+        of the source.
+    """
+    if restart:
+        for worksheet_name in worksheets:
+            store.discard_checkpoints(worksheet_name)
+    resumed_weeks = max(len(store.pending_weeks(worksheet_name)) for worksheet_name in worksheets)
+    sheets = sheets_loader.GspreadBackend(gc, spreadsheet)
+    weeks = 0
+    cells = {worksheet_name: 0 for worksheet_name in worksheets}
+    if not load_only:
+        with instrumentation.stage('extract'):
+            # Diff the calendar of the history against the warehouse
+            missing_weeks = [
+                source.get_missing_weeks(store, sheets, worksheets[0], False, read_chunk_weeks, read_workers),
+                source.get_missing_weeks(store, sheets, worksheets[1], True, read_chunk_weeks, read_workers)
+                ]
+        stages = Pipeline(source, store, sheets, worksheets, missing_weeks, queue_weeks, load_batch_weeks, sharding)
+        try:
+            with instrumentation.stage('extract'):
+                source.extract_weeks(missing_weeks[0], missing_weeks[1], stages.add_week)
+        except BaseException as error:
+            # Store the weeks extracted so far, even when the extraction
+            # failed, and raise the extraction error over a stage error,
+            # which stays in its context
+            try:
+                stages.finish()
+            except Exception:
+                raise error
+            raise
+        stages.finish()
+        weeks = stages.weeks
+        cells = stages.cells
+
+    with instrumentation.stage('load'):
+        for worksheet_name, count in checkpoints.load_worksheets(store, sheets, worksheets, sharding).items():
+            cells[worksheet_name] += count
+    result = {'weeks': weeks, 'resumed_weeks': resumed_weeks}
+    result.update(cells)
+    result.update(source.summary())
+    return result
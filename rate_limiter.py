@@ -0,0 +1,243 @@
+"""
+Adaptive rate limiting and concurrent fetching of API requests.
+
+Every API gets one RateLimiter shared by all threads: a token bucket that
+slows down on rate-limit errors and high usage headers, retries with
+jittered exponential backoff, and speeds up again with every success.
+"""
+
+
+#Import libraries
+import collections
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Define variables
+FB_RATE_LIMIT_CODES = [4, 17, 32, 613] + list(range(80000, 80015))
+GA_RATE_LIMIT_REASONS = ['rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded']
+HIGH_USAGE_PERCENT = 75
+
+class RateLimiter(object):
+    """A thread-safe, adaptive token bucket for the requests of one API."""
+
+    def __init__(self, name, rate, burst = 1, min_rate = 0.05, max_retries = 5, base_delay = 1.0, max_delay = 64.0):
+        """Creates a full bucket.
+
+        Args:
+            name: The API name, for reports.
+            rate: The highest number of requests per second.
+            burst: The number of requests that may go at once.
+            min_rate: The lowest number of requests per second to slow down to.
+            max_retries: The retries of a rate-limited request before giving up.
+            base_delay: The backoff of the first retry, in seconds.
+            max_delay: The longest backoff, in seconds.
+        """
+        self.name = name
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min(min_rate, rate)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.requests = 0
+        self.retries = 0
+        self.usage_percent = None
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request may be sent."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self.requests += 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def slow_down(self, pause = 0):
+        """Halves the rate, and optionally pauses all requests.
+
+        Args:
+            pause: The seconds to send no requests at all.
+        """
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.paused_until = max(self.paused_until, time.monotonic() + pause)
+
+    def speed_up(self):
+        """Raises the rate a little, up to the highest rate."""
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate * 1.1)
+
+    def observe_usage(self, percent, regain_seconds = 0):
+        """Adapts the rate to the quota usage an API reports.
+
+        Args:
+            percent: The highest usage of any quota, in percent.
+            regain_seconds: The seconds until a blocked quota is available again.
+        """
+        self.usage_percent = percent
+        if regain_seconds > 0:
+            self.slow_down(pause = regain_seconds)
+        elif percent >= HIGH_USAGE_PERCENT:
+            with self.lock:
+                self.rate = max(self.min_rate, self.max_rate * (100 - min(percent, 99)) / (100 - HIGH_USAGE_PERCENT))
+
+    def backoff_delay(self, attempt):
+        """Draws the jittered exponential backoff of a retry.
+
+        Args:
+            attempt: The number of the retry, starting at 0.
+        Returns:
+            A random delay in seconds, up to base_delay * 2 ** attempt.
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, function, is_rate_limited):
+        """Sends a request through the limiter, retrying rate-limited ones.
+
+        Args:
+            function: A function without arguments that sends the request.
+            is_rate_limited: A function telling if an exception is a
+                rate-limit or quota error worth retrying.
+        Returns:
+            The result of the function.
+        """
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                result = function()
+            except Exception as error:
+                if attempt >= self.max_retries or not is_rate_limited(error):
+                    raise
+                with self.lock:
+                    self.retries += 1
+                self.slow_down()
+                time.sleep(self.backoff_delay(attempt))
+                attempt += 1
+                continue
+            self.speed_up()
+            return result
+
+def ga_rate_limited(error):
+    """Tells if an Analytics Reporting API error is worth retrying.
+
+    Args:
+        error: An exception, like googleapiclient.errors.HttpError.
+    Returns:
+        True for 429 and 5xx errors, and 403 quota errors.
+    """
+    status = int(getattr(getattr(error, 'resp', None), 'status', 0) or 0)
+    if status == 429 or status >= 500:
+        return True
+    if status == 403:
+        content = getattr(error, 'content', b'')
+        if isinstance(content, bytes):
+            content = content.decode('utf-8', 'replace')
+        return any(reason in content for reason in GA_RATE_LIMIT_REASONS)
+    return False
+
+def fb_rate_limited(error):
+    """Tells if a Graph API error is worth retrying.
+
+    Args:
+        error: An exception, like facebookads.exceptions.FacebookRequestError.
+    Returns:
+        True for the throttling error codes and HTTP 429.
+    """
+    if hasattr(error, 'api_error_code') and error.api_error_code() in FB_RATE_LIMIT_CODES:
+        return True
+    return hasattr(error, 'http_status') and error.http_status() == 429
+
+def facebook_usage(headers):
+    """Reads the quota usage out of the Graph API usage headers.
+
+    Args:
+        headers: A dictionary of the response headers.
+    Returns:
+        The highest usage in percent and the seconds until a blocked quota
+        is available again.
+    """
+    headers = {name.lower(): value for name, value in (headers or {}).items()}
+    percents = [0]
+    regain_seconds = 0
+    for name in ['x-app-usage', 'x-ad-account-usage', 'x-business-use-case-usage']:
+        if name not in headers:
+            continue
+        try:
+            usage = json.loads(headers[name])
+        except ValueError:
+            continue
+        if name == 'x-business-use-case-usage':
+            usages = [entry for entries in usage.values() for entry in entries]
+        else:
+            usages = [usage]
+        for entry in usages:
+            percents.extend(
+                float(value) for key, value in entry.items()
+                if key in ['call_count', 'total_cputime', 'total_time', 'acc_id_util_pct'])
+            regain_seconds = max(regain_seconds, 60 * float(entry.get('estimated_time_to_regain_access', 0)))
+    return max(percents), regain_seconds
+
+def iter_concurrently(function, items, max_workers, max_ahead = None):
+    """Calls a function on every item in a thread pool, handing out the results as they are ready.
+
+    The items are submitted through a sliding window, so a slow consumer
+    holds back the calls instead of collecting all the results in memory.
+
+    Args:
+        function: A function of one item.
+        items: A list of items.
+        max_workers: The number of threads; 1 calls the function in this thread.
+        max_ahead: The results that may wait for the consumer besides the
+            running calls, max_workers by default.
+    Yields:
+        The results, in the order of the items; a result is yielded as soon
+        as it and all the results before it are ready.
+    """
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        for item in items:
+            yield function(item)
+        return
+    if max_ahead is None:
+        max_ahead = max_workers
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers = min(max_workers, len(items))) as executor:
+        try:
+            for item in items:
+                if len(pending) >= max_workers + max_ahead:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(function, item))
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # A failed call or a consumer that stopped drops the calls not started yet
+            for future in pending:
+                future.cancel()
+
+def fetch_concurrently(function, items, max_workers):
+    """Calls a function on every item in a thread pool.
+
+    Args:
+        function: A function of one item.
+        items: A list of items.
+        max_workers: The number of threads; 1 calls the function in this thread.
+    Returns:
+        The list of the results, in the order of the items.
+    """
+    return list(iter_concurrently(function, items, max_workers))
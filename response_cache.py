@@ -0,0 +1,253 @@
+"""
+Persistent on-disk cache of the Google Analytics and Facebook API responses.
+
+Responses are keyed by a hash of the normalized request. Weeks that closed
+more than the settle period ago do not change anymore and are cached for
+ever, more recent weeks expire after a TTL. The least recently used
+responses are evicted when the cache grows over its size limit, tracked as
+a running total of the response sizes.
+
+Usage:
+    python response_cache.py [--config config.json] [--path api_cache.sqlite] stats
+    python response_cache.py list
+    python response_cache.py purge [--expired]
+"""
+
+
+#Import libraries
+import argparse
+import datetime as dt
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+# Define variables
+CONFIG_PATH = '/your/path/to/file/config.json'
+CACHE_PATH = 'api_cache.sqlite'
+SETTLE_DAYS = 7
+TTL_HOURS = 12
+MAX_MB = 100
+# An eviction frees the cache down to this share of its size limit, so the
+# next puts do not evict again right away
+LOW_WATER = 0.9
+
+def request_key(request):
+    """Hashes a normalized request.
+
+    Args:
+        request: A JSON serializable description of the request.
+    Returns:
+        The hexadecimal SHA-256 of the request with sorted keys.
+    """
+    normalized = json.dumps(request, sort_keys = True, separators = (',', ':'), default = str)
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+class ResponseCache(object):
+    """A SQLite cache of API responses with immutable-week semantics."""
+
+    def __init__(self, path = CACHE_PATH, settle_days = SETTLE_DAYS, ttl_hours = TTL_HOURS, max_mb = MAX_MB):
+        """Opens or creates the cache.
+
+        Args:
+            path: The SQLite file of the cache.
+            settle_days: The days after the end of a week until its data is final.
+            ttl_hours: The hours to keep the responses of more recent weeks.
+            max_mb: The size limit of the cached responses, in megabytes.
+        """
+        self.path = path
+        self.settle_days = settle_days
+        self.ttl_seconds = ttl_hours * 3600
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        # The extraction threads share the connection, one at a time.
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, timeout = 30, check_same_thread = False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, request TEXT, response TEXT, size INTEGER, '
+            'ending_date TEXT, created REAL, accessed REAL, expires REAL)'
+            )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.connection.commit()
+        # The running total of the response sizes, summed up once
+        self.total_bytes = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def get(self, request):
+        """Looks up the cached response of a request.
+
+        Args:
+            request: A JSON serializable description of the request.
+        Returns:
+            The cached response, or None if missing or expired.
+        """
+        with self.lock:
+            key = request_key(request)
+            row = self.connection.execute('SELECT response, expires FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] < time.time()):
+                return None
+            self.connection.execute('UPDATE responses SET accessed = ? WHERE key = ?', (time.time(), key))
+            self.connection.commit()
+            return json.loads(row[0])
+
+    def put(self, request, ending_date, response):
+        """Stores the response of a request.
+
+        Args:
+            request: A JSON serializable description of the request.
+            ending_date: The last date the request covers.
+            response: The JSON serializable response.
+        """
+        with self.lock:
+            now = time.time()
+            if ending_date + dt.timedelta(days = self.settle_days) < dt.date.today():
+                expires = None
+            else:
+                expires = now + self.ttl_seconds
+            key = request_key(request)
+            request_text = json.dumps(request, sort_keys = True, default = str)
+            response_text = json.dumps(response)
+            replaced = self.connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, request_text, response_text, len(response_text), str(ending_date), now, now, expires)
+                )
+            self.connection.commit()
+            self.total_bytes += len(response_text) - (replaced[0] if replaced else 0)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def read_through(self, request, ending_date, fetch):
+        """Returns the cached response of a request, or fetches and stores it.
+
+        Args:
+            request: A JSON serializable description of the request.
+            ending_date: The last date the request covers.
+            fetch: A function without arguments that queries the API.
+        Returns:
+            The response of the request.
+        """
+        response = self.get(request)
+        if response is None:
+            response = fetch()
+            self.put(request, ending_date, response)
+        return response
+
+    def evict(self):
+        """Deletes expired responses, then the least recently used down to LOW_WATER of the size limit.
+
+        put only calls it once the running total passes the size limit, and
+        the total is summed up again here, with the responses other
+        processes stored since.
+        """
+        with self.lock:
+            self.connection.execute('DELETE FROM responses WHERE expires < ?', (time.time(),))
+            total = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+            if total > self.max_bytes:
+                evicted = []
+                for key, size in self.connection.execute('SELECT key, size FROM responses ORDER BY accessed'):
+                    if total <= self.max_bytes * LOW_WATER:
+                        break
+                    evicted.append((key,))
+                    total -= size
+                self.connection.executemany('DELETE FROM responses WHERE key = ?', evicted)
+            self.connection.commit()
+            self.total_bytes = total
+
+    def stats(self):
+        """Summarizes the cache content.
+
+        Returns:
+            A dictionary of the number of responses, permanent, expiring and
+            expired ones, and their total size in bytes.
+        """
+        with self.lock:
+            now = time.time()
+            count, size, permanent, expired = self.connection.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0), '
+                'COALESCE(SUM(expires IS NULL), 0), COALESCE(SUM(expires < ?), 0) FROM responses',
+                (now,)
+                ).fetchone()
+            return {
+                'responses': count,
+                'permanent': permanent,
+                'expiring': count - permanent - expired,
+                'expired': expired,
+                'bytes': size
+                }
+
+    def entries(self):
+        """Lists the cached requests, most recently used first.
+
+        Returns:
+            A list of (request, ending date, size, expiry timestamp or None) tuples.
+        """
+        with self.lock:
+            return self.connection.execute(
+                'SELECT request, ending_date, size, expires FROM responses ORDER BY accessed DESC'
+                ).fetchall()
+
+    def purge(self, expired_only = False):
+        """Deletes cached responses.
+
+        Args:
+            expired_only: Whether to keep the responses that did not expire yet.
+        Returns:
+            The number of deleted responses.
+        """
+        with self.lock:
+            if expired_only:
+                cursor = self.connection.execute('DELETE FROM responses WHERE expires < ?', (time.time(),))
+            else:
+                cursor = self.connection.execute('DELETE FROM responses')
+            self.connection.commit()
+            self.total_bytes = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+            return cursor.rowcount
+
+def from_config(config):
+    """Opens the cache with the settings of a config.json.
+
+    Args:
+        config: The loaded config.json dictionary.
+    Returns:
+        A ResponseCache.
+    """
+    return ResponseCache(
+        path = config.get('cache_path', CACHE_PATH),
+        settle_days = config.get('cache_settle_days', SETTLE_DAYS),
+        ttl_hours = config.get('cache_ttl_hours', TTL_HOURS),
+        max_mb = config.get('cache_max_mb', MAX_MB)
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Inspect or purge the API response cache.')
+    parser.add_argument('--config', default = CONFIG_PATH, help = 'the config.json with the cache settings')
+    parser.add_argument('--path', help = 'the SQLite file of the cache, cache_path of the config by default')
+    subparsers = parser.add_subparsers(dest = 'command')
+    subparsers.required = True
+    subparsers.add_parser('stats', help = 'count the cached responses')
+    subparsers.add_parser('list', help = 'list the cached requests')
+    purge_parser = subparsers.add_parser('purge', help = 'delete cached responses')
+    purge_parser.add_argument('--expired', action = 'store_true', help = 'only delete expired responses')
+    args = parser.parse_args()
+
+    with open(args.config) as config_file:
+        config = json.load(config_file)
+    if args.path is not None:
+        config['cache_path'] = args.path
+    cache = from_config(config)
+    if args.command == 'stats':
+        for name, value in cache.stats().items():
+            print('{}: {}'.format(name, value))
+    elif args.command == 'list':
+        for request, ending_date, size, expires in cache.entries():
+            if expires is None:
+                expiry = 'never'
+            else:
+                expiry = dt.datetime.fromtimestamp(expires).strftime('%Y-%m-%d %H:%M')
+            print('{}\t{} bytes\texpires {}\t{}'.format(ending_date, size, expiry, request))
+    else:
+        print('{} responses deleted'.format(cache.purge(expired_only = args.expired)))
+
+if __name__ == "__main__":
+    main()
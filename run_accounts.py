@@ -0,0 +1,189 @@
+"""
+Runs the weekly downloads of many Facebook ad accounts and Google Analytics
+views in a process pool.
+
+The accounts and views come from config.json:
+
+    "runner_processes": 4,
+    "fb_ad_accounts": [
+        {"account_id": "act_<id>", "spreadsheet": "<url>",
+         "worksheets": ["facebook_totals", "facebook_details"]}],
+    "ga_views": [
+        {"view_id": "<id>", "spreadsheet": "<url>",
+         "worksheets": ["ga_totals", "ga_details"]}]
+
+Every worker process authorizes once and reuses its sessions for all the
+accounts it gets. A failing account does not stop the others; the run
+summary lists the outcome of each.
+
+Every account resumes after the weeks it checkpointed in an earlier run,
+unless --restart drops them; --load-only uploads them without extracting.
+
+Usage:
+    python run_accounts.py [--processes 4] [--summary run_summary.json]
+        [--resume | --restart] [--load-only]
+"""
+
+
+#Import libraries
+import argparse
+import functools
+import json
+import multiprocessing
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+import checkpoints
+import instrumentation
+import warehouse
+
+# Define variables
+SUMMARY_PATH = 'run_summary.json'
+SESSIONS = {}
+
+def get_session(name):
+    """Authorizes an API once per worker process.
+
+    Args:
+        name: 'drive', 'google_analytics' or 'facebook'.
+    Returns:
+        The authorized session object.
+    """
+    if name not in SESSIONS:
+        if name == 'drive':
+            import ga_weekly_download
+            SESSIONS[name] = ga_weekly_download.initialize_drive()
+        elif name == 'google_analytics':
+            import ga_weekly_download
+            SESSIONS[name] = ga_weekly_download.initialize_analyticsreporting()
+        else:
+            import fb_weekly_download
+            SESSIONS[name] = fb_weekly_download.initialize_facebook()
+            fb_weekly_download.FacebookAdsApi.set_default_api(SESSIONS[name])
+    return SESSIONS[name]
+
+def list_jobs(config):
+    """Lists the accounts and views of a config.json.
+
+    Args:
+        config: The loaded config.json dictionary.
+    Returns:
+        A list of (source, target) tuples, the target being the account's
+        dictionary from the config.
+    """
+    jobs = [('facebook', target) for target in config.get('fb_ad_accounts', [])]
+    jobs += [('google_analytics', target) for target in config.get('ga_views', [])]
+    return jobs
+
+def job_account(source, target):
+    """Names the account or view of a job."""
+    if source == 'facebook':
+        return target['account_id']
+    return target['view_id']
+
+def run_job(job, restart = False, load_only = False):
+    """Brings the worksheets of one account or view up to date.
+
+    Args:
+        job: A (source, target) tuple of list_jobs.
+        restart: Whether to drop the weeks checkpointed since the last upload.
+        load_only: Whether to upload the checkpointed weeks without extracting.
+    Returns:
+        A dictionary of the outcome, with the error if the job failed.
+    """
+    source, target = job
+    account = job_account(source, target)
+    started = time.time()
+    result = {'source': source, 'account': account}
+    if source == 'facebook':
+        import fb_weekly_download as script
+    else:
+        import ga_weekly_download as script
+    report = instrumentation.start(script.__name__, account, [script.LIMITER])
+    try:
+        if 'warehouse_path' in target:
+            store = warehouse.Warehouse(path = target['warehouse_path'])
+        else:
+            store = warehouse.from_config(script.CONFIG, account)
+        with instrumentation.stage('auth'):
+            gc = get_session('drive')
+            session = get_session(source)
+        if source == 'facebook':
+            result.update(script.run(
+                script.AdAccount(account),
+                gc,
+                target['spreadsheet'],
+                target.get('worksheets', script.WORKSHEETS),
+                store,
+                restart = restart,
+                load_only = load_only
+                ))
+        else:
+            result.update(script.run(
+                session,
+                gc,
+                account,
+                target['spreadsheet'],
+                target.get('worksheets', script.WORKSHEETS),
+                store,
+                restart = restart,
+                load_only = load_only
+                ))
+        result['status'] = 'ok'
+    except Exception as error:
+        result['status'] = 'failed'
+        result['error'] = repr(error)
+        result['traceback'] = traceback.format_exc()
+    result['report'] = report.to_dict()
+    result['seconds'] = round(time.time() - started, 3)
+    return result
+
+def run_all(jobs, processes, restart = False, load_only = False):
+    """Shards the jobs across a process pool.
+
+    Args:
+        jobs: A list of (source, target) tuples of list_jobs.
+        processes: The number of worker processes.
+        restart: Whether to drop the weeks checkpointed since the last upload.
+        load_only: Whether to upload the checkpointed weeks without extracting.
+    Returns:
+        The list of the job outcomes, in the order of the jobs.
+    """
+    job_runner = functools.partial(run_job, restart = restart, load_only = load_only)
+    if processes <= 1:
+        return [job_runner(job) for job in jobs]
+    # Spawned workers open their own SQLite and HTTP connections.
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers = processes, mp_context = context) as executor:
+        return list(executor.map(job_runner, jobs))
+
+def main():
+    import ga_weekly_download
+    config = ga_weekly_download.CONFIG
+    parser = argparse.ArgumentParser(description = 'Run the weekly downloads of all configured accounts and views.')
+    parser.add_argument('--processes', type = int, default = config.get('runner_processes', multiprocessing.cpu_count()))
+    parser.add_argument('--summary', default = SUMMARY_PATH, help = 'the JSON file of the run summary')
+    checkpoints.add_arguments(parser)
+    args = parser.parse_args()
+
+    started = time.time()
+    results = run_all(list_jobs(config), args.processes, restart = args.restart, load_only = args.load_only)
+    summary = {
+        'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started)),
+        'seconds': round(time.time() - started, 3),
+        'ok': sum(result['status'] == 'ok' for result in results),
+        'failed': sum(result['status'] == 'failed' for result in results),
+        'jobs': results
+        }
+    with open(args.summary, 'w') as summary_file:
+        json.dump(summary, summary_file, indent = 2)
+    instrumentation.write_reports([result['report'] for result in results], config)
+    for result in results:
+        print('{:<18} {:<24} {:<7} {:>8.1f}s {}'.format(
+            result['source'], result['account'], result['status'], result['seconds'], result.get('error', '')))
+    print('{} ok, {} failed in {:.1f}s'.format(summary['ok'], summary['failed'], summary['seconds']))
+    if summary['failed']:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
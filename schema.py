@@ -0,0 +1,191 @@
+"""
+Compact dtypes of the weekly frames.
+
+The APIs and g2d.download return every metric as a string, and the details
+layout mixes campaign names and numbers in one object column. The frames
+between the transform and the warehouse are kept typed instead: one row per
+week and campaign, the week and campaign as categoricals and every metric in
+its own column of an explicit compact dtype.
+
+The nullable dtypes are used so a metric missing in a week or for a campaign
+stays a missing value instead of turning the column into float64.
+"""
+
+
+#Import libraries
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+# Define variables
+WEEK = 'week'
+CAMPAIGN = 'campaign'
+# The Facebook campaign IDs of the details, the warehouse keys campaigns by them
+CAMPAIGN_ID = 'campaign_id'
+KEY_COLUMNS = [WEEK, CAMPAIGN, CAMPAIGN_ID]
+# Counts fit in 32 bits per week, impressions may not; money keeps its cents
+# in 64 bits, ratios need no more than float32.
+METRIC_DTYPES = {
+    'ga:impressions': 'Int64',
+    'ga:adClicks': 'Int32',
+    'ga:adCost': 'Float64',
+    'ga:sessions': 'Int32',
+    'ga:users': 'Int32',
+    'ga:goal6Completions': 'Int32',
+    'ga:transactions': 'Int32',
+    'ga:transactionRevenue': 'Float64',
+    'ga:bounceRate': 'Float32',
+    'ga:CTR': 'Float32',
+    'ga:CPC': 'Float32',
+    'impressions': 'Int64',
+    'clicks': 'Int32',
+    'reach': 'Int32',
+    'spend': 'Float64',
+    'frequency': 'Float32',
+    'ctr': 'Float32',
+    'cpc': 'Float32',
+    'cpm': 'Float32'
+    }
+DEFAULT_DTYPE = 'Float64'
+# The metrics in money, summed to the cent
+MONEY_METRICS = ['ga:adCost', 'ga:transactionRevenue', 'spend']
+
+def metric_dtype(metric):
+    """Looks up the dtype of a metric.
+
+    Args:
+        metric: A metric name, like 'ga:adClicks' or 'spend'.
+    Returns:
+        The pandas dtype name, DEFAULT_DTYPE for unknown metrics.
+    """
+    return METRIC_DTYPES.get(metric, DEFAULT_DTYPE)
+
+def metric_columns(data):
+    """Lists the metric columns of a typed frame, in their order."""
+    return [column for column in data.columns if column not in KEY_COLUMNS]
+
+def typed_column(values, dtype):
+    """Converts the values of one metric to its dtype.
+
+    Args:
+        values: A pandas Series of numbers or strings; empty strings are missing.
+        dtype: The pandas dtype name.
+    Returns:
+        The pandas Series in the dtype.
+    """
+    if values.dtype == dtype:
+        return values
+    if not pd.api.types.is_numeric_dtype(values.dtype):
+        try:
+            # astype parses like float(), pd.to_numeric may be off in the last digit
+            values = values.astype(object).replace('', np.nan).astype(float)
+        except (TypeError, ValueError):
+            values = pd.to_numeric(values, errors = 'coerce')
+    if dtype.startswith('Int'):
+        # Whole numbers sent as '12.0' still count
+        values = values.round()
+    return values.astype(dtype)
+
+def metric_array(values, dtype):
+    """Converts float64 values of one metric to its dtype without a Series.
+
+    Args:
+        values: A float64 NumPy array, NaN for missing values.
+        dtype: The pandas dtype name.
+    Returns:
+        The pandas array in the dtype.
+    """
+    missing = np.isnan(values)
+    numpy_dtype = np.dtype(dtype.lower())
+    if dtype.startswith('Int'):
+        return pd.arrays.IntegerArray(np.where(missing, 0, np.round(values)).astype(numpy_dtype), missing)
+    return pd.arrays.FloatingArray(np.where(missing, 0, values).astype(numpy_dtype), missing)
+
+def key_array(names, numbers):
+    """Builds a week or campaign categorical from unique names and the numbers of the rows."""
+    return pd.Categorical.from_codes(numbers, categories = pd.Index(names, dtype = object))
+
+def categorical(values):
+    """Stores the week or campaign names once, in the order they first appear."""
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.values
+    return pd.Categorical(values, categories = pd.unique(values.dropna()))
+
+def typed_frame(data):
+    """Casts a frame of weeks, campaigns and metrics to the compact dtypes.
+
+    Args:
+        data: A pandas DataFrame with a 'week' column, a 'campaign' column
+            for the details, and one column per metric.
+    Returns:
+        The typed pandas DataFrame, with a default index.
+    """
+    columns = {}
+    for column in data.columns:
+        if column in KEY_COLUMNS:
+            columns[column] = categorical(data[column])
+        else:
+            columns[column] = typed_column(data[column], metric_dtype(column)).values
+    return pd.DataFrame(columns, index = pd.RangeIndex(len(data)))
+
+def concat_frames(frames):
+    """Concatenates typed frames without losing their dtypes.
+
+    pd.concat turns categoricals with different categories into objects, so
+    the categories are united first.
+
+    Args:
+        frames: A list of typed pandas DataFrames.
+    Returns:
+        The typed pandas DataFrame of all the rows, in the order of the frames.
+    """
+    if len(frames) == 1:
+        return frames[0]
+    combined = pd.concat(frames, ignore_index = True, sort = False)
+    for key in KEY_COLUMNS:
+        if key in combined.columns:
+            if all(key in frame.columns for frame in frames):
+                # Categories united before may come back as strings, not objects
+                combined[key] = union_categoricals([
+                    frame[key].cat.set_categories(frame[key].cat.categories.astype(object)) for frame in frames])
+            else:
+                combined[key] = categorical(combined[key].astype(object))
+    for metric in metric_columns(combined):
+        combined[metric] = typed_column(combined[metric], metric_dtype(metric))
+    return combined
+
+def python_values(values):
+    """Converts a typed column to the Python values to store.
+
+    Args:
+        values: A pandas Series of a typed frame.
+    Returns:
+        A list of ints, floats or strings, None for missing values.
+    """
+    if values.dtype == 'Float32':
+        # The shortest repr of a float32 is the number that was parsed,
+        # float() of the float32 itself would add digits.
+        missing = values.isna().to_numpy()
+        return [
+            None if is_missing else float(str(value))
+            for is_missing, value in zip(missing, values.to_numpy(dtype = np.float32, na_value = np.nan))]
+    return values.to_numpy(dtype = object, na_value = None).tolist()
+
+def memory_report(data):
+    """Measures what the compact dtypes save on a typed frame.
+
+    Args:
+        data: A typed pandas DataFrame.
+    Returns:
+        A dictionary of the rows, the bytes of the frame, the bytes of the
+        same values as object strings, like g2d.download returns them, and
+        the percentage saved.
+    """
+    typed_bytes = int(data.memory_usage(index = False, deep = True).sum())
+    untyped_bytes = int(data.astype(str).astype(object).memory_usage(index = False, deep = True).sum())
+    return {
+        'rows': len(data),
+        'bytes': typed_bytes,
+        'untyped_bytes': untyped_bytes,
+        'saved_percent': round(100 * (1 - typed_bytes / untyped_bytes), 1) if untyped_bytes else 0.0
+        }
@@ -0,0 +1,205 @@
+"""
+Sharding of the details worksheets across worksheets and spreadsheets.
+
+A details worksheet grows by a column every week and by (metrics + 1) rows
+for every new campaign, towards the cap of 10 million cells per spreadsheet,
+and every upload reads its layout again. Its weeks are split into shards
+instead, each a worksheet of its own: by ISO year or quarter when
+configured, and in any case into a new shard before a shard would pass
+max_cells. A new shard goes to the next of the extra spreadsheets once its
+spreadsheet is full.
+
+The manifest in the warehouse keeps the spreadsheet, worksheet and weeks of
+every shard, so an upload writes only the shards with new weeks, side by
+side. An existing worksheet becomes the first shard as it is.
+"""
+
+
+#Import libraries
+import rate_limiter
+import sheets_loader
+import warehouse
+
+# Define variables
+SHARD_BY = None
+MAX_CELLS = 5000000
+SPREADSHEET_CELLS = 10000000
+WORKERS = 4
+
+def shard_period(week, shard_by):
+    """Names the period of a week that one shard holds.
+
+    Args:
+        week: An (iso_year, iso_week) tuple.
+        shard_by: 'year', 'quarter' or None.
+    Returns:
+        A name like '2017' or '2017_q3', or '' when not sharding by period.
+    """
+    iso_year, iso_week = week
+    if shard_by == 'year':
+        return str(iso_year)
+    if shard_by == 'quarter':
+        # The 53rd week of a long year stays in the fourth quarter
+        return '{}_q{}'.format(iso_year, min(4, (iso_week - 1) // 13 + 1))
+    return ''
+
+def shard_cells(rows, weeks):
+    """Counts the cells of a shard, headers and row names included."""
+    return (rows + 1) * (weeks + 1)
+
+class Sharding(object):
+    """Splits the weeks of the details worksheets into shards and uploads them."""
+
+    def __init__(self, shard_by = SHARD_BY, max_cells = MAX_CELLS, spreadsheets = (), max_workers = WORKERS):
+        """Sets up the sharding.
+
+        Args:
+            shard_by: 'year' or 'quarter' to start a shard per period, or
+                None to only start one near max_cells.
+            max_cells: The cells a shard may take, or None for no limit.
+            spreadsheets: The URLs of the spreadsheets for the shards that
+                do not fit in the spreadsheet of the run.
+            max_workers: The number of shards uploaded side by side.
+        """
+        if shard_by not in (None, 'year', 'quarter'):
+            raise ValueError("shard_by is 'year', 'quarter' or None, not {!r}".format(shard_by))
+        self.shard_by = shard_by
+        self.max_cells = max_cells
+        self.spreadsheets = [''] + list(spreadsheets)
+        self.max_workers = max_workers
+
+    def plan(self, manifest, worksheet_name, weeks, rows):
+        """Assigns every week to a shard, starting shards where needed.
+
+        The cells are estimated with all the rows of the worksheet in every
+        shard, so a shard never passes max_cells, if set.
+
+        Args:
+            manifest: The shards of Warehouse.shards.
+            worksheet_name: The name of the unsharded worksheet.
+            weeks: The (iso_year, iso_week) tuples of the worksheet, in
+                calendar order.
+            rows: The rows of the worksheet.
+        Returns:
+            The shards, with the list of their weeks under 'weeks'.
+        """
+        shards = [dict(shard, weeks = []) for shard in manifest]
+        for week in weeks:
+            shard = next((shard for shard in shards if shard['first'] <= week <= shard['last']), None)
+            if shard is None:
+                # The shard before the week, or the first one
+                before = [shard for shard in shards if shard['first'] <= week]
+                shard = before[-1] if before else (shards[0] if shards else None)
+                if (shard is None
+                        or shard['period'] != shard_period(week, self.shard_by)
+                        or (self.max_cells is not None and shard_cells(rows, len(shard['weeks']) + 1) > self.max_cells)
+                        or self.spills(shards, shard['spreadsheet'], rows, rows + 1)):
+                    shard = self.new_shard(shards, worksheet_name, week, rows)
+                    shards.append(shard)
+                    shards.sort(key = lambda shard: shard['first'])
+                shard['first'] = min(shard['first'], week)
+                shard['last'] = max(shard['last'], week)
+            shard['weeks'].append(week)
+        return shards
+
+    def spills(self, shards, spreadsheet, rows, cells):
+        """Tells whether more cells go to the next spreadsheet instead.
+
+        Args:
+            shards: The shards planned so far.
+            spreadsheet: The URL of the spreadsheet, '' for the one of the run.
+            rows: The rows of the worksheet.
+            cells: The cells to add.
+        Returns:
+            True when the spreadsheet would pass SPREADSHEET_CELLS and a
+            next spreadsheet is configured.
+        """
+        position = self.spreadsheets.index(spreadsheet) if spreadsheet in self.spreadsheets else 0
+        used = sum(shard_cells(rows, len(shard['weeks'])) for shard in shards if shard['spreadsheet'] == spreadsheet)
+        return position + 1 < len(self.spreadsheets) and used + cells > SPREADSHEET_CELLS
+
+    def new_shard(self, shards, worksheet_name, week, rows):
+        """Starts a shard of a week in the first spreadsheet it fits in.
+
+        Args:
+            shards: The shards planned so far.
+            worksheet_name: The name of the unsharded worksheet.
+            week: The (iso_year, iso_week) tuple of its first week.
+            rows: The rows of the worksheet.
+        Returns:
+            A shard without weeks.
+        """
+        period = shard_period(week, self.shard_by)
+        spreadsheet = shards[-1]['spreadsheet'] if shards else ''
+        while self.spills(shards, spreadsheet, rows, shard_cells(rows, 1)):
+            spreadsheet = self.spreadsheets[self.spreadsheets.index(spreadsheet) + 1]
+        taken = set(shard['worksheet'] for shard in shards if shard['spreadsheet'] == spreadsheet)
+        name = '_'.join(part for part in [worksheet_name, period] if part)
+        number = 1
+        while name in taken or (number == 1 and period == '' and shards):
+            number += 1
+            name = '_'.join(part for part in [worksheet_name, period, str(number)] if part)
+        return {'spreadsheet': spreadsheet, 'worksheet': name, 'period': period, 'first': week, 'last': week, 'weeks': []}
+
+    def load(self, store, sheets, worksheet_name, pending_weeks):
+        """Uploads the shards of a details worksheet that have new weeks.
+
+        The worksheet is pivoted from the first pending week, or the first
+        week of no shard yet, on.
+
+        Args:
+            store: The warehouse.Warehouse of the account or view.
+            sheets: A sheets_loader.GspreadBackend of the spreadsheet of the run.
+            worksheet_name: The name of the unsharded worksheet.
+            pending_weeks: The (iso_year, iso_week) tuples not uploaded yet.
+        Returns:
+            The number of cells written.
+        """
+        manifest = store.shards(worksheet_name)
+        if not manifest:
+            # The worksheet written before the sharding is the first shard
+            header, _ = sheets.get_layout(worksheet_name)
+            weeks = [warehouse.parse_week(str(week)) for week in header[1:] if str(week) != '']
+            if weeks:
+                manifest = [{'spreadsheet': '', 'worksheet': worksheet_name, 'period': '', 'first': min(weeks), 'last': max(weeks)}]
+        weeks = [warehouse.parse_week(label) for label in store.week_labels(worksheet_name)]
+        new_weeks = list(pending_weeks) + [
+            week for week in weeks
+            if not any(shard['first'] <= week <= shard['last'] for shard in manifest)]
+        if not new_weeks:
+            return 0
+        data = store.details_frame(worksheet_name, min(new_weeks))
+        shards = self.plan(manifest, worksheet_name, weeks, store.row_count(worksheet_name))
+        store.save_shards(worksheet_name, shards)
+        known = set((shard['spreadsheet'], shard['worksheet']) for shard in manifest)
+        pending_weeks = set(pending_weeks)
+        changed = [
+            shard for shard in shards
+            if (shard['spreadsheet'], shard['worksheet']) not in known or pending_weeks.intersection(shard['weeks'])]
+        backends = [sheets.open(shard['spreadsheet']) for shard in changed]
+
+        def upload(number):
+            shard = changed[number]
+            shard_data = data[[warehouse.week_label(*week) for week in shard['weeks']]].dropna(how = 'all')
+            return sheets_loader.upload_delta(backends[number], shard['worksheet'], shard_data)
+
+        return sum(rate_limiter.fetch_concurrently(upload, list(range(len(changed))), self.max_workers))
+
+def from_config(config):
+    """Sets up the sharding with the settings of a config.json.
+
+    Args:
+        config: The loaded config.json dictionary.
+    Returns:
+        A Sharding, or None when neither sheets_shard_by nor
+        sheets_shard_max_cells is set and the details worksheet is uploaded
+        whole.
+    """
+    if config.get('sheets_shard_by', SHARD_BY) is None and config.get('sheets_shard_max_cells', MAX_CELLS) is None:
+        return None
+    return Sharding(
+        shard_by = config.get('sheets_shard_by', SHARD_BY),
+        max_cells = config.get('sheets_shard_max_cells', MAX_CELLS),
+        spreadsheets = config.get('sheets_shard_spreadsheets', []),
+        max_workers = config.get('sheets_shard_workers', WORKERS)
+        )
@@ -0,0 +1,342 @@
+"""
+Incremental upload of the weekly worksheets to Google Sheets.
+
+Instead of rewriting every cell like d2g.upload, the loader reads the week
+columns and row names already on the worksheet and writes only the new week
+columns and the new campaign rows, in one batched values update.
+
+Existing worksheets are read the same way instead of with g2d.download: the
+header row and the row names first, then the week columns in ranges of a
+few weeks, side by side, each parsed straight into a typed frame.
+"""
+
+
+#Import libraries
+import numpy as np
+import pandas as pd
+import gspread
+import rate_limiter
+import schema
+import transform
+
+# Define variables
+READ_CHUNK_WEEKS = 52
+READ_WORKERS = 4
+
+def column_letter(number):
+    """Converts a column number to its A1 letters.
+
+    Args:
+        number: A column number, starting at 1.
+    Returns:
+        The column letters, like 'A' or 'AB'.
+    """
+    letters = ''
+    while number > 0:
+        number, remainder = divmod(number - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+def cell_value(value):
+    """Converts a DataFrame value to a JSON serializable cell value.
+
+    Args:
+        value: A value of the DataFrame.
+    Returns:
+        A str, int or float, empty for missing values.
+    """
+    if value is None or (not isinstance(value, str) and pd.isnull(value)):
+        return ''
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def parse_cell(a1_cell):
+    """Converts an A1 cell to its row and column numbers.
+
+    Args:
+        a1_cell: A cell like 'AB12'.
+    Returns:
+        The row and column numbers, starting at 1.
+    """
+    letters = a1_cell.rstrip('0123456789')
+    col = 0
+    for letter in letters:
+        col = col * 26 + ord(letter) - 64
+    return int(a1_cell[len(letters):]), col
+
+class GspreadBackend(object):
+    """Reads the layout of and writes values to the worksheets of a spreadsheet."""
+
+    def __init__(self, client, spreadsheet_url):
+        """Opens the spreadsheet.
+
+        Args:
+            client: An authorized gspread client, from initialize_drive.
+            spreadsheet_url: The spreadsheet URL.
+        """
+        self.client = client
+        self.spreadsheet = client.open_by_url(spreadsheet_url)
+        self.others = {}
+
+    def open(self, spreadsheet_url):
+        """Opens another spreadsheet with the same client.
+
+        Args:
+            spreadsheet_url: The spreadsheet URL, '' for this one.
+        Returns:
+            The GspreadBackend of the spreadsheet.
+        """
+        if not spreadsheet_url:
+            return self
+        if spreadsheet_url not in self.others:
+            self.others[spreadsheet_url] = GspreadBackend(self.client, spreadsheet_url)
+        return self.others[spreadsheet_url]
+
+    def worksheet(self, worksheet_name):
+        """Opens a worksheet, adding it when missing."""
+        try:
+            return self.spreadsheet.worksheet(worksheet_name)
+        except gspread.exceptions.WorksheetNotFound:
+            return self.spreadsheet.add_worksheet(title = worksheet_name, rows = 1, cols = 1)
+
+    def get_layout(self, worksheet_name):
+        """Reads the first row and the first column of a worksheet.
+
+        Args:
+            worksheet_name: The worksheet name on the spreadsheet.
+        Returns:
+            The header row and the row names, as lists of str, both empty
+            when the worksheet is missing.
+        """
+        try:
+            worksheet = self.spreadsheet.worksheet(worksheet_name)
+        except gspread.exceptions.WorksheetNotFound:
+            return [], []
+        return worksheet.row_values(1), worksheet.col_values(1)
+
+    def get_columns(self, worksheet_name, a1_ranges):
+        """Reads several ranges of a worksheet in one values request, column by column.
+
+        Args:
+            worksheet_name: The worksheet name on the spreadsheet.
+            a1_ranges: A list of A1 ranges without sheet name.
+        Returns:
+            A list per range of the lists of the values of its columns,
+            numbers unformatted; trailing empty cells are left out.
+        """
+        response = self.spreadsheet.values_batch_get(
+            ["'{}'!{}".format(worksheet_name, a1_range) for a1_range in a1_ranges],
+            params = {'majorDimension': 'COLUMNS', 'valueRenderOption': 'UNFORMATTED_VALUE'}
+            )
+        return [value_range.get('values', []) for value_range in response.get('valueRanges', [])]
+
+    def batch_update(self, worksheet_name, rows, cols, data):
+        """Writes several ranges of a worksheet in one values update.
+
+        Args:
+            worksheet_name: The worksheet name on the spreadsheet.
+            rows: The number of rows the worksheet needs.
+            cols: The number of columns the worksheet needs.
+            data: A list of (A1 range without sheet name, list of rows of values) tuples.
+        """
+        worksheet = self.worksheet(worksheet_name)
+        if worksheet.row_count < rows or worksheet.col_count < cols:
+            worksheet.resize(rows = max(rows, worksheet.row_count), cols = max(cols, worksheet.col_count))
+        self.spreadsheet.values_batch_update({
+            'valueInputOption': 'RAW',
+            'data': [
+                {
+                    'range': "'{}'!{}".format(worksheet_name, a1_range),
+                    'values': values
+                } for a1_range, values in data]
+            })
+
+class FakeSheetsBackend(object):
+    """An in-memory stand-in of GspreadBackend that counts the calls."""
+
+    def __init__(self):
+        # Cells by worksheet name and (row, column) numbers
+        self.worksheets = {}
+        self.reads = 0
+        self.updates = 0
+        self.cells_written = 0
+        self.others = {}
+
+    def open(self, spreadsheet_url):
+        """Opens another in-memory spreadsheet, like GspreadBackend.open."""
+        if not spreadsheet_url:
+            return self
+        return self.others.setdefault(spreadsheet_url, FakeSheetsBackend())
+
+    def get_layout(self, worksheet_name):
+        """Reads the first row and the first column, like GspreadBackend.get_layout."""
+        self.reads += 1
+        cells = self.worksheets.get(worksheet_name, {})
+        header = [cells.get((1, col), '') for col in range(1, max([col for row, col in cells if row == 1] or [0]) + 1)]
+        names = [cells.get((row, 1), '') for row in range(1, max([row for row, col in cells if col == 1] or [0]) + 1)]
+        return header, names
+
+    def get_columns(self, worksheet_name, a1_ranges):
+        """Reads several ranges column by column, like GspreadBackend.get_columns."""
+        self.reads += 1
+        cells = self.worksheets.get(worksheet_name, {})
+        return [range_columns(cells, a1_range) for a1_range in a1_ranges]
+
+    def batch_update(self, worksheet_name, rows, cols, data):
+        """Writes several ranges, like GspreadBackend.batch_update."""
+        self.updates += 1
+        cells = self.worksheets.setdefault(worksheet_name, {})
+        for a1_range, values in data:
+            first_row, first_col = parse_cell(a1_range.split(':')[0])
+            for row_number, row in enumerate(values):
+                for col_number, value in enumerate(row):
+                    cells[(first_row + row_number, first_col + col_number)] = value
+                    self.cells_written += 1
+
+    def to_frame(self, worksheet_name):
+        """Reads a whole fake worksheet back like g2d.download with row and column names."""
+        cells = self.worksheets[worksheet_name]
+        rows = max(row for row, _ in cells)
+        cols = max(col for _, col in cells)
+        values = [[cells.get((row, col), '') for col in range(1, cols + 1)] for row in range(1, rows + 1)]
+        return pd.DataFrame([row[1:] for row in values[1:]], index = [row[0] for row in values[1:]], columns = values[0][1:])
+
+def range_columns(cells, a1_range):
+    """Reads a range of cells column by column, like a values request.
+
+    Args:
+        cells: A dictionary of (row, column) numbers to values.
+        a1_range: An A1 range without sheet name, like 'B2:D40'.
+    Returns:
+        The lists of the values of its columns, trailing empty cells and
+        columns left out.
+    """
+    first, last = a1_range.split(':')
+    first_row, first_col = parse_cell(first)
+    last_row, last_col = parse_cell(last)
+    columns = []
+    for col in range(first_col, last_col + 1):
+        values = [cells.get((row, col), '') for row in range(first_row, last_row + 1)]
+        while values and values[-1] == '':
+            values.pop()
+        columns.append(values)
+    while columns and not columns[-1]:
+        columns.pop()
+    return columns
+
+def column_ranges(numbers):
+    """Groups column numbers into ranges of consecutive columns.
+
+    Args:
+        numbers: A sorted list of column numbers.
+    Returns:
+        A list of (first, last) column numbers.
+    """
+    ranges = []
+    for number in numbers:
+        if ranges and number == ranges[-1][1] + 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return [(first, last) for first, last in ranges]
+
+def read_worksheet(backend, worksheet_name, details = False, weeks = None, chunk_weeks = READ_CHUNK_WEEKS, max_workers = READ_WORKERS):
+    """Reads a worksheet straight into a typed frame, in chunks of week columns.
+
+    Only the header row and the row names are read whole; the week columns
+    are read in chunks of chunk_weeks columns, in parallel, and every chunk
+    is parsed into a typed frame of its own weeks, so the worksheet is never
+    held as one DataFrame of strings.
+
+    Args:
+        backend: A GspreadBackend, or FakeSheetsBackend.
+        worksheet_name: The worksheet name on the spreadsheet.
+        details: Whether the worksheet has the details layout.
+        weeks: The week column names to read, like the last few, or None
+            to read them all.
+        chunk_weeks: The week columns read per request.
+        max_workers: The number of chunks read side by side.
+    Returns:
+        A typed pandas DataFrame of schema, or None when the worksheet is
+        missing or has no weeks.
+    """
+    header, names = backend.get_layout(worksheet_name)
+    week_names = [str(week) for week in header[1:]]
+    names = [str(name) for name in names[1:]]
+    numbers = [
+        number for number, week in enumerate(week_names, 2)
+        if week != '' and (weeks is None or week in weeks)]
+    if not numbers or not names:
+        return None
+    parse = transform.details_from_columns if details else transform.totals_from_columns
+
+    def read_chunk(chunk):
+        ranges = column_ranges(chunk)
+        columns = []
+        for (first, last), range_values in zip(ranges, backend.get_columns(worksheet_name, [
+                '{}2:{}{}'.format(column_letter(first), column_letter(last), len(names) + 1)
+                for first, last in ranges])):
+            # Columns left out at the end of a range are empty
+            columns += range_values + [[]] * (last - first + 1 - len(range_values))
+        return parse(names, [week_names[number - 2] for number in chunk], columns)
+
+    chunks = [numbers[i:i + chunk_weeks] for i in range(0, len(numbers), chunk_weeks)]
+    return schema.concat_frames(rate_limiter.fetch_concurrently(read_chunk, chunks, max_workers))
+
+def upload_delta(backend, worksheet_name, data, layout = None):
+    """Uploads only the new week columns and new rows of a worksheet.
+
+    The cells already on the worksheet are left as they are; new rows are
+    appended below the existing ones, in the order of the DataFrame. New
+    week columns go where the DataFrame has them, so a week filled in the
+    middle of the history is written in calendar order, rewriting the
+    columns from it on.
+
+    Args:
+        backend: A GspreadBackend, or FakeSheetsBackend.
+        worksheet_name: The worksheet name on the spreadsheet.
+        data: A pandas DataFrame with row names as index and weeks as columns.
+        layout: The header row and the row names of backend.get_layout, or
+            None to read them.
+    Returns:
+        The number of cells written.
+    """
+    header, names = backend.get_layout(worksheet_name) if layout is None else layout
+    old_columns = [str(column) for column in header[1:]]
+    old_names = [str(name) for name in names[1:]]
+    data = data.copy()
+    data.index = [str(name) for name in data.index]
+    data.columns = [str(column) for column in data.columns]
+    known_columns = set(old_columns)
+    known_names = set(old_names)
+    new_columns = [column for column in data.columns if column not in known_columns]
+    new_names = [name for name in data.index if name not in known_names]
+    if not new_columns and not new_names:
+        return 0
+    all_names = old_names + new_names
+    if known_columns.issubset(data.columns):
+        columns = list(data.columns)
+    else:
+        # Columns only on the worksheet keep their place, the new ones go last
+        columns = old_columns + new_columns
+    # The columns up to the first one out of place stay as they are
+    kept = 0
+    while kept < len(old_columns) and old_columns[kept] == columns[kept]:
+        kept += 1
+    rewritten = columns[kept:]
+    updates = []
+    if rewritten:
+        # The new and the moved week columns, headers included, for all the rows
+        block = data.reindex(index = all_names, columns = rewritten)
+        values = [rewritten] + [[cell_value(value) for value in row] for row in block.values.tolist()]
+        first_col = column_letter(kept + 2)
+        updates.append(('{}1:{}{}'.format(first_col, column_letter(len(columns) + 1), len(all_names) + 1), values))
+    if new_names:
+        # The new rows, names included, for the columns left in place
+        block = data.reindex(index = new_names, columns = columns[:kept])
+        values = [[name] + [cell_value(value) for value in row] for name, row in zip(new_names, block.values.tolist())]
+        first_row = len(old_names) + 2
+        updates.append(('A{}:{}{}'.format(first_row, column_letter(kept + 1), len(all_names) + 1), values))
+    backend.batch_update(worksheet_name, len(all_names) + 1, len(columns) + 1, updates)
+    return sum(len(row) for _, values in updates for row in values)
@@ -0,0 +1,10 @@
+"""
+Puts the scripts of the repository on the path of the tests.
+"""
+
+
+#Import libraries
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,99 @@
+"""
+Tests of the extract-to-load pipeline of both scripts against the fakes.
+"""
+
+
+#Import libraries
+import importlib
+import sqlite3
+import fakes
+import pipeline
+import pytest
+import rate_limiter
+import schema
+
+# Define variables
+WEEKS = 12
+FACTS_QUERY = 'SELECT source, iso_year, iso_week, campaign, metric, value FROM facts ORDER BY 1, 2, 3, 4, 5'
+
+class Crash(Exception):
+    """The failure of a run that stops halfway."""
+
+@pytest.fixture(params = sorted(fakes.SCRIPTS))
+def source(request, monkeypatch):
+    """Sets up a script to run quickly against the fakes."""
+    script = importlib.import_module(fakes.SCRIPTS[request.param])
+    monkeypatch.setattr(script, 'LIMITER', rate_limiter.RateLimiter(script.LIMITER.name, rate = 1000, burst = 1000, base_delay = 0.01))
+    monkeypatch.setattr(script, 'MAX_WORKERS', 2)
+    if request.param == 'facebook':
+        monkeypatch.setattr(script, 'ASYNC_FIRST_POLL', 0.01)
+    return request.param
+
+def run(source, workdir, sheets):
+    """Runs the pipeline of a source against new fake APIs of the same data."""
+    services = {'analytics': None, 'facebook': None}
+    if source == 'google_analytics':
+        services['analytics'] = fakes.FakeAnalytics(campaigns = 5)
+    else:
+        services['facebook'] = fakes.FakeFacebook(campaigns = 5)
+    return fakes.run_offline(source, sheets = sheets, weeks = WEEKS, workdir = str(workdir), **services)['result']
+
+def stored_facts(source, workdir):
+    """Reads all the facts of the warehouse of a run."""
+    connection = sqlite3.connect(str(workdir / 'warehouse_{}.sqlite'.format(source)))
+    try:
+        return connection.execute(FACTS_QUERY).fetchall()
+    finally:
+        connection.close()
+
+def sheet_cells(sheets):
+    """Lists the cells of all the fake worksheets."""
+    return {
+        (url, title): dict(worksheet.cells)
+        for url, spreadsheet in sheets.spreadsheets.items()
+        for title, worksheet in spreadsheet.worksheets.items()}
+
+def test_a_rerun_writes_no_cells(source, tmp_path):
+    sheets = fakes.FakeSheetsClient()
+    run(source, tmp_path, sheets)
+    cells_written = sheets.cells_written
+    result = run(source, tmp_path, sheets)
+    assert result['weeks'] == 0
+    assert sheets.cells_written == cells_written
+
+def test_the_totals_keep_counts_whole_and_money_in_cents(source, tmp_path):
+    sheets = fakes.FakeSheetsClient()
+    run(source, tmp_path, sheets)
+    (_, cells), = [(title, cells) for (_, title), cells in sheet_cells(sheets).items() if title.endswith('_totals')]
+    names = {row: name for (row, col), name in cells.items() if col == 1}
+    for (row, col), value in cells.items():
+        if row == 1 or col == 1 or value == '':
+            continue
+        if schema.metric_dtype(names[row]).startswith('Int'):
+            assert type(value) is int, (names[row], value)
+        elif names[row] in schema.MONEY_METRICS:
+            assert value == round(value, 2), (names[row], value)
+
+def test_a_run_resumed_after_a_crash_equals_a_fresh_run(source, tmp_path, monkeypatch):
+    fresh_sheets = fakes.FakeSheetsClient()
+    fresh = run(source, tmp_path / 'fresh', fresh_sheets)
+
+    add_week = pipeline.Pipeline.add_week
+    added = []
+
+    def crashing_add_week(self, start_date, extracted_data):
+        if len(added) == WEEKS // 2:
+            raise Crash('stopped halfway')
+        added.append(start_date)
+        return add_week(self, start_date, extracted_data)
+    monkeypatch.setattr(pipeline.Pipeline, 'add_week', crashing_add_week)
+    sheets = fakes.FakeSheetsClient()
+    with pytest.raises(Crash):
+        run(source, tmp_path / 'resumed', sheets)
+    monkeypatch.setattr(pipeline.Pipeline, 'add_week', add_week)
+    resumed = run(source, tmp_path / 'resumed', sheets)
+
+    assert resumed['resumed_weeks'] == WEEKS // 2
+    assert resumed['weeks'] == fresh['weeks'] - WEEKS // 2
+    assert stored_facts(source, tmp_path / 'resumed') == stored_facts(source, tmp_path / 'fresh')
+    assert sheet_cells(sheets) == sheet_cells(fresh_sheets)
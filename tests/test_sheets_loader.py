@@ -0,0 +1,122 @@
+"""
+Tests of the incremental upload against the in-memory FakeSheetsBackend.
+"""
+
+
+#Import libraries
+import pandas as pd
+import sheets_loader
+
+def totals_layout(weeks):
+    """Builds a totals worksheet layout with two metrics, one column per week."""
+    return pd.DataFrame(
+        {week: [100 + number, 10 + number] for number, week in enumerate(weeks)},
+        index = ['ga:sessions', 'ga:adClicks']
+        )
+
+def recorded_ranges(backend):
+    """Records the A1 ranges of every batch_update of a FakeSheetsBackend."""
+    ranges = []
+    batch_update = backend.batch_update
+
+    def record(worksheet_name, rows, cols, data):
+        ranges.extend(a1_range for a1_range, _ in data)
+        return batch_update(worksheet_name, rows, cols, data)
+    backend.batch_update = record
+    return ranges
+
+def test_upload_delta_writes_a_new_worksheet():
+    backend = sheets_loader.FakeSheetsBackend()
+    data = totals_layout(['2017-1', '2017-2', '2017-3'])
+    cells = sheets_loader.upload_delta(backend, 'ga_totals', data)
+    assert cells == backend.cells_written
+    pd.testing.assert_frame_equal(backend.to_frame('ga_totals'), data)
+
+def test_upload_delta_rerun_writes_no_cells():
+    backend = sheets_loader.FakeSheetsBackend()
+    data = totals_layout(['2017-1', '2017-2', '2017-3'])
+    sheets_loader.upload_delta(backend, 'ga_totals', data)
+    updates, cells_written = backend.updates, backend.cells_written
+    assert sheets_loader.upload_delta(backend, 'ga_totals', data) == 0
+    assert (backend.updates, backend.cells_written) == (updates, cells_written)
+
+def test_upload_delta_appends_new_weeks_only():
+    backend = sheets_loader.FakeSheetsBackend()
+    sheets_loader.upload_delta(backend, 'ga_totals', totals_layout(['2017-1', '2017-2']))
+    ranges = recorded_ranges(backend)
+    data = totals_layout(['2017-1', '2017-2', '2017-3'])
+    # The new column, header included, for both rows
+    assert sheets_loader.upload_delta(backend, 'ga_totals', data) == 3
+    assert ranges == ['D1:D3']
+    pd.testing.assert_frame_equal(backend.to_frame('ga_totals'), data)
+
+def test_upload_delta_filling_a_gap_rewrites_the_following_columns_only():
+    backend = sheets_loader.FakeSheetsBackend()
+    sheets_loader.upload_delta(backend, 'ga_totals', totals_layout(['2017-1', '2017-2', '2017-4', '2017-5']))
+    ranges = recorded_ranges(backend)
+    data = totals_layout(['2017-1', '2017-2', '2017-3', '2017-4', '2017-5'])
+    # The gap week and the two weeks after it, headers included, for both rows
+    assert sheets_loader.upload_delta(backend, 'ga_totals', data) == 9
+    assert ranges == ['D1:F3']
+    pd.testing.assert_frame_equal(backend.to_frame('ga_totals'), data)
+
+def test_upload_delta_appends_new_rows_below_the_old_ones():
+    backend = sheets_loader.FakeSheetsBackend()
+    sheets_loader.upload_delta(backend, 'ga_totals', totals_layout(['2017-1', '2017-2']))
+    data = pd.concat([totals_layout(['2017-1', '2017-2']), pd.DataFrame({'2017-1': [5], '2017-2': [6]}, index = ['ga:users'])])
+    # The new row, its name included
+    assert sheets_loader.upload_delta(backend, 'ga_totals', data) == 3
+    pd.testing.assert_frame_equal(backend.to_frame('ga_totals'), data)
+
+def details_layout(weeks):
+    """Builds a details worksheet layout of three campaigns, the last one starting in the second week."""
+    rows = {}
+    for number, week in enumerate(weeks):
+        column = {}
+        for campaign in range(3):
+            if campaign == 2 and number == 0:
+                continue
+            column['campaign_{}'.format(campaign)] = 'Campaign {}'.format(campaign)
+            column['ga:adClicks_{}'.format(campaign)] = 10 * campaign + number
+            column['ga:sessions_{}'.format(campaign)] = 100 * campaign + number
+        rows[week] = column
+    index = ['{}_{}'.format(name, campaign) for campaign in range(3) for name in ['campaign', 'ga:adClicks', 'ga:sessions']]
+    return pd.DataFrame(rows).reindex(index)
+
+def test_read_worksheet_in_chunks_round_trips_the_totals():
+    backend = sheets_loader.FakeSheetsBackend()
+    weeks = ['2017-{}'.format(week) for week in range(1, 8)]
+    data = totals_layout(weeks)
+    sheets_loader.upload_delta(backend, 'ga_totals', data)
+    frame = sheets_loader.read_worksheet(backend, 'ga_totals', chunk_weeks = 3, max_workers = 2)
+    assert list(frame['week'].astype(str)) == weeks
+    for metric, values in data.iterrows():
+        assert list(frame[metric]) == list(values)
+
+def test_read_worksheet_in_chunks_round_trips_the_details():
+    backend = sheets_loader.FakeSheetsBackend()
+    weeks = ['2017-{}'.format(week) for week in range(1, 6)]
+    data = details_layout(weeks)
+    sheets_loader.upload_delta(backend, 'ga_details', data)
+    frame = sheets_loader.read_worksheet(backend, 'ga_details', details = True, chunk_weeks = 2, max_workers = 2)
+    read = {
+        (str(row['week']), row['campaign']): (row['ga:adClicks'], row['ga:sessions'])
+        for _, row in frame.iterrows()}
+    expected = {
+        (week, data.loc['campaign_{}'.format(campaign), week]): (
+            data.loc['ga:adClicks_{}'.format(campaign), week],
+            data.loc['ga:sessions_{}'.format(campaign), week])
+        for week in weeks for campaign in range(3)
+        if pd.notnull(data.loc['campaign_{}'.format(campaign), week])}
+    assert read == expected
+
+def test_read_worksheet_reads_only_the_asked_weeks():
+    backend = sheets_loader.FakeSheetsBackend()
+    weeks = ['2017-{}'.format(week) for week in range(1, 8)]
+    sheets_loader.upload_delta(backend, 'ga_totals', totals_layout(weeks))
+    frame = sheets_loader.read_worksheet(backend, 'ga_totals', weeks = weeks[-2:], chunk_weeks = 3)
+    assert list(frame['week'].astype(str)) == weeks[-2:]
+    assert list(frame['ga:sessions']) == [105, 106]
+
+def test_read_worksheet_of_a_missing_worksheet_is_none():
+    assert sheets_loader.read_worksheet(sheets_loader.FakeSheetsBackend(), 'ga_totals') is None
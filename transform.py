@@ -0,0 +1,221 @@
+"""
+Vectorized transform of the API responses into typed weekly frames.
+
+The responses are first flattened into typed NumPy arrays of campaigns,
+metrics and values, one element per campaign and metric, which
+details_frame pivots into the typed frame of schema with one row per
+campaign; totals_frame builds the one-row frame of the totals.
+
+The week columns read back from a worksheet are converted to the same
+frames by totals_from_columns and details_from_columns. The worksheet
+layout itself, a 'campaign_i' row with the name followed by the sorted
+'metric_i' rows, is derived from the facts by warehouse.Warehouse.
+"""
+
+
+#Import libraries
+import numpy as np
+import pandas as pd
+import schema
+
+def ga_metric_types(report):
+    """Lists the Python type of every metric of an Analytics Reporting API V4 report.
+
+    Args:
+        report: A report with a columnHeader.
+    Returns:
+        A list of int for INTEGER metrics and float for all others.
+    """
+    return [
+        int if entry.get('type', 'INTEGER') == 'INTEGER' else float
+        for entry in report['columnHeader']['metricHeader']['metricHeaderEntries']]
+
+def ga_rows(report):
+    """Yields the rows of one report page with typed metric values.
+
+    Args:
+        report: A report, or one page of a report.
+    Yields:
+        A (dimensions, values) tuple per row, the values converted by
+        ga_metric_types.
+    """
+    types = ga_metric_types(report)
+    for row in report['data'].get('rows', []):
+        yield row['dimensions'], [convert(value) for convert, value in zip(types, row['metrics'][0]['values'])]
+
+def ga_details_arrays(dict_data):
+    """Flattens an Analytics Reporting API V4 response by campaign.
+
+    The rows are read one at a time, without intermediate lists of rows.
+
+    Args:
+        dict_data: A response with the campaign as first dimension.
+    Returns:
+        The campaign, metric and float64 value arrays, one element per
+        campaign and metric.
+    """
+    report = dict_data['reports'][0]
+    metric_names = np.array(
+        [entry['name'] for entry in report['columnHeader']['metricHeader']['metricHeaderEntries']],
+        dtype = object
+        )
+    names = []
+
+    def flat_values():
+        for dimensions, values in ga_rows(report):
+            names.append(dimensions[0])
+            for value in values:
+                yield value
+
+    # np.fromiter fills the names while it reads the values.
+    values = np.fromiter(flat_values(), dtype = float)
+    return (
+        np.repeat(np.array(names, dtype = object), len(metric_names)),
+        np.tile(metric_names, len(names)),
+        values
+        )
+
+def fb_details_arrays(dict_data, skip_fields = ('date_start', 'date_stop', 'campaign_id', 'campaign_name')):
+    """Flattens Facebook campaign stats by campaign.
+
+    Args:
+        dict_data: A dictionary of campaign IDs to dictionaries of stats.
+        skip_fields: The fields that are no metrics.
+    Returns:
+        The campaign ID, metric and float64 value arrays, one element per
+        campaign and metric.
+    """
+    items = [
+        (campaign, metric, value)
+        for campaign, stats in dict_data.items()
+        for metric, value in stats.items()
+        if metric not in skip_fields]
+    if not items:
+        return np.array([], dtype = object), np.array([], dtype = object), np.array([], dtype = float)
+    campaigns, metrics, values = zip(*items)
+    return np.array(campaigns, dtype = object), np.array(metrics, dtype = object), np.array(values, dtype = float)
+
+def fb_campaign_names(dict_data):
+    """Maps the campaign IDs of Facebook campaign stats to their campaign names.
+
+    Args:
+        dict_data: A dictionary of campaign IDs to dictionaries of stats.
+    Returns:
+        A dictionary of campaign IDs to names.
+    """
+    return {campaign: stats['campaign_name'] for campaign, stats in dict_data.items()}
+
+def details_frame(campaigns, metrics, values, week, campaign_names = None):
+    """Pivots the flat arrays of one week into a typed frame.
+
+    Args:
+        campaigns: The campaign array of *_details_arrays, names or IDs.
+        metrics: The metric array of *_details_arrays.
+        values: The value array of *_details_arrays.
+        week: The week column name, like '2017-27'.
+        campaign_names: A dictionary of the campaign IDs to their names, or
+            None when the campaigns are keyed by name.
+    Returns:
+        A typed pandas DataFrame of schema with one row per campaign, in the
+        order they first appear, and one column per metric.
+    """
+    campaign_numbers, keys = pd.factorize(np.asarray(campaigns, dtype = object))
+    metric_numbers, metric_names = pd.factorize(np.asarray(metrics, dtype = object))
+    grid = np.full((len(metric_names), len(keys)), np.nan)
+    grid[metric_numbers, campaign_numbers] = values
+    columns = {schema.WEEK: schema.key_array([week], np.zeros(len(keys), dtype = int))}
+    if campaign_names is None:
+        columns[schema.CAMPAIGN] = schema.key_array(keys, np.arange(len(keys)))
+    else:
+        # Campaigns of the same name stay apart by their ID
+        columns[schema.CAMPAIGN] = schema.categorical(pd.Series([campaign_names[key] for key in keys], dtype = object))
+        columns[schema.CAMPAIGN_ID] = schema.key_array(keys, np.arange(len(keys)))
+    for metric, metric_values in zip(metric_names, grid):
+        columns[metric] = schema.metric_array(metric_values, schema.metric_dtype(metric))
+    return pd.DataFrame(columns)
+
+def totals_frame(metrics, values, week):
+    """Builds the typed frame of the totals of one week.
+
+    Args:
+        metrics: A list of metric names.
+        values: Their values, numbers or strings like the APIs send them.
+        week: The week column name, like '2017-27'.
+    Returns:
+        A one-row typed pandas DataFrame of schema.
+    """
+    columns = {schema.WEEK: schema.key_array([week], np.zeros(1, dtype = int))}
+    for metric, value in zip(metrics, np.asarray(values, dtype = float)):
+        columns[metric] = schema.metric_array(np.array([value]), schema.metric_dtype(metric))
+    return pd.DataFrame(columns)
+
+def column_grid(columns, rows):
+    """Pads the week columns of a values read into one grid.
+
+    Args:
+        columns: A list of lists of cell values, one per week column; the
+            trailing empty cells may be left out.
+        rows: The number of rows of the grid.
+    Returns:
+        A 2D object NumPy array of rows by weeks, '' for empty cells.
+    """
+    grid = np.full((rows, len(columns)), '', dtype = object)
+    for number, values in enumerate(columns):
+        grid[:len(values), number] = values[:rows]
+    return grid
+
+def totals_from_columns(names, weeks, columns):
+    """Converts week columns of a totals worksheet to a typed frame.
+
+    Args:
+        names: The metric names of the rows.
+        weeks: The week column names.
+        columns: A list per week of its cell values, as column_grid takes them.
+    Returns:
+        A typed pandas DataFrame of schema with one row per week.
+    """
+    grid = column_grid(columns, len(names))
+    data = {schema.WEEK: schema.key_array(weeks, np.arange(len(weeks)))}
+    for name, values in zip(names, grid):
+        data[name] = values
+    return schema.typed_frame(pd.DataFrame(data))
+
+def details_from_columns(names, weeks, columns):
+    """Converts week columns of a details worksheet to a typed frame.
+
+    Every campaign number is looked up in its week only, since the numbers of
+    a week column only hold within that column, without a loop over the
+    cells.
+
+    Args:
+        names: The 'campaign_i' and 'metric_i' names of the rows.
+        weeks: The week column names.
+        columns: A list per week of its cell values, as column_grid takes them.
+    Returns:
+        A typed pandas DataFrame of schema with one row per week and campaign.
+    """
+    grid = column_grid(columns, len(names))
+    parts = [name.rpartition('_') for name in names]
+    metrics = np.array([metric for metric, _, _ in parts], dtype = object)
+    numbers = np.array([number for _, _, number in parts], dtype = object)
+    campaign_rows = np.flatnonzero(metrics == schema.CAMPAIGN)
+    # A campaign number shown twice keeps its first row
+    campaign_rows = campaign_rows[np.sort(np.unique(numbers[campaign_rows], return_index = True)[1])]
+    campaign_grid = grid[campaign_rows]
+    present = pd.notnull(campaign_grid) & (campaign_grid != '')
+    # One row per week and campaign, week by week
+    week_positions, campaign_positions = np.nonzero(present.T)
+    campaign_numbers, campaign_names = pd.factorize(np.array(
+        [str(name) for name in campaign_grid[campaign_positions, week_positions]], dtype = object))
+    data = {
+        schema.WEEK: schema.key_array(weeks, week_positions),
+        schema.CAMPAIGN: schema.key_array(campaign_names, campaign_numbers)
+        }
+    positions = pd.Index(numbers[campaign_rows])
+    metric_rows = np.flatnonzero((metrics != schema.CAMPAIGN) & (positions.get_indexer(numbers) >= 0))
+    for metric in pd.unique(metrics[metric_rows]):
+        rows = metric_rows[metrics[metric_rows] == metric]
+        metric_grid = np.full(campaign_grid.shape, '', dtype = object)
+        metric_grid[positions.get_indexer(numbers[rows])] = grid[rows]
+        data[metric] = metric_grid[campaign_positions, week_positions]
+    return schema.typed_frame(pd.DataFrame(data))
@@ -0,0 +1,467 @@
+"""
+Local warehouse of the weekly data in long form.
+
+Every worksheet is stored as one row per source, ISO week, campaign and
+metric, clustered by ISO week, so the last week is an index lookup and the
+spreadsheet becomes an output derived from the warehouse.
+
+The weeks of a backfill are checkpointed one by one as they are stored:
+a week is 'stored' until the worksheet is uploaded, then 'loaded'. A run
+that stops halfway resumes after the last checkpointed week.
+
+Campaigns are keyed by a campaign dimension that maps the Facebook campaign
+ID, or the Google Analytics campaign name, to a surrogate key numbered once
+and kept for good, so the details rows of a campaign never move when
+campaigns are added or come back in another order, and campaigns of the
+same name stay apart. The facts are keyed by that key; the name of every
+week is kept with them, and the last one in the dimension.
+"""
+
+
+#Import libraries
+import collections
+import os
+import sqlite3
+import time
+import pandas as pd
+import schema
+
+# Define variables
+WAREHOUSE_PATH = 'warehouse.sqlite'
+# The campaign key of the totals rows, which have no campaign
+TOTALS_KEY = -1
+
+def parse_week(label):
+    """Splits a week column name like '2017-27'.
+
+    Args:
+        label: A week column name.
+    Returns:
+        The ISO-year and ISO-week number, as ints.
+    """
+    iso_year, iso_week = label.split('-')
+    return int(iso_year), int(iso_week)
+
+def week_label(iso_year, iso_week):
+    """Names the column of a week.
+
+    Args:
+        iso_year: An ISO-year.
+        iso_week: An ISO-week number.
+    Returns:
+        The week column name, like '2017-27'.
+    """
+    return '{}-{}'.format(iso_year, iso_week)
+
+class Warehouse(object):
+    """A SQLite table of weekly facts in long form."""
+
+    def __init__(self, path = WAREHOUSE_PATH):
+        """Opens or creates the warehouse.
+
+        Args:
+            path: The SQLite file of the warehouse.
+        """
+        self.path = path
+        # The load stage of the pipeline writes from its own thread
+        self.connection = sqlite3.connect(path, timeout = 30, check_same_thread = False)
+        # The primary key clusters the rows of a source by ISO week; the
+        # name of the campaign of every week is kept with its facts.
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS facts ('
+            'source TEXT, iso_year INTEGER, iso_week INTEGER, campaign_key INTEGER, campaign TEXT, metric TEXT, '
+            'value NUMERIC, position INTEGER, '
+            'PRIMARY KEY (source, iso_year, iso_week, campaign_key, metric)) WITHOUT ROWID'
+            )
+        # The manifest of the worksheet shards, see shards.py
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS shards ('
+            'source TEXT, spreadsheet TEXT, worksheet TEXT, period TEXT, '
+            'first_year INTEGER, first_week INTEGER, last_year INTEGER, last_week INTEGER, '
+            'PRIMARY KEY (source, spreadsheet, worksheet)) WITHOUT ROWID'
+            )
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS campaigns ('
+            'source TEXT, campaign_id TEXT, campaign_key INTEGER, campaign TEXT, '
+            'PRIMARY KEY (source, campaign_id)) WITHOUT ROWID'
+            )
+        # Weeks without any rows are checkpointed too
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS checkpoints ('
+            'source TEXT, iso_year INTEGER, iso_week INTEGER, state TEXT, updated REAL, '
+            'PRIMARY KEY (source, iso_year, iso_week)) WITHOUT ROWID'
+            )
+        self.connection.commit()
+
+    def campaign_keys(self, source, campaign_ids, names = None):
+        """Looks up the surrogate keys of campaigns, numbering the new ones.
+
+        New campaigns get the next keys in the order they first appear; the
+        caller commits them with the facts that use them. The first new ID
+        whose campaign was keyed by its name, from a worksheet, takes that
+        key; other IDs of the same name get keys of their own. Every
+        campaign keeps its last name.
+
+        Args:
+            source: The worksheet name, like 'ga_details'.
+            campaign_ids: A list of Facebook campaign IDs or Google Analytics
+                campaign names.
+            names: The list of their campaign names, or None.
+        Returns:
+            A list of their int keys.
+        """
+        names = names or campaign_ids
+        keys = dict(self.connection.execute(
+            'SELECT campaign_id, campaign_key FROM campaigns WHERE source = ?',
+            (source,)
+            ).fetchall())
+        # A key is taken once an ID shares it with the name it was imported by
+        taken = set(campaign_key for campaign_key, count in collections.Counter(keys.values()).items() if count > 1)
+        next_key = max(keys.values()) + 1 if keys else 0
+        new_keys = {}
+        for campaign_id, name in zip(campaign_ids, names):
+            if campaign_id in keys or campaign_id in new_keys:
+                continue
+            if name in keys and keys[name] not in taken:
+                new_keys[campaign_id] = keys[name]
+                taken.add(keys[name])
+            else:
+                new_keys[campaign_id] = next_key
+                next_key += 1
+        self.connection.executemany(
+            'INSERT INTO campaigns VALUES (?, ?, ?, ?)',
+            [(source, campaign_id, campaign_key, None) for campaign_id, campaign_key in new_keys.items()]
+            )
+        self.connection.executemany(
+            'UPDATE campaigns SET campaign = ? WHERE source = ? AND campaign_id = ?',
+            [(name, source, campaign_id) for campaign_id, name in dict(zip(campaign_ids, names)).items()]
+            )
+        keys.update(new_keys)
+        return [keys[campaign_id] for campaign_id in campaign_ids]
+
+    def last_week(self, source):
+        """Looks up the last stored or checkpointed week of a source.
+
+        Args:
+            source: The worksheet name, like 'ga_totals'.
+        Returns:
+            The ISO-year and ISO-week number, or None if the source is empty.
+        """
+        return self.connection.execute(
+            'SELECT iso_year, iso_week FROM facts WHERE source = ? '
+            'UNION SELECT iso_year, iso_week FROM checkpoints WHERE source = ? '
+            'ORDER BY iso_year DESC, iso_week DESC LIMIT 1',
+            (source, source)
+            ).fetchone()
+
+    def stored_weeks(self, source):
+        """Lists the stored or checkpointed weeks of a source.
+
+        Args:
+            source: The worksheet name, like 'ga_totals'.
+        Returns:
+            A list of (iso_year, iso_week) tuples, in calendar order.
+        """
+        return self.connection.execute(
+            'SELECT iso_year, iso_week FROM facts WHERE source = ? '
+            'UNION SELECT iso_year, iso_week FROM checkpoints WHERE source = ? '
+            'ORDER BY iso_year, iso_week',
+            (source, source)
+            ).fetchall()
+
+    def store_weeks(self, source, rows, checkpoint_weeks = ()):
+        """Replaces the stored weeks of a source.
+
+        Args:
+            source: The worksheet name, like 'ga_totals'.
+            rows: A list of (iso_year, iso_week, campaign_key, campaign, metric,
+                value) tuples; their order is kept within each week.
+            checkpoint_weeks: A list of (iso_year, iso_week) tuples to
+                checkpoint as 'stored' in the same transaction, with or
+                without rows.
+        """
+        weeks = sorted(set((iso_year, iso_week) for iso_year, iso_week, _, _, _, _ in rows) | set(checkpoint_weeks))
+        self.connection.executemany(
+            'DELETE FROM facts WHERE source = ? AND iso_year = ? AND iso_week = ?',
+            [(source, iso_year, iso_week) for iso_year, iso_week in weeks]
+            )
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO facts (source, iso_year, iso_week, campaign, metric, value, position, campaign_key) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [(source, iso_year, iso_week, campaign, metric, value, position, campaign_key)
+                for position, (iso_year, iso_week, campaign_key, campaign, metric, value) in enumerate(rows)]
+            )
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?)',
+            [(source, iso_year, iso_week, 'stored', time.time()) for iso_year, iso_week in checkpoint_weeks]
+            )
+        self.connection.commit()
+
+    def mark_loaded(self, source, weeks = None):
+        """Checkpoints the stored weeks of a source as uploaded.
+
+        Args:
+            source: The worksheet name, like 'ga_totals'.
+            weeks: The (iso_year, iso_week) tuples uploaded; the weeks stored
+                while the upload ran, gaps before the last week included,
+                stay 'stored'. None marks every stored week.
+        """
+        if weeks is None:
+            self.connection.execute(
+                "UPDATE checkpoints SET state = 'loaded', updated = ? WHERE source = ? AND state = 'stored'",
+                (time.time(), source)
+                )
+        else:
+            updated = time.time()
+            self.connection.executemany(
+                "UPDATE checkpoints SET state = 'loaded', updated = ? WHERE source = ? AND state = 'stored' "
+                'AND iso_year = ? AND iso_week = ?',
+                [(updated, source, iso_year, iso_week) for iso_year, iso_week in weeks]
+                )
+        self.connection.commit()
+
+    def pending_weeks(self, source):
+        """Lists the checkpointed weeks of a source not uploaded yet.
+
+        Args:
+            source: The worksheet name, like 'ga_totals'.
+        Returns:
+            A list of (iso_year, iso_week) tuples, in calendar order.
+        """
+        return self.connection.execute(
+            "SELECT iso_year, iso_week FROM checkpoints WHERE source = ? AND state = 'stored' "
+            'ORDER BY iso_year, iso_week',
+            (source,)
+            ).fetchall()
+
+    def discard_checkpoints(self, source):
+        """Drops the weeks of a source stored since its last upload.
+
+        The next run extracts them again; the weeks already uploaded are kept.
+
+        Args:
+            source: The worksheet name, like 'ga_totals'.
+        Returns:
+            The number of weeks dropped.
+        """
+        weeks = self.pending_weeks(source)
+        self.connection.executemany(
+            'DELETE FROM facts WHERE source = ? AND iso_year = ? AND iso_week = ?',
+            [(source, iso_year, iso_week) for iso_year, iso_week in weeks]
+            )
+        self.connection.execute("DELETE FROM checkpoints WHERE source = ? AND state = 'stored'", (source,))
+        self.connection.commit()
+        return len(weeks)
+
+    def shards(self, source):
+        """Reads the manifest of the shards of a worksheet.
+
+        Args:
+            source: The worksheet name, like 'ga_details'.
+        Returns:
+            A list of dictionaries with the 'spreadsheet' URL, '' for the
+            spreadsheet of the run, the 'worksheet' name, the 'period' and
+            the 'first' and 'last' (iso_year, iso_week) of every shard, in
+            calendar order.
+        """
+        return [
+            {
+                'spreadsheet': spreadsheet,
+                'worksheet': worksheet,
+                'period': period,
+                'first': (first_year, first_week),
+                'last': (last_year, last_week)
+            } for spreadsheet, worksheet, period, first_year, first_week, last_year, last_week in self.connection.execute(
+                'SELECT spreadsheet, worksheet, period, first_year, first_week, last_year, last_week FROM shards '
+                'WHERE source = ? ORDER BY first_year, first_week',
+                (source,)
+                ).fetchall()]
+
+    def save_shards(self, source, shards):
+        """Replaces the manifest of the shards of a worksheet.
+
+        Args:
+            source: The worksheet name, like 'ga_details'.
+            shards: A list of shards like Warehouse.shards returns them.
+        """
+        self.connection.execute('DELETE FROM shards WHERE source = ?', (source,))
+        self.connection.executemany(
+            'INSERT INTO shards VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [(source, shard['spreadsheet'], shard['worksheet'], shard['period']) + tuple(shard['first']) + tuple(shard['last'])
+                for shard in shards]
+            )
+        self.connection.commit()
+
+    def store_frame(self, source, data, checkpoint = False):
+        """Stores the weeks of a typed frame.
+
+        The campaigns are keyed by their 'campaign_id', or by their name
+        when the frame has no IDs, like the weeks of a worksheet.
+
+        Args:
+            source: The worksheet name, like 'ga_totals'.
+            data: A typed pandas DataFrame of schema; the totals have no
+                'campaign' column.
+            checkpoint: Whether to checkpoint all the weeks of the frame,
+                the categories of its 'week' column, as 'stored'.
+        """
+        metrics = schema.metric_columns(data)
+        weeks = [parse_week(label) for label in schema.python_values(data[schema.WEEK])]
+        if schema.CAMPAIGN in data.columns:
+            campaigns = schema.python_values(data[schema.CAMPAIGN])
+            campaign_ids = campaigns
+            if schema.CAMPAIGN_ID in data.columns:
+                campaign_ids = [
+                    campaign if campaign_id is None else campaign_id
+                    for campaign, campaign_id in zip(campaigns, schema.python_values(data[schema.CAMPAIGN_ID]))]
+            campaign_keys = self.campaign_keys(source, campaign_ids, campaigns)
+        else:
+            campaigns = [''] * len(data)
+            campaign_keys = [TOTALS_KEY] * len(data)
+        columns = [schema.python_values(data[metric]) for metric in metrics]
+        rows = []
+        for number, ((iso_year, iso_week), campaign_key, campaign) in enumerate(zip(weeks, campaign_keys, campaigns)):
+            for metric, values in zip(metrics, columns):
+                if values[number] is not None:
+                    rows.append((iso_year, iso_week, campaign_key, campaign, metric, values[number]))
+        if checkpoint:
+            self.store_weeks(source, rows, [parse_week(label) for label in data[schema.WEEK].cat.categories])
+        else:
+            self.store_weeks(source, rows)
+
+    def week_labels(self, source):
+        """Lists the week column names of the worksheet of a source.
+
+        Args:
+            source: The worksheet name, like 'ga_totals'.
+        Returns:
+            The names of the weeks with facts, in calendar order.
+        """
+        return [
+            week_label(iso_year, iso_week)
+            for iso_year, iso_week in self.connection.execute(
+                'SELECT DISTINCT iso_year, iso_week FROM facts WHERE source = ? ORDER BY iso_year, iso_week',
+                (source,)
+                )]
+
+    def row_count(self, source):
+        """Counts the rows of the worksheet of a source, without the header.
+
+        Args:
+            source: The worksheet name, like 'ga_details'.
+        Returns:
+            The number of metrics of the totals, or of 'campaign_i' and
+            'metric_i' rows of the details.
+        """
+        return self.connection.execute(
+            'SELECT COUNT(DISTINCT NULLIF(campaign_key, ?)) + COUNT(*) '
+            'FROM (SELECT DISTINCT campaign_key, metric FROM facts WHERE source = ?)',
+            (TOTALS_KEY, source)
+            ).fetchone()[0]
+
+    def read_source(self, source, first_week = None):
+        """Reads the rows of a source.
+
+        Args:
+            source: The worksheet name.
+            first_week: The (iso_year, iso_week) tuple of the first week to
+                read, or None for all the weeks.
+        Returns:
+            A pandas DataFrame of the long rows, in week and insertion order,
+            the values of the Int metrics of schema as Python ints.
+        """
+        query = 'SELECT iso_year, iso_week, campaign_key, campaign, metric, value FROM facts WHERE source = ? '
+        params = (source,)
+        if first_week is not None:
+            # A range on the primary key
+            query += 'AND iso_year >= ? AND (iso_year > ? OR iso_week >= ?) '
+            params += (first_week[0], first_week[0], first_week[1])
+        rows = pd.read_sql_query(query + 'ORDER BY iso_year, iso_week, position', self.connection, params = params)
+        # pandas reads the whole value column as float64, counts are no floats
+        counts = rows['metric'].map(schema.metric_dtype).str.startswith('Int').to_numpy(dtype = bool)
+        values = rows['value'].to_numpy(dtype = object)
+        values[counts] = rows['value'][counts].round().astype('int64').tolist()
+        rows['value'] = pd.Series(values, index = rows.index, dtype = object)
+        rows['week'] = [week_label(iso_year, iso_week) for iso_year, iso_week in zip(rows['iso_year'], rows['iso_week'])]
+        return rows
+
+    def totals_frame(self, source, first_week = None):
+        """Derives the totals worksheet of a source.
+
+        Args:
+            source: The worksheet name, like 'ga_totals'.
+            first_week: The (iso_year, iso_week) tuple of the first week to
+                fill in, or None for all the weeks. The week columns before
+                it are left empty, for sheets_loader.upload_delta to write
+                the weeks from it on.
+        Returns:
+            A pandas DataFrame with metrics as index and weeks as columns.
+        """
+        # The weeks stored while the rows are read wait for the next upload
+        weeks = self.week_labels(source)
+        rows = self.read_source(source, first_week)
+        data = rows.pivot(index = 'metric', columns = 'week', values = 'value').reindex(
+            index = pd.unique(rows['metric']),
+            columns = weeks
+            )
+        data.index.name, data.columns.name = None, None
+        return data
+
+    def details_frame(self, source, first_week = None):
+        """Derives the details worksheet of a source.
+
+        Every campaign keeps the row numbers of its key across all weeks and
+        runs, showing its name of each week, with its name row first and its
+        metric rows sorted by name.
+
+        Args:
+            source: The worksheet name, like 'ga_details'.
+            first_week: The (iso_year, iso_week) tuple of the first week to
+                fill in, or None for all the weeks. The week columns before
+                it are left empty and the campaigns only in them left out.
+        Returns:
+            A pandas DataFrame with 'campaign_i' and 'metric_i' rows and weeks as columns.
+        """
+        # The weeks stored while the rows are read wait for the next upload
+        weeks = self.week_labels(source)
+        rows = self.read_source(source, first_week)
+        keys = rows['campaign_key'].astype('int64')
+        names = rows[['campaign_key', 'week', 'campaign']].drop_duplicates(['campaign_key', 'week'])
+        names = pd.DataFrame({
+            'row': ['campaign_{}'.format(campaign_key) for campaign_key in names['campaign_key'].astype('int64')],
+            'week': names['week'],
+            'value': names['campaign']
+            })
+        values = pd.DataFrame({
+            'row': ['{}_{}'.format(metric, campaign_key) for campaign_key, metric in zip(keys, rows['metric'])],
+            'week': rows['week'],
+            'value': rows['value']
+            })
+        campaign_metrics = rows['metric'].groupby(keys).unique()
+        index = []
+        for campaign_key, metrics in campaign_metrics.items():
+            index.append('campaign_{}'.format(campaign_key))
+            for metric in sorted(metrics):
+                index.append('{}_{}'.format(metric, campaign_key))
+        data = pd.concat([names, values]).pivot(index = 'row', columns = 'week', values = 'value').reindex(
+            index = index,
+            columns = weeks
+            )
+        data.index.name, data.columns.name = None, None
+        return data
+
+def from_config(config, account = None):
+    """Opens the warehouse with the settings of a config.json.
+
+    Args:
+        config: The loaded config.json dictionary.
+        account: The ad account or view of the warehouse, named before the
+            extension of warehouse_path, or None for warehouse_path itself.
+    Returns:
+        A Warehouse.
+    """
+    path = config.get('warehouse_path', WAREHOUSE_PATH)
+    if account is not None:
+        root, extension = os.path.splitext(path)
+        path = '{}_{}{}'.format(root, account, extension)
+    return Warehouse(path = path)